@@ -1,18 +1,80 @@
 from pydantic import BaseModel, Field
+from typing import Literal
 
 model_field = Field(description="The name of the Model")
+# The priority classes of utils.admission
+PriorityClass = Literal["interactive", "standard", "batch"]
+
+
+class ModelBackend(BaseModel):
+    target_path: str = Field(description="The target path on the inference server.")
+    url: str | None = Field(
+        default=None,
+        description="Base url of the inference server (default: LLM_BASE_URL).",
+    )
+    weight: float = Field(
+        default=1, gt=0, description="Relative share of the requests for this backend."
+    )
+
+
+class ModelLimits(BaseModel):
+    stream_idle_timeout: float | None = Field(
+        default=None,
+        gt=0,
+        description="Seconds a stream may receive nothing from the inference server (default: STREAM_IDLE_TIMEOUT).",
+    )
+    max_output_tokens: int | None = Field(
+        default=None,
+        gt=0,
+        description="Maximum tokens of a streamed response (default: STREAM_MAX_TOKENS).",
+    )
+    max_output_bytes: int | None = Field(
+        default=None,
+        gt=0,
+        description="Maximum size of a streamed response in bytes (default: STREAM_MAX_BYTES).",
+    )
 
 
 class AddAvailableModelRequest(BaseModel):
     model: str = model_field
     target_path: str = Field(description="The target path on the inference server.")
     owner: str = Field(description="Who owns the model")
+    backends: list[ModelBackend] | None = Field(
+        default=None,
+        description="Replicas serving the model. If not given, the model is served from target_path on the default inference server.",
+    )
+    limits: ModelLimits | None = Field(
+        default=None, description="Limits for the streamed responses of the model."
+    )
 
 
 class AddApiKeyRequest(BaseModel):
     user: str = Field(description="The user with whom to associate the key.")
     key: str = Field(description="The key to add.")
     name: str = Field(description="The name of the key")
+    priority: PriorityClass | None = Field(
+        default=None,
+        description="The priority class of requests with this key (default: standard).",
+    )
+    weight: float | None = Field(
+        default=None,
+        gt=0,
+        description="The share of this key relative to other keys when requests are queued (default: 1).",
+    )
+
+
+class SetKeyWeightRequest(BaseModel):
+    key: str = Field(description="The key to update.")
+    weight: float = Field(
+        gt=0, description="The share of this key relative to other keys."
+    )
+
+
+class SetKeyPriorityRequest(BaseModel):
+    key: str = Field(description="The key to update.")
+    priority: PriorityClass = Field(
+        description="The priority class of requests with this key."
+    )
 
 
 class RemoveModelRequest(BaseModel):
@@ -1,7 +1,16 @@
 from .admin_requests import *
 from fastapi import APIRouter, Request, Security, HTTPException, status
-from security.api_keys import get_admin_key, key_handler
-from utils.handlers import model_handler
+from security.api_keys import get_admin_key
+from utils.handlers import (
+    key_handler,
+    model_handler,
+    upstream_health,
+    load_balancer,
+    metrics,
+    admission_controller,
+    redis_sync,
+)
+from utils.model_handler import gen_backend_object
 import logging
 
 router = APIRouter(
@@ -16,11 +25,23 @@ logger = logging.getLogger("admin")
 def addModel(
     RequestData: AddAvailableModelRequest, admin_key: str = Security(get_admin_key)
 ):
+    backends = None
+    if RequestData.backends:
+        backends = [
+            gen_backend_object(backend.target_path, backend.url, backend.weight)
+            for backend in RequestData.backends
+        ]
     try:
         model_handler.add_model(
             model=RequestData.model,
             owner=RequestData.owner,
             path=RequestData.target_path,
+            backends=backends,
+            limits=(
+                RequestData.limits.model_dump(exclude_none=True)
+                if RequestData.limits
+                else None
+            ),
         )
     except KeyError as e:
         raise HTTPException(status.HTTP_409_CONFLICT)
@@ -39,7 +60,11 @@ def removemodel(
 @router.post("/addapikey", status_code=status.HTTP_201_CREATED)
 def addKey(RequestData: AddApiKeyRequest, admin_key: str = Security(get_admin_key)):
     if key_handler.add_key(
-        user=RequestData.user, api_key=RequestData.key, name=RequestData.name
+        user=RequestData.user,
+        api_key=RequestData.key,
+        name=RequestData.name,
+        priority=RequestData.priority,
+        weight=RequestData.weight,
     ):
         pass
     else:
@@ -54,7 +79,60 @@ def removeKey(RequestData: AddApiKeyRequest, admin_key: str = Security(get_admin
         raise HTTPException(409, "Key already exists")
 
 
+@router.post("/setkeypriority", status_code=status.HTTP_200_OK)
+def setKeyPriority(
+    RequestData: SetKeyPriorityRequest, admin_key: str = Security(get_admin_key)
+):
+    if not key_handler.set_key_priority(RequestData.key, RequestData.priority):
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Key not found")
+
+
+@router.post("/setkeyweight", status_code=status.HTTP_200_OK)
+def setKeyWeight(
+    RequestData: SetKeyWeightRequest, admin_key: str = Security(get_admin_key)
+):
+    if not key_handler.set_key_weight(RequestData.key, RequestData.weight):
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Key not found")
+
+
 @router.get("/listkeys", status_code=status.HTTP_200_OK)
 def listKeys(RequestData: Request, admin_key: str = Security(get_admin_key)):
     logger.debug("Keys requested")
     return key_handler.list_keys()
+
+
+@router.get("/upstreams", status_code=status.HTTP_200_OK)
+def listUpstreams(admin_key: str = Security(get_admin_key)):
+    """
+    Circuit breaker state and outstanding requests of all upstream backends.
+    """
+    upstreams = upstream_health.get_status()
+    for upstream in upstreams:
+        upstream["in_flight"] = load_balancer.in_flight.get(
+            (upstream["url"], upstream["path"]), 0
+        )
+    return upstreams
+
+
+@router.get("/metrics", status_code=status.HTTP_200_OK)
+def getMetrics(admin_key: str = Security(get_admin_key)):
+    """
+    Event counters (e.g. cache hits and misses) of this worker.
+    """
+    return metrics.get_counters()
+
+
+@router.get("/sync", status_code=status.HTTP_200_OK)
+def getSync(admin_key: str = Security(get_admin_key)):
+    """
+    State of the sync of keys and models from the database to redis (shared by all workers).
+    """
+    return redis_sync.get_status()
+
+
+@router.get("/admission", status_code=status.HTTP_200_OK)
+def getAdmission(admin_key: str = Security(get_admin_key)):
+    """
+    Active and queued requests per model and queue statistics per key of this worker.
+    """
+    return admission_controller.get_status()
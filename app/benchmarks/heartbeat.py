@@ -0,0 +1,121 @@
+"""
+Benchmark of the per stream overhead of open event streams.
+
+Opens many idle streams (waiting for the next upstream chunk) and compares the
+number of tasks and the memory per stream of the previous implementation (ping
+and exit signal tasks per stream) with the shared heartbeat scheduler.
+
+Run from the app directory:
+    python -m benchmarks.heartbeat
+"""
+
+import asyncio
+import tracemalloc
+from datetime import datetime
+from functools import partial
+
+import anyio
+
+from utils.response_handling import (
+    AppStatus,
+    LoggingStreamResponse,
+    ServerSentEvent,
+    ensure_bytes,
+)
+from utils.stream_logger import StreamLogger
+
+STREAMS = 2000
+
+
+class DiscardUsage:
+    def log_usage_for_key(self, tokencount, model, key, isprompt=False):
+        pass
+
+
+class PreviousStreamResponse(LoggingStreamResponse):
+    # The previous implementation from utils/response_handling.py
+    @staticmethod
+    async def listen_for_exit_signal() -> None:
+        if AppStatus.should_exit:
+            return
+        if AppStatus.should_exit_event is None:
+            AppStatus.should_exit_event = anyio.Event()
+        if AppStatus.should_exit:
+            return
+        await AppStatus.should_exit_event.wait()
+
+    async def _ping(self, send) -> None:
+        while self.active:
+            await anyio.sleep(self._ping_interval)
+            ping = (
+                ServerSentEvent(comment=f"ping - {datetime.utcnow()}").encode()
+                if self.ping_message_factory is None
+                else ensure_bytes(self.ping_message_factory(), self.sep)
+            )
+            async with self._send_lock:
+                if self.active:
+                    await send(
+                        {"type": "http.response.body", "body": ping, "more_body": True}
+                    )
+
+    async def __call__(self, scope, receive, send) -> None:
+        async with anyio.create_task_group() as task_group:
+
+            async def wrap(func) -> None:
+                await func()
+                task_group.cancel_scope.cancel()
+
+            task_group.start_soon(wrap, partial(self.stream_response, send))
+            task_group.start_soon(wrap, partial(self._ping, send))
+            task_group.start_soon(wrap, self.listen_for_exit_signal)
+            await wrap(partial(self.listen_for_disconnect, receive))
+
+
+async def open_streams(response_class) -> tuple[int, int]:
+    release = anyio.Event()
+
+    async def upstream():
+        yield b'data: {"choices":[{"index":0}]}\r\n\r\n'
+        await release.wait()
+
+    async def receive():
+        await release.wait()
+        return {"type": "http.disconnect"}
+
+    async def discard(message):
+        pass
+
+    tasks = len(asyncio.all_tasks())
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    async with anyio.create_task_group() as task_group:
+        for _ in range(STREAMS):
+            response = response_class(
+                content=upstream(),
+                streamlogger=StreamLogger(DiscardUsage(), "key", True, "model"),
+            )
+            task_group.start_soon(response, {}, receive, discard)
+        # Let all streams send their first chunk and wait for the next one
+        await anyio.sleep(0.5)
+        memory = tracemalloc.get_traced_memory()[0] - start
+        tasks = len(asyncio.all_tasks()) - tasks
+        release.set()
+    tracemalloc.stop()
+    return tasks, memory
+
+
+def measure(name, response_class):
+    tasks, memory = asyncio.run(open_streams(response_class))
+    print(
+        f"{name:<24} {tasks / STREAMS:5.2f} tasks/stream  {memory / STREAMS / 1024:6.2f} KiB/stream"
+    )
+
+
+def main():
+    print(f"{STREAMS} idle streams")
+    measure("previous", PreviousStreamResponse)
+    measure("shared heartbeat", LoggingStreamResponse)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark of the token accounting for streamed responses.
+
+Compares the per token cost of the previous accounting (regex and json.loads on
+every decoded chunk) with the incremental SSE parser used by StreamLogger.
+
+Run from the app directory:
+    python -m benchmarks.stream_parsing
+"""
+
+import json
+import re
+import timeit
+
+from utils.sse_parsing import SSEParser, count_choices
+
+TOKENS = 2000
+
+
+def getTokensForChunk(streamChunk: str):
+    # The previous implementation from utils/stream_logger.py
+    regex = "(?:^data: )(.*)"
+    matches = re.findall(regex, streamChunk)
+    tokenCount = 0
+    for tokens in matches:
+        if tokens.strip() == "[DONE]":
+            pass
+        else:
+            parsed_json = json.loads(tokens)
+            dataChoices = parsed_json["choices"]
+            tokenCount = tokenCount + len(dataChoices)
+
+    return tokenCount
+
+
+def make_events(tokens: int) -> list[bytes]:
+    events = []
+    for i in range(tokens):
+        chunk = {
+            "id": "chatcmpl-5b7d1a3e-8a0e-4b5f-9c1e-0a1b2c3d4e5f",
+            "object": "chat.completion.chunk",
+            "created": 1718000000,
+            "model": "llama-3-8b-instruct",
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {"content": f" token{i}"},
+                    "logprobs": None,
+                    "finish_reason": None,
+                }
+            ],
+        }
+        events.append(b"data: " + json.dumps(chunk).encode() + b"\r\n\r\n")
+    events.append(b"data: [DONE]\r\n\r\n")
+    return events
+
+
+def split(data: bytes, size: int) -> list[bytes]:
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def previous(chunks: list[bytes]) -> int:
+    return sum(getTokensForChunk(chunk.decode()) for chunk in chunks)
+
+
+def incremental(chunks: list[bytes]) -> int:
+    parser = SSEParser()
+    count = 0
+    for chunk in chunks:
+        for data in parser.feed(chunk):
+            count += count_choices(data)
+    for data in parser.flush():
+        count += count_choices(data)
+    return count
+
+
+def measure(name, function, chunks, repeat=5):
+    counted = function(chunks)
+    best = min(timeit.repeat(lambda: function(chunks), number=1, repeat=repeat))
+    print(f"{name:<40} {best / TOKENS * 1e6:8.2f} us/token  {counted} tokens counted")
+
+
+def main():
+    events = make_events(TOKENS)
+    stream = b"".join(events)
+    print(f"{TOKENS} tokens, {len(stream)} bytes")
+    measure("previous, one event per chunk", previous, events)
+    measure("incremental, one event per chunk", incremental, events)
+    batched = [b"".join(events[i : i + 16]) for i in range(0, len(events), 16)]
+    # The previous implementation only counts the first event of each chunk
+    measure("previous, 16 events per chunk", previous, batched)
+    measure("incremental, 16 events per chunk", incremental, batched)
+    # The previous implementation fails on events split over chunks
+    measure("incremental, 100 byte chunks", incremental, split(stream, 100))
+    measure("incremental, 4KB chunks", incremental, split(stream, 4096))
+
+
+if __name__ == "__main__":
+    main()
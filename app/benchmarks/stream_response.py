@@ -0,0 +1,109 @@
+"""
+Benchmark of forwarding a streamed response through LoggingStreamResponse.
+
+Measures the throughput in tokens per second per core (CPU time of the single
+event loop thread) of the previous per chunk handling (ensure_bytes, decoded
+debug output and a timeout scope per chunk) and the current fast path.
+
+Run from the app directory:
+    python -m benchmarks.stream_response
+"""
+
+import asyncio
+import logging
+import time
+
+import anyio
+
+from benchmarks.stream_parsing import TOKENS, make_events
+from utils.response_handling import (
+    LoggingStreamResponse,
+    SendTimeoutError,
+    ensure_bytes,
+    _log,
+)
+from utils.stream_logger import StreamLogger
+
+
+class DiscardUsage:
+    def log_usage_for_key(self, tokencount, model, key, isprompt=False):
+        pass
+
+
+class PreviousStreamResponse(LoggingStreamResponse):
+    async def stream_response(self, send) -> None:
+        # The previous implementation from utils/response_handling.py
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        async for data in self.body_iterator:
+            chunk = ensure_bytes(data, self.sep)
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug(f"chunk: {chunk.decode()}")
+            self.streamlogger.handle_chunk(chunk)
+            with anyio.move_on_after(self.send_timeout) as timeout:
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+            if timeout.cancel_called:
+                await self.body_iterator.aclose()
+                raise SendTimeoutError()
+
+        async with self._send_lock:
+            self.active = False
+            await self.streamlogger.finish()
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def upstream(events: list[bytes]):
+    for event in events:
+        yield event
+
+
+async def discard(message):
+    pass
+
+
+async def forward(response_class, events: list[bytes], send_timeout) -> float:
+    response = response_class(
+        content=upstream(events),
+        send_timeout=send_timeout,
+        streamlogger=StreamLogger(DiscardUsage(), "key", True, "model"),
+    )
+    start = time.process_time()
+    await response.stream_response(discard)
+    return time.process_time() - start
+
+
+def measure(name, response_class, events, send_timeout, repeat=5):
+    best = min(
+        asyncio.run(forward(response_class, events, send_timeout))
+        for _ in range(repeat)
+    )
+    print(f"{name:<40} {TOKENS / best:12,.0f} tokens/s per core")
+
+
+def main():
+    events = make_events(TOKENS)
+    print(f"{TOKENS} tokens, one event per chunk")
+    for send_timeout in (None, 30):
+        measure(
+            f"previous, send_timeout={send_timeout}",
+            PreviousStreamResponse,
+            events,
+            send_timeout,
+        )
+        measure(
+            f"fast path, send_timeout={send_timeout}",
+            LoggingStreamResponse,
+            events,
+            send_timeout,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@
 from fastapi import (
     APIRouter,
     Request,
+    Response,
     BackgroundTasks,
     Security,
     HTTPException,
@@ -24,20 +25,52 @@ from llama_cpp.llama_types import (
 )
 from llama_cpp.server.types import ModelList
 
-from utils.response_handling import LoggingStreamResponse, event_generator
-from security.api_keys import get_api_key
+from utils.response_handling import AppStatus, LoggingStreamResponse
+from utils.response_cache import replay_events
+from utils.embedding_cache import (
+    get_text_inputs,
+    split_embedding_response,
+    build_embedding_response,
+)
+from utils.embedding_batching import EmbeddingBatcher
+from utils.request_building import InferenceRequest
+from security.api_keys import get_rate_limited_api_key
 from utils.handlers import (
-    model_handler,
     inference_request_builder,
-    logging_handler,
+    upstream_clients,
+    upstream_health,
+    health_checker,
+    response_cache,
+    embedding_cache,
+    admission_controller,
+    connections,
+    key_handler,
+    model_handler,
+    async_key_handler,
+    async_model_handler,
+    async_logging_handler,
+    session_handler,
+    redis_sync,
+    metrics,
 )
 from utils.stream_logger import StreamLogger
+from utils.sse_parsing import SSEParser, strip_usage_events
+from utils.stream_aggregation import StreamAggregator
+from utils.usage_extraction import extract_usage
+from utils.load_balancing import BackendLease
+from utils.admission import get_priority
+from utils.single_flight import SingleFlight
 from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
 
 
 import logging
+import anyio
 import httpx
+import json
+import math
 import os
+import time
 
 
 llm_logger = logging.getLogger("app")
@@ -49,152 +82,664 @@ router = APIRouter(
 )
 
 llm_logger.info(f"Request URL used is {os.environ.get("LLM_BASE_URL")}")
-stream_client = httpx.AsyncClient(base_url=os.environ.get("LLM_BASE_URL"))
+# Only parse and validate upstream responses against the schema when debugging
+validate_responses = int(os.environ.get("VALIDATE_RESPONSES", 0)) == 1
+# How often a request is sent to another backend if a backend can't be reached
+connect_retries = int(os.environ.get("UPSTREAM_CONNECT_RETRIES", 1))
+# Share one upstream call between identical concurrent deterministic requests
+request_coalescing = int(os.environ.get("REQUEST_COALESCING", 1)) == 1
+single_flight = SingleFlight()
+# Ask the inference server for the usage of streamed responses
+stream_usage = int(os.environ.get("STREAM_USAGE", 1)) == 1
+# Merge the events a stream receives within a few milliseconds into one send.
+# The window can be set per request with the X-Stream-Coalesce header (in ms).
+stream_coalesce_ms = float(os.environ.get("STREAM_COALESCE_MS", 0))
+stream_coalesce_max_ms = float(os.environ.get("STREAM_COALESCE_MAX_MS", 50))
+stream_coalesce_bytes = int(os.environ.get("STREAM_COALESCE_BYTES", 16384))
+# Send non streaming completions upstream as streams and aggregate the response,
+# so that the tokens generated so far are known if the client disconnects.
+upstream_aggregation = int(os.environ.get("UPSTREAM_STREAM_AGGREGATION", 0)) == 1
+# Watchdog limits of streams (0 for no limit), can be overridden per model
+stream_idle_timeout = float(os.environ.get("STREAM_IDLE_TIMEOUT", 0))
+stream_max_tokens = int(os.environ.get("STREAM_MAX_TOKENS", 0))
+stream_max_bytes = int(os.environ.get("STREAM_MAX_BYTES", 0))
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     llm_logger.debug("Lifespan called")
-    stream_client = httpx.AsyncClient(base_url=os.environ.get("LLM_BASE_URL"))
+    # The databases are first used here, not when the app is imported
+    await anyio.to_thread.run_sync(key_handler.init_database)
+    if not redis_sync.enabled:
+        # Otherwise only the sync leader rebuilds the keys and models in redis
+        await anyio.to_thread.run_sync(key_handler.init_keys)
+        await anyio.to_thread.run_sync(model_handler.init_models)
+    await upstream_clients.start(
+        [upstream_clients.default_url] + await async_model_handler.get_backend_urls()
+    )
+    # We will not accept any session from a previous run
+    await session_handler.clear_sessions()
+    health_checker.start()
+    key_handler.start_key_listener()
+    redis_sync.start()
     yield
-    await stream_client.aclose()
+    redis_sync.stop()
+    key_handler.stop_key_listener()
+    await health_checker.stop()
+    await upstream_clients.aclose()
+    await connections.aclose()
 
 
-@router.post("/completions")
-async def completion(
-    requestData: CompletionRequest,
+async def cancel_on_disconnect(request: Request, call: Callable[[], Awaitable]):
+    """
+    Handle a request and cancel the handling (e.g. a running upstream request)
+    as soon as the client disconnects.
+
+    Parameters:
+    - request (Request): The incoming request, its body is read first.
+    - call (Callable): Coroutine function handling the request.
+
+    Returns:
+    - The result of call, or an empty 499 response if the client disconnected.
+    """
+    # Requests in flight are waited for when draining
+    AppStatus.in_flight += 1
+    try:
+        # Only the disconnect can be received once the body has been read
+        await request.body()
+        disconnected = False
+        result = None
+        error = None
+        async with anyio.create_task_group() as task_group:
+
+            async def watch():
+                nonlocal disconnected
+                while (await request.receive())["type"] != "http.disconnect":
+                    pass
+                disconnected = True
+                task_group.cancel_scope.cancel()
+
+            task_group.start_soon(watch)
+            try:
+                result = await call()
+            except Exception as e:
+                # Raised as is below, not as an exception group of the task group
+                error = e
+            task_group.cancel_scope.cancel()
+    finally:
+        AppStatus.in_flight -= 1
+    if error is not None:
+        raise error
+    if disconnected:
+        llm_logger.info("Client disconnected, request cancelled")
+        metrics.increment("client_disconnects")
+        return Response(status_code=499)
+    return result
+
+
+async def get_stream_limits(model: str) -> dict:
+    """
+    Get the watchdog limits for a stream of a model, as arguments of LoggingStreamResponse.
+    """
+    limits = await async_model_handler.get_model_limits(model)
+    idle_timeout = limits.get("stream_idle_timeout", stream_idle_timeout)
+    max_tokens = limits.get("max_output_tokens", stream_max_tokens)
+    max_bytes = limits.get("max_output_bytes", stream_max_bytes)
+    return {
+        "idle_timeout": idle_timeout if idle_timeout > 0 else None,
+        "max_tokens": max_tokens if max_tokens > 0 else None,
+        "max_bytes": max_bytes if max_bytes > 0 else None,
+        "metrics": metrics,
+    }
+
+
+def get_coalesce_window(request: Request) -> float:
+    """
+    Get the coalescing window of a streamed request in seconds.
+    """
+    window = stream_coalesce_ms
+    requested = request.headers.get("x-stream-coalesce")
+    if requested is not None:
+        try:
+            window = float(requested)
+        except ValueError:
+            pass
+    if not 0 < window < math.inf:
+        return 0.0
+    return min(window, stream_coalesce_max_ms) / 1000
+
+
+def log_usage(
+    usage: dict,
+    token_field: str,
+    model: str,
+    api_key: str,
+    background_tasks: BackgroundTasks,
+):
+    """
+    Log the usage of a response. For completions, the prompt tokens are logged as a separate entry.
+    """
+    isprompt = token_field == "prompt_tokens"
+    background_tasks.add_task(
+        async_logging_handler.log_usage_for_key,
+        usage.get(token_field, 0),
+        model,
+        api_key,
+        isprompt=isprompt,
+    )
+    if not isprompt and "prompt_tokens" in usage:
+        background_tasks.add_task(
+            async_logging_handler.log_usage_for_key,
+            usage["prompt_tokens"],
+            model,
+            api_key,
+            isprompt=True,
+        )
+
+
+def forward_response(
+    r: httpx.Response,
+    token_field: str,
+    model: str,
+    api_key: str,
+    background_tasks: BackgroundTasks,
+):
+    """
+    Return a non streaming upstream response to the caller and log its usage.
+
+    The upstream body is passed through as is and only the usage is extracted
+    from it. If VALIDATE_RESPONSES is set, the body is parsed and returned as
+    data, so that FastAPI validates it against the endpoint's response model.
+    """
+    if validate_responses and r.is_success:
+        responseData = r.json()
+        usage = responseData.get("usage")
+    else:
+        usage = extract_usage(r.content)
+    if usage is not None:
+        log_usage(usage, token_field, model, api_key, background_tasks)
+    else:
+        llm_logger.warning(f"No usage in upstream response ({r.status_code})")
+    if validate_responses and r.is_success:
+        return responseData
+    return Response(
+        content=r.content,
+        status_code=r.status_code,
+        media_type=r.headers.get("content-type", "application/json"),
+    )
+
+
+async def close_upstream_response(r: httpx.Response, backend: BackendLease):
+    await r.aclose()
+    backend.release()
+
+
+async def send_upstream(inference_request, request: Request, stream: bool):
+    """
+    Send an inference request to one of the backends of the requested model,
+    once it is admitted by the admission control of the model.
+    Results are recorded in the backend's circuit breaker. If a backend cannot
+    be reached, the request is retried on another backend.
+
+    Returns:
+    - httpx.Response: The upstream response.
+    - str: The requested model.
+    - BackendLease: The backend handling the request, to be released when done.
+    """
+    permit = await admission_controller.acquire(
+        inference_request.model,
+        inference_request.priority,
+        inference_request.tenant,
+        inference_request.weight,
+    )
+    try:
+        failed_backends = []
+        while True:
+            req, model, backend = await inference_request_builder.build_request(
+                inference_request,
+                request.headers,
+                request.url.path,
+                request.method,
+                exclude=failed_backends,
+            )
+            start = time.monotonic()
+            try:
+                r = await backend.client.send(req, stream=stream)
+            except httpx.ConnectError as e:
+                backend.release()
+                upstream_health.record_failure(backend.key, repr(e))
+                failed_backends.append(backend.key)
+                if len(failed_backends) > connect_retries:
+                    raise
+                llm_logger.warning(f"Backend {backend.key} not reachable, retrying")
+                continue
+            except httpx.HTTPError as e:
+                backend.release()
+                upstream_health.record_failure(backend.key, repr(e))
+                raise
+            except BaseException:
+                # Cancelled, e.g. because the client disconnected
+                backend.release()
+                upstream_health.on_cancel(backend.key)
+                raise
+            if r.status_code >= 500:
+                upstream_health.record_failure(
+                    backend.key, f"Upstream returned status {r.status_code}"
+                )
+            else:
+                upstream_health.record_success(backend.key, time.monotonic() - start)
+            backend.permit = permit
+            return r, model, backend
+    except BaseException:
+        if permit is not None:
+            permit.release()
+        raise
+
+
+async def fetch_upstream(inference_request, request: Request, cache_key: str = None):
+    """
+    Send a non streaming inference request and read the full response.
+    Successful responses are stored in the response cache if a cache key is given.
+    """
+    r, model, backend = await send_upstream(inference_request, request, False)
+    backend.release()
+    if cache_key is not None and r.is_success:
+        await response_cache.set(model, cache_key, r.content)
+    return r, model
+
+
+async def fetch_aggregated(
+    inference_request,
     request: Request,
+    token_field: str,
+    api_key: str,
     background_tasks: BackgroundTasks,
-    api_key: str = Security(get_api_key),
-) -> Completion:
-    content = await request.body()
-    llm_logger.debug(content)
-    stream = requestData.stream
-    llm_logger.debug(stream_client)
-    req, model = await inference_request_builder.build_request(
-        requestData,
-        request.headers.mutablecopy(),
-        request.url.path,
-        request.method,
-        content.decode(),
-        stream_client,
+    cache_key: str = None,
+):
+    """
+    Answer a non streaming request by streaming it from the inference server
+    and aggregating the events into the response. If the request is cancelled,
+    the upstream generation is stopped and the tokens generated so far are logged.
+    """
+    r, model, backend = await send_upstream(
+        inference_request.as_stream(), request, True
     )
     try:
-        if stream:
+        if not r.is_success:
+            await r.aread()
+            return forward_response(r, token_field, model, api_key, background_tasks)
+        responselogger = StreamLogger(
+            logging_handler=async_logging_handler,
+            source=api_key,
+            iskey=True,
+            model=model,
+        )
+        aggregator = StreamAggregator()
+        parser = SSEParser()
+        try:
+            async for chunk in r.aiter_raw():
+                for data in parser.feed(chunk):
+                    responselogger.handle_event(data)
+                    aggregator.handle_event(data)
+            for data in parser.flush():
+                responselogger.handle_event(data)
+                aggregator.handle_event(data)
+        except BaseException:
+            # Log the partial usage, e.g. if the client disconnected
+            with anyio.move_on_after(LoggingStreamResponse.LOG_TIMEOUT, shield=True):
+                await responselogger.finish()
+            raise
+    finally:
+        await r.aclose()
+        backend.release()
+    if aggregator.error is not None:
+        return Response(
+            content=json.dumps(aggregator.error),
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            media_type="application/json",
+        )
+    content = json.dumps(aggregator.result()).encode()
+    if cache_key is not None:
+        await response_cache.set(model, cache_key, content)
+    usage = aggregator.usage or {token_field: responselogger.tokenCount}
+    log_usage(usage, token_field, model, api_key, background_tasks)
+    return Response(content=content, media_type="application/json")
+
+
+async def cached_response(
+    inference_request,
+    data: bytes,
+    token_field: str,
+    api_key: str,
+    background_tasks: BackgroundTasks,
+):
+    """
+    Answer a request from the response cache. Streams are replayed event by event.
+    """
+    model = inference_request.model
+    if inference_request.stream:
+        responselogger = StreamLogger(
+            logging_handler=async_logging_handler,
+            source=api_key,
+            iskey=True,
+            model=model,
+        )
+        content = replay_events(data)
+        if inference_request.strip_usage:
+            content = strip_usage_events(content, responselogger.handle_chunk)
+        return LoggingStreamResponse(
+            content=content,
+            streamlogger=responselogger,
+            coalesce_window=inference_request.coalesce_window,
+            coalesce_bytes=stream_coalesce_bytes,
+            **(await get_stream_limits(model)),
+        )
+    usage = extract_usage(data)
+    if usage is not None:
+        log_usage(usage, token_field, model, api_key, background_tasks)
+    return Response(content=data, media_type="application/json")
+
+
+async def send_embedding_batch(data: dict, inputs: list[str], request: Request):
+    batch_data = {**data, "input": inputs}
+    batch_request = InferenceRequest(json.dumps(batch_data).encode(), batch_data)
+    r, _ = await fetch_upstream(batch_request, request)
+    return r
+
+
+embedding_batcher = EmbeddingBatcher(send_embedding_batch)
+
+
+async def compute_embeddings(
+    inference_request: InferenceRequest, inputs: list[str], request: Request
+):
+    """
+    Compute the embeddings of inputs upstream. If batching is enabled, the inputs
+    are sent together with those of concurrent requests, otherwise identical
+    concurrent requests share one upstream call.
+
+    Returns:
+    - httpx.Response: The upstream response.
+    - list: The embeddings of the inputs, or None if the upstream request failed.
+    - list: The (estimated) tokens of the inputs, or None if the upstream request failed.
+    """
+    if embedding_batcher.enabled:
+        return await embedding_batcher.submit(
+            request.url.path, inference_request.data, inputs, request
+        )
+    batch_data = {**inference_request.data, "input": inputs}
+    batch_request = InferenceRequest(json.dumps(batch_data).encode(), batch_data)
+    if request_coalescing:
+        r, _ = await single_flight.do(
+            batch_request.get_key(request.url.path),
+            lambda: fetch_upstream(batch_request, request),
+        )
+    else:
+        r, _ = await fetch_upstream(batch_request, request)
+    if not r.is_success:
+        return r, None, None
+    return r, *split_embedding_response(r.json(), inputs)
+
+
+async def forward_embedding_request(
+    inference_request: InferenceRequest,
+    inputs: list[str],
+    request: Request,
+    background_tasks: BackgroundTasks,
+    api_key: str,
+):
+    """
+    Forward an embedding request with text inputs. Each distinct input is only
+    computed once, and only if it is not in the embedding cache (if enabled).
+    Tokens of inputs that did not need to be computed are logged as cached.
+    """
+    model = inference_request.model
+    unique_inputs = list(dict.fromkeys(inputs))
+    entries = {}
+    misses = unique_inputs
+    if embedding_cache.enabled:
+        keys = embedding_cache.get_keys(
+            request.url.path, inference_request.data, unique_inputs
+        )
+        values = await embedding_cache.get_many(model, keys)
+        misses = []
+        for text, key, value in zip(unique_inputs, keys, values):
+            if value is None:
+                misses.append(text)
+            else:
+                entries[text] = embedding_cache.decode_entry(value)
+        miss_keys = {text: key for text, key in zip(unique_inputs, keys)}
+    computed_tokens = 0
+    if len(misses) > 0:
+        r, embeddings, tokens = await compute_embeddings(
+            inference_request, misses, request
+        )
+        if embeddings is None:
+            return forward_response(
+                r, "prompt_tokens", model, api_key, background_tasks
+            )
+        computed_tokens = sum(tokens)
+        for text, embedding, token_count in zip(misses, embeddings, tokens):
+            entries[text] = {"embedding": embedding, "tokens": token_count}
+        if embedding_cache.enabled:
+            await embedding_cache.set_many(
+                model,
+                {
+                    miss_keys[text]: embedding_cache.encode_entry(
+                        embedding, token_count
+                    )
+                    for text, embedding, token_count in zip(misses, embeddings, tokens)
+                },
+            )
+    # Tokens of cached and duplicate inputs are reported as if they were computed.
+    prompt_tokens = sum(entries[text]["tokens"] for text in inputs)
+    background_tasks.add_task(
+        async_logging_handler.log_usage_for_key,
+        computed_tokens,
+        model,
+        api_key,
+        prompt_tokens - computed_tokens,
+        isprompt=True,
+    )
+    return build_embedding_response(
+        model, [entries[text]["embedding"] for text in inputs], prompt_tokens
+    )
+
+
+async def forward_inference_request(
+    request: Request,
+    request_type: type,
+    token_field: str,
+    background_tasks: BackgroundTasks,
+    api_key: str,
+    deterministic: bool = False,
+    cacheable: bool = False,
+    embeddings: bool = False,
+):
+    """
+    Forward an inference request to the inference server of the requested model.
+
+    The body is read and parsed once, and the original bytes are sent upstream.
+    Identical concurrent non streaming requests that are deterministic (or for a
+    deterministic endpoint) share a single upstream call, but the usage is
+    still logged for each of them. Deterministic requests to cacheable endpoints
+    are answered from the response cache if it is enabled. Text inputs of
+    embedding requests are looked up in the embedding cache and batched with
+    concurrent requests if these are enabled.
+    """
+    if AppStatus.draining:
+        raise HTTPException(
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+            "The gateway is shutting down",
+            headers={"Retry-After": "1"},
+        )
+    inference_request = inference_request_builder.parse_request(
+        await request.body(), request_type
+    )
+    if inference_request.stream:
+        if stream_usage:
+            inference_request.request_stream_usage()
+        inference_request.coalesce_window = get_coalesce_window(request)
+    llm_logger.debug(inference_request.body)
+    if admission_controller.enabled:
+        key_priority, inference_request.weight = (
+            await async_key_handler.get_key_scheduling(api_key)
+        )
+        inference_request.priority = get_priority(
+            key_priority, request.headers.get("x-priority")
+        )
+        inference_request.tenant = api_key
+    deterministic = deterministic or inference_request.is_deterministic()
+    cache_key = None
+    if cacheable and deterministic and response_cache.enabled:
+        cache_key = inference_request.get_key(request.url.path)
+        data = await response_cache.get(inference_request.model, cache_key)
+        if data is not None:
+            return await cached_response(
+                inference_request, data, token_field, api_key, background_tasks
+            )
+    inputs = None
+    if embeddings and (embedding_cache.enabled or embedding_batcher.enabled):
+        inputs = get_text_inputs(inference_request.data)
+    try:
+        if inputs is not None:
+            return await forward_embedding_request(
+                inference_request, inputs, request, background_tasks, api_key
+            )
+        if request_coalescing and not inference_request.stream and deterministic:
+            r, model = await single_flight.do(
+                cache_key or inference_request.get_key(request.url.path),
+                lambda: fetch_upstream(inference_request, request, cache_key),
+            )
+            return forward_response(r, token_field, model, api_key, background_tasks)
+        if upstream_aggregation and not inference_request.stream and not embeddings:
+            return await fetch_aggregated(
+                inference_request,
+                request,
+                token_field,
+                api_key,
+                background_tasks,
+                cache_key,
+            )
+        r, model, backend = await send_upstream(
+            inference_request, request, inference_request.stream
+        )
+        if inference_request.stream and r.is_success:
             responselogger = StreamLogger(
-                logging_handler=logging_handler, source=api_key, iskey=True, model=model
+                logging_handler=async_logging_handler,
+                source=api_key,
+                iskey=True,
+                model=model,
             )
-            # no logging implemented yet...
-            r = await stream_client.send(req, stream=True)
-            background_tasks.add_task(r.aclose)
+            background_tasks.add_task(close_upstream_response, r, backend)
+            content = r.aiter_raw()
+            if cache_key is not None:
+                content = response_cache.record_stream(content, model, cache_key)
+            if inference_request.strip_usage:
+                content = strip_usage_events(content, responselogger.handle_chunk)
             return LoggingStreamResponse(
-                content=event_generator(r.aiter_raw()),
+                content=content,
                 streamlogger=responselogger,
+                coalesce_window=inference_request.coalesce_window,
+                coalesce_bytes=stream_coalesce_bytes,
+                **(await get_stream_limits(model)),
             )
         else:
-            r = await stream_client.send(req)
+            if inference_request.stream:
+                # Errors are returned as they are, not as an event stream.
+                await r.aread()
+                await r.aclose()
+            backend.release()
             llm_logger.debug(r.content)
-            responseData = r.json()
-            tokens = responseData["usage"]["completion_tokens"]
-            background_tasks.add_task(
-                logging_handler.log_usage_for_key, tokens, model, api_key
-            )
-            return responseData
+            if cache_key is not None and r.is_success and not inference_request.stream:
+                await response_cache.set(model, cache_key, r.content)
+            return forward_response(r, token_field, model, api_key, background_tasks)
     except HTTPException as e:
         llm_logger.exception(e)
         raise e
+    except httpx.TimeoutException as e:
+        llm_logger.exception(e)
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Inference server timed out",
+        )
+    except httpx.TransportError as e:
+        llm_logger.exception(e)
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail="Inference server not reachable",
+        )
     except Exception as e:
         llm_logger.exception(e)
         # re-raise to let FastAPI handle it.
         raise HTTPException(status_code=500)
 
 
+# The request bodies are not parsed by FastAPI. They are only validated against
+# the llama_cpp request models if STRICT_REQUEST_VALIDATION is set.
+@router.post("/completions")
+async def completion(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    api_key: str = Security(get_rate_limited_api_key),
+) -> Completion:
+    return await cancel_on_disconnect(
+        request,
+        lambda: forward_inference_request(
+            request,
+            CompletionRequest,
+            "completion_tokens",
+            background_tasks,
+            api_key,
+            cacheable=True,
+        ),
+    )
+
+
 @router.post("/chat/completions")
 async def chat_completion(
-    requestData: ChatCompletionRequest,
     request: Request,
     background_tasks: BackgroundTasks,
-    api_key: str = Security(get_api_key),
+    api_key: str = Security(get_rate_limited_api_key),
 ) -> ChatCompletion:
-    content = await request.body()
-    llm_logger.debug(content)
-    stream = requestData.stream
-    req, model = await inference_request_builder.build_request(
-        requestData,
-        request.headers.mutablecopy(),
-        request.url.path,
-        request.method,
-        content.decode(),
-        stream_client,
+    return await cancel_on_disconnect(
+        request,
+        lambda: forward_inference_request(
+            request,
+            ChatCompletionRequest,
+            "completion_tokens",
+            background_tasks,
+            api_key,
+            cacheable=True,
+        ),
     )
-    try:
-        if stream:
-            responselogger = StreamLogger(
-                logging_handler=logging_handler, source=api_key, iskey=True, model=model
-            )
-            # no logging implemented yet...
-            r = await stream_client.send(req, stream=True)
-            background_tasks.add_task(r.aclose)
-            return LoggingStreamResponse(
-                content=event_generator(r.aiter_raw()),
-                streamlogger=responselogger,
-            )
-        else:            
-            r = await stream_client.send(req)
-            llm_logger.debug(r.content)
-            responseData = r.json()
-            tokens = responseData["usage"]["completion_tokens"]
-            background_tasks.add_task(
-                logging_handler.log_usage_for_key, tokens, model, api_key
-            )
-            return responseData
-    except HTTPException as e:
-        llm_logger.exception(e)
-        raise e
-    except Exception as e:
-        llm_logger.exception(e)
-        # re-raise to let FastAPI handle it.
-        raise HTTPException(status_code=500)
 
 
 @router.post("/embeddings")
 async def embedding(
-    requestData: EmbeddingRequest,
     request: Request,
     background_tasks: BackgroundTasks,
-    api_key: str = Security(get_api_key),
+    api_key: str = Security(get_rate_limited_api_key),
 ) -> CreateEmbeddingResponse:
-    content = await request.body()
-    llm_logger.debug(content)
-    req, model = await inference_request_builder.build_request(
-        requestData,
-        request.headers.mutablecopy(),
-        request.url.path,
-        request.method,
-        content.decode(),
-        stream_client,
+    return await cancel_on_disconnect(
+        request,
+        lambda: forward_inference_request(
+            request,
+            EmbeddingRequest,
+            "prompt_tokens",
+            background_tasks,
+            api_key,
+            deterministic=True,
+            embeddings=True,
+        ),
     )
-    try:
-        llm_logger.debug(req.content)
-        r = await stream_client.send(req)
-        responseData = r.json()
-        tokens = responseData["usage"]["prompt_tokens"]
-        background_tasks.add_task(
-            logging_handler.log_usage_for_key, tokens, model, api_key
-        )
-        return responseData
-    except HTTPException as e:
-        llm_logger.exception(e)
-        raise e
-    except Exception as e:
-        llm_logger.exception(e)
-        raise HTTPException(status_code=500)
 
 
 @router.get("/models/")
 @router.get("/models")
-def getModels() -> ModelList:
+async def getModels() -> ModelList:
     # At the moment hard-coded. Will update
-    models = model_handler.get_models()
+    models = await async_model_handler.get_models()
     if len(models) > 0:
         return {
             "object": "list",
@@ -9,6 +9,7 @@ uvlogger = logging.getLogger("app")
 
 
 from fastapi import FastAPI, Request, Security
+from fastapi.responses import JSONResponse
 
 
 from starlette.middleware.sessions import SessionMiddleware
@@ -17,6 +18,8 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from saml.saml_router import get_authed_user
 from utils.serverlogging import RouterLogging
+from utils.rate_limiting import RateLimitHeaders
+from utils.response_handling import AppStatus
 from llmapi.llm_router import lifespan
 from security.auth import SAMLSessionBackend
 from security.session import SessionHandler
@@ -58,6 +61,9 @@ app.add_middleware(
 
 app.add_middleware(SessionMiddleware, secret_key="some-random-string", max_age=None)
 
+# Add the rate limit headers of inference requests
+app.add_middleware(RateLimitHeaders)
+
 # Add Request logging
 app.add_middleware(RouterLogging, logger=uvlogger, debug=debugging)
 
@@ -97,5 +103,19 @@ async def getData(request: Request, user: any = Security(get_authed_user)):
         return {"data": "No Data"}
 
 
+@app.get("/health")
+async def health():
+    # Liveness: The gateway is running
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+async def ready():
+    # Readiness: The gateway accepts requests (not while draining for a shutdown)
+    if AppStatus.draining or AppStatus.should_exit:
+        return JSONResponse({"status": "draining"}, status_code=503)
+    return {"status": "ready"}
+
+
 # This has to be the very last route!!
 app.mount("/", SPAStaticFiles(directory="dist", html=True), name="FrontEnd")
@@ -101,7 +101,7 @@ async def saml_callback(request: Request):
                     status.HTTP_403_FORBIDDEN,
                     "Authentication invalid, missing saml data",
                 )
-            session_key = session_handler.create_session(sessionData)
+            session_key = await session_handler.create_session(sessionData)
             logger.debug("Session key created, adding to request session")
             request.session["key"] = session_key
             request.session["invalid"] = False
@@ -1,11 +1,13 @@
-from fastapi import Security, HTTPException
+from fastapi import Security, HTTPException, Request
 from fastapi.security import APIKeyHeader
-from utils.handlers import key_handler
+from collections import OrderedDict
+from utils.handlers import async_key_handler, rate_limiter
+from .auth import get_request_source
 
 import logging
 import re
 import os
-
+import time
 
 admin_key_header = APIKeyHeader(name="AdminKey")
 api_key_header = APIKeyHeader(name="Authorization")
@@ -14,11 +16,50 @@ logging.config.fileConfig("logging.conf", disable_existing_loggers=False)
 uvlogger = logging.getLogger("app")
 
 
-def get_api_key(api_key: str = Security(api_key_header)) -> str:
+class InvalidKeyLog:
+    """
+    Logs attempts with invalid keys at most once per interval and source, repeated
+    attempts are counted and reported with the next message of the source.
+    """
+
+    def __init__(self, interval: float = None, max_sources: int = 10000):
+        self.interval = (
+            float(os.environ.get("INVALID_KEY_LOG_INTERVAL", 60))
+            if interval is None
+            else interval
+        )
+        self.max_sources = max_sources
+        # source -> [time of the last message, suppressed attempts]
+        # Only used on the event loop, so no lock is needed
+        self.sources: OrderedDict[str, list] = OrderedDict()
+
+    def log(self, source: str, key: str):
+        now = time.monotonic()
+        entry = self.sources.get(source)
+        if entry is not None and now - entry[0] < self.interval:
+            entry[1] += 1
+            return
+        suppressed = 0 if entry is None else entry[1]
+        self.sources[source] = [now, 0]
+        self.sources.move_to_end(source)
+        while len(self.sources) > self.max_sources:
+            self.sources.popitem(last=False)
+        # Only a prefix, the header may be huge or a mistyped valid key
+        message = f"Attempted usage with invalid key {key[:8]}... from {source}"
+        if suppressed > 0:
+            message += f" ({suppressed} more since the last message)"
+        uvlogger.warning(message)
+
+
+invalid_key_log = InvalidKeyLog()
+
+
+async def get_api_key(request: Request, api_key: str = Security(api_key_header)) -> str:
     """
     Retrieves and validates the API key from the header.
 
     Args:
+    - request (Request): The request, its source is logged for invalid keys.
     - api_key_header (str): Header containing the API key preceded by 'Bearer '.
 
     Returns:
@@ -26,19 +67,49 @@ def get_api_key(api_key: str = Security(api_key_header)) -> str:
 
     Raises:
     - HTTPException: If the provided API key is invalid or missing, it raises a 401 status code error
-        with the detail "Invalid or missing API Key". Additionally, logs information about the header and key.
+        with the detail "Invalid or missing API Key". Additionally, logs the source and a prefix of the key (rate limited per source).
     """
     api_key = re.sub("^Bearer ", "", api_key)
-    if key_handler.check_key(api_key):
+    if await async_key_handler.check_key(api_key):
         return api_key
     else:
-        uvlogger.warn(f"Attempted usage with invalid key: {api_key}")
+        invalid_key_log.log(get_request_source(request), api_key)
     raise HTTPException(
         status_code=401,
         detail="Invalid or missing API Key",
     )
 
 
+async def get_rate_limited_api_key(
+    request: Request, api_key: str = Security(get_api_key)
+) -> str:
+    """
+    Retrieves and validates the API key from the header and applies the rate limits of the key.
+    The state of the limits is returned in x-ratelimit-* headers (added by the RateLimitHeaders middleware).
+
+    Args:
+    - request (Request): The request to limit.
+    - api_key (str): The validated API key.
+
+    Returns:
+    - str: The validated API key.
+
+    Raises:
+    - HTTPException: If the key exceeded its limits, it raises a 429 status code error with a Retry-After header.
+    """
+    result = await rate_limiter.check_request(api_key)
+    if result is None:
+        return api_key
+    if not result.allowed:
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded",
+            headers=result.headers(),
+        )
+    request.state.ratelimit_headers = result.headers()
+    return api_key
+
+
 def get_admin_key(admin_key_header: str = Security(admin_key_header)) -> str:
     """
     Retrieves the admin key from the header for privileged access.
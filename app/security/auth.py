@@ -8,7 +8,7 @@ from starlette.authentication import (
 )
 from starlette.requests import HTTPConnection
 from starlette.middleware import Middleware
-from .session import SessionHandler
+from .session import AsyncSessionHandler
 from fastapi import HTTPException, status
 import logging
 
@@ -34,7 +34,7 @@ class SAMLUser(SimpleUser):
 
 
 class SAMLSessionBackend(AuthenticationBackend):
-    def __init__(self, session_handler: SessionHandler):
+    def __init__(self, session_handler: AsyncSessionHandler):
         self.session_handler = session_handler
 
     async def authenticate(self, conn):
@@ -48,7 +48,7 @@ class SAMLSessionBackend(AuthenticationBackend):
         if not "key" in conn.session:
             return
         try:
-            data = self.session_handler.get_session_data(conn.session["key"])
+            data = await self.session_handler.get_session_data(conn.session["key"])
             # Check IP correct
             if data == None:
                 # This is not a valid session any more... so we need to reset it somehow.
@@ -1,7 +1,6 @@
 import redis
-import os
-import urllib
 import pymongo
+from utils.connections import ConnectionRegistry, MONGO, ASYNC_MONGO
 import secrets
 import string
 from datetime import datetime, timedelta
@@ -11,23 +10,25 @@ import logging
 
 
 class SessionHandler:
-    def __init__(self, testing: bool = False, exp_time: int = 600):
+    def __init__(
+        self,
+        testing: bool = False,
+        exp_time: int = 600,
+        connections: ConnectionRegistry = None,
+    ):
         self.expire_time = exp_time
         if not testing:
-            # Needs to be escaped if necessary
-            mongo_user = urllib.parse.quote_plus(os.environ.get("MONGOUSER"))
-            mongo_password = urllib.parse.quote_plus(os.environ.get("MONGOPASSWORD"))
-            mongo_URL = os.environ.get("MONGOHOST")
-            # Set up required endpoints.
-            mongo_client = pymongo.MongoClient(
-                "mongodb://%s:%s@%s/" % (mongo_user, mongo_password, mongo_URL)
-            )
-            self.setup(mongo_client)
+            connections = ConnectionRegistry() if connections is None else connections
+            connections.inject(self.setup, MONGO)
 
     def setup(self, mongo_client: pymongo.MongoClient):
         self.db = mongo_client["sessions"]
         self.session_collection = self.db["sessions"]
-        # Clean up sessions, we will not accept any session from a previous run
+
+    def clear_sessions(self):
+        """
+        Remove all sessions, we will not accept any session from a previous run.
+        """
         self.session_collection.delete_many({})
     def create_session(
         self, session_data: dict, session_key: str = None, update_existing: bool = False
@@ -106,3 +107,77 @@ class SessionHandler:
     def clear_session(self, session_key: str): 
         self.session_collection.delete_one({"key": session_key})
     
+
+class AsyncSessionHandler:
+    """
+    SessionHandler with an async mongo client, for use on the event loop.
+    """
+
+    def __init__(
+        self,
+        testing: bool = False,
+        exp_time: int = 600,
+        connections: ConnectionRegistry = None,
+    ):
+        self.expire_time = exp_time
+        if not testing:
+            connections = ConnectionRegistry() if connections is None else connections
+            connections.inject(self.setup, ASYNC_MONGO)
+
+    def setup(self, mongo_client: pymongo.AsyncMongoClient):
+        self.db = mongo_client["sessions"]
+        self.session_collection = self.db["sessions"]
+
+    generate_session_key = SessionHandler.generate_session_key
+
+    async def clear_sessions(self):
+        """
+        Remove all sessions, we will not accept any session from a previous run.
+        """
+        await self.session_collection.delete_many({})
+
+    async def create_session(
+        self, session_data: dict, session_key: str = None, update_existing: bool = False
+    ):
+        if session_key == None:
+            # Should be the case in most instances.
+            session_key = self.generate_session_key()
+        expire = datetime.now() + timedelta(seconds=self.expire_time)
+        dataToSet = {
+            "key": session_key,
+            "data": session_data,
+            "expire": expire.timestamp(),
+        }
+        if update_existing:
+            upsertCommand = {"$set": dataToSet}
+        else:
+            upsertCommand = {"$setOnInsert": dataToSet}
+        result = await self.session_collection.update_one(
+            {"key": session_key}, upsertCommand, upsert=not update_existing
+        )
+        # Nothing should have happened, if something was matched.
+        while (not update_existing) and (not result.matched_count == 0):
+            # This should indicate, that the key already existed.
+            if result.modified_count > 0:
+                raise Exception(
+                    "Updated an existing element while no update was requested"
+                )
+            session_key = self.generate_session_key()
+            dataToSet["key"] = session_key
+            result = await self.session_collection.update_one(
+                {"key": session_key}, {"$setOnInsert": dataToSet}, upsert=True
+            )
+        return session_key
+
+    async def get_session_data(self, session_key):
+        entry = await self.session_collection.find_one({"key": session_key})
+        if entry == None:
+            return None
+        if datetime.now().timestamp() >= entry["expire"]:
+            # This is expired, we can remove it...
+            await self.session_collection.delete_one({"key": session_key})
+            return None
+        return entry["data"]
+
+    async def clear_session(self, session_key: str):
+        await self.session_collection.delete_one({"key": session_key})
@@ -1,5 +1,7 @@
+import asyncio
 from pytest_mock_resources import create_mongo_fixture
-from session import SessionHandler
+from pymongo import AsyncMongoClient
+from session import AsyncSessionHandler, SessionHandler
 from fastapi import HTTPException
 
 
@@ -30,3 +32,24 @@ def test_expire_session(mongo):
         assert e.detail == "Session expired"
         failed = True
     assert failed
+
+
+def test_async_session(mongo):
+    credentials = mongo.pmr_credentials
+
+    async def run():
+        client = AsyncMongoClient(
+            credentials.host,
+            credentials.port,
+            username=credentials.username,
+            password=credentials.password,
+            authSource=credentials.database,
+        )
+        handler = AsyncSessionHandler(True)
+        handler.setup(client[credentials.database])
+        session_key = await handler.create_session({"Some": "Data"})
+        assert (await handler.get_session_data(session_key))["Some"] == "Data"
+        await handler.clear_session(session_key)
+        assert await handler.get_session_data(session_key) == None
+
+    asyncio.run(run())
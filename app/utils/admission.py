@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+
+from fastapi import HTTPException
+from fastapi import status
+
+from .metrics import Metrics
+
+logger = logging.getLogger("app")
+
+# Priority classes from highest to lowest
+PRIORITY_CLASSES = ("interactive", "standard", "batch")
+DEFAULT_PRIORITY = "standard"
+
+
+def get_priority(key_priority: str | None, requested: str | None) -> str:
+    """
+    Get the priority class of a request. The priority of the key is the highest
+    priority a request can have, a request can only ask for a lower one (e.g. via a header).
+
+    Parameters:
+    - key_priority (str): The priority stored for the key, None for the default.
+    - requested (str): The priority requested for the request, if any.
+
+    Returns:
+    - str: The priority class of the request.
+    """
+    if key_priority not in PRIORITY_CLASSES:
+        key_priority = DEFAULT_PRIORITY
+    if requested not in PRIORITY_CLASSES:
+        return key_priority
+    return max(key_priority, requested, key=PRIORITY_CLASSES.index)
+
+
+class AdmissionPermit:
+    """
+    Permission to send one request to the backends of a model.
+    """
+
+    def __init__(self, queue: "ModelQueue"):
+        self.queue = queue
+        self.start = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.queue.release(time.monotonic() - self.start)
+
+
+class FairQueue:
+    """
+    Weighted fair queue over tenants (keys) using deficit round robin: tenants
+    with waiting requests take turns, and in each turn a tenant may dispatch as
+    many requests as its weight (fractional weights accumulate over turns).
+    """
+
+    def __init__(self):
+        self.queues: dict[str, deque[asyncio.Future]] = {}
+        self.weights: dict[str, float] = {}
+        self.deficits: dict[str, float] = {}
+        # Tenants with waiting requests in round robin order
+        self.rotation: deque[str] = deque()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def push(self, tenant: str, weight: float, future: asyncio.Future):
+        queue = self.queues.get(tenant)
+        if queue is None:
+            queue = deque()
+            self.queues[tenant] = queue
+            self.deficits[tenant] = 0
+            self.rotation.append(tenant)
+        self.weights[tenant] = weight
+        queue.append(future)
+
+    def pop(self) -> asyncio.Future:
+        while True:
+            tenant = self.rotation[0]
+            if self.deficits[tenant] < 1:
+                # New turn for the tenant
+                self.deficits[tenant] += self.weights[tenant]
+                if self.deficits[tenant] < 1:
+                    self.rotation.rotate(-1)
+                    continue
+            queue = self.queues[tenant]
+            future = queue.popleft()
+            self.deficits[tenant] -= 1
+            if len(queue) == 0:
+                self.drop(tenant)
+            elif self.deficits[tenant] < 1:
+                self.rotation.rotate(-1)
+            return future
+
+    def remove(self, tenant: str, future: asyncio.Future):
+        queue = self.queues[tenant]
+        queue.remove(future)
+        if len(queue) == 0:
+            self.drop(tenant)
+
+    def drop(self, tenant: str):
+        del self.queues[tenant]
+        del self.weights[tenant]
+        del self.deficits[tenant]
+        self.rotation.remove(tenant)
+
+
+class ModelQueue:
+    """
+    Limits the number of concurrent requests to a model. Requests over the limit
+    wait in one queue per priority class, higher classes are admitted first.
+    Within a class, tenants are served fairly according to their weights.
+    """
+
+    def __init__(self, limit: int, max_depth: int):
+        self.limit = limit
+        self.max_depth = max_depth
+        self.active = 0
+        self.depth = 0
+        self.waiting: dict[str, FairQueue] = {
+            priority: FairQueue() for priority in PRIORITY_CLASSES
+        }
+        # Moving average of how long a request holds its permit
+        self.avg_duration = None
+
+    def retry_after(self) -> int:
+        """
+        Estimated seconds until a request would be admitted.
+        """
+        if self.avg_duration is None:
+            return 1
+        return max(math.ceil(self.avg_duration * (self.depth + 1) / self.limit), 1)
+
+    def release(self, duration: float):
+        if self.avg_duration is None:
+            self.avg_duration = duration
+        else:
+            self.avg_duration = 0.9 * self.avg_duration + 0.1 * duration
+        self.active -= 1
+        self.admit_next()
+
+    def admit_next(self):
+        for priority in PRIORITY_CLASSES:
+            queue = self.waiting[priority]
+            while len(queue.rotation) > 0 and self.active < self.limit:
+                future = queue.pop()
+                self.depth -= 1
+                self.active += 1
+                future.set_result(AdmissionPermit(self))
+            if self.active >= self.limit:
+                return
+
+    def info(self):
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued": {
+                priority: len(queue) for priority, queue in self.waiting.items()
+            },
+            "avg_duration": self.avg_duration,
+        }
+
+
+class TenantStats:
+    """
+    Queue statistics of a tenant (key) over all models.
+    """
+
+    def __init__(self):
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, wait: float):
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def info(self):
+        return {
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_wait": self.wait_total / max(self.admitted + self.rejected, 1),
+            "max_wait": self.wait_max,
+        }
+
+
+class AdmissionController:
+    """
+    Admission control in front of the backends of each model: at most
+    max_concurrency requests per model are sent upstream at once, further requests
+    are queued by priority class and shared fairly between tenants (keys) by weight.
+    Requests are rejected with 429 if the queue of the model is full or they waited
+    longer than queue_timeout.
+
+    Parameters:
+    - metrics (Metrics): Counters for admitted and rejected requests and the queue wait time.
+    """
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        # 0 disables admission control
+        self.max_concurrency = int(os.environ.get("ADMISSION_MAX_CONCURRENCY", 0))
+        self.enabled = self.max_concurrency > 0
+        self.max_queue = int(os.environ.get("ADMISSION_MAX_QUEUE", 256))
+        self.queue_timeout = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 60))
+        self.queues: dict[str, ModelQueue] = {}
+        self.tenants: dict[str, TenantStats] = {}
+
+    def get_queue(self, model: str) -> ModelQueue:
+        queue = self.queues.get(model)
+        if queue is None:
+            queue = ModelQueue(self.max_concurrency, self.max_queue)
+            self.queues[model] = queue
+        return queue
+
+    def get_tenant(self, tenant: str) -> TenantStats:
+        stats = self.tenants.get(tenant)
+        if stats is None:
+            stats = TenantStats()
+            self.tenants[tenant] = stats
+        return stats
+
+    def reject(self, queue: ModelQueue, stats: TenantStats, reason: str):
+        stats.rejected += 1
+        self.metrics.increment("admission_rejected")
+        raise HTTPException(
+            status.HTTP_429_TOO_MANY_REQUESTS,
+            reason,
+            headers={"Retry-After": str(queue.retry_after())},
+        )
+
+    async def acquire(
+        self, model: str, priority: str, tenant: str = "", weight: float = 1
+    ) -> AdmissionPermit | None:
+        """
+        Wait until a request to a model may be sent upstream.
+
+        Parameters:
+        - model (str): The requested model.
+        - priority (str): The priority class of the request.
+        - tenant (str, optional): Who the request belongs to, e.g. the api key.
+        - weight (float, optional): The share of the tenant relative to other tenants.
+
+        Returns:
+        - AdmissionPermit: To be released once the upstream request is done, None if admission control is disabled.
+
+        Raises:
+        - HTTPException: 429 if the queue is full or the request waited too long.
+        """
+        if not self.enabled:
+            return None
+        queue = self.get_queue(model)
+        stats = self.get_tenant(tenant)
+        if queue.active < queue.limit and queue.depth == 0:
+            queue.active += 1
+            stats.admitted += 1
+            self.metrics.increment("admission_admitted")
+            return AdmissionPermit(queue)
+        if queue.depth >= queue.max_depth:
+            self.reject(
+                queue, stats, "Too many queued requests for the requested model"
+            )
+        future = asyncio.get_running_loop().create_future()
+        queue.waiting[priority].push(tenant, weight, future)
+        queue.depth += 1
+        stats.queued += 1
+        start = time.monotonic()
+        try:
+            permit = await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Admitted at the same moment, give the permit back
+                future.result().release()
+            else:
+                queue.waiting[priority].remove(tenant, future)
+                queue.depth -= 1
+                future.cancel()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.reject(queue, stats, "Request waited too long for the requested model")
+        finally:
+            wait = time.monotonic() - start
+            stats.queued -= 1
+            stats.record_wait(wait)
+            self.metrics.increment("admission_wait_ms", int(wait * 1000))
+        stats.admitted += 1
+        self.metrics.increment("admission_admitted")
+        self.metrics.increment("admission_queued")
+        return permit
+
+    def get_status(self):
+        return {
+            "models": {model: queue.info() for model, queue in self.queues.items()},
+            "tenants": {tenant: stats.info() for tenant, stats in self.tenants.items()},
+        }
@@ -0,0 +1,183 @@
+import logging
+import os
+import threading
+import urllib
+
+import pymongo
+import redis
+import redis.asyncio
+
+logger = logging.getLogger("app")
+
+# The kinds of clients, handlers name the ones they need when they are injected
+MONGO = "mongo"
+ASYNC_MONGO = "async_mongo"
+REDIS = "redis"
+ASYNC_REDIS = "async_redis"
+
+
+class ConnectionRegistry:
+    """
+    The mongo and redis clients of a worker, shared by all handlers.
+
+    Clients are created when they are first needed and only connect on their
+    first operation, so the app can be imported without the databases. Every
+    client has a single (bounded) connection pool for the whole worker.
+
+    Mongo clients must not be used in a forked child, so the child drops the
+    clients of its parent and sets up the handlers with new ones (reset has to
+    be registered as at-fork hook by the owner of the registry). Redis clients
+    are kept, their pools are reset instead.
+    """
+
+    def __init__(self):
+        mongo_URL = os.environ.get("MONGOHOST")
+        if os.environ.get("MONGOUSER"):
+            # Needs to be escaped if necessary
+            mongo_user = urllib.parse.quote_plus(os.environ.get("MONGOUSER"))
+            mongo_password = urllib.parse.quote_plus(
+                os.environ.get("MONGOPASSWORD", "")
+            )
+            self.mongo_url = "mongodb://%s:%s@%s/" % (
+                mongo_user,
+                mongo_password,
+                mongo_URL,
+            )
+        else:
+            self.mongo_url = "mongodb://%s/" % mongo_URL
+        self.redis_host = os.environ.get("REDISHOST")
+        self.redis_port = int(os.environ.get("REDISPORT", 6379))
+        self.mongo_max_pool_size = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+        self.mongo_min_pool_size = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+        self.redis_max_connections = int(os.environ.get("REDIS_MAX_CONNECTIONS", 100))
+        # Seconds to wait for a free redis connection
+        self.redis_pool_timeout = float(os.environ.get("REDIS_POOL_TIMEOUT", 20))
+        self.clients = {}
+        # (setup, kinds) of the injected handlers
+        self.consumers = []
+        # Clients are requested by the threadpool and background threads
+        self.lock = threading.Lock()
+
+    def create(self, kind: str):
+        if kind == MONGO:
+            return pymongo.MongoClient(
+                self.mongo_url,
+                connect=False,
+                maxPoolSize=self.mongo_max_pool_size,
+                minPoolSize=self.mongo_min_pool_size,
+            )
+        if kind == ASYNC_MONGO:
+            return pymongo.AsyncMongoClient(
+                self.mongo_url,
+                connect=False,
+                maxPoolSize=self.mongo_max_pool_size,
+                minPoolSize=self.mongo_min_pool_size,
+            )
+        if kind == REDIS:
+            pool = redis.BlockingConnectionPool(
+                host=self.redis_host,
+                port=self.redis_port,
+                db=0,
+                max_connections=self.redis_max_connections,
+                timeout=self.redis_pool_timeout,
+            )
+            return redis.StrictRedis(connection_pool=pool)
+        if kind == ASYNC_REDIS:
+            pool = redis.asyncio.BlockingConnectionPool(
+                host=self.redis_host,
+                port=self.redis_port,
+                db=0,
+                max_connections=self.redis_max_connections,
+                timeout=self.redis_pool_timeout,
+            )
+            return redis.asyncio.StrictRedis(connection_pool=pool)
+        raise ValueError(f"Unknown client kind {kind}")
+
+    def get(self, kind: str):
+        """
+        Get the client of a kind, it is created if it does not exist yet.
+
+        Parameters:
+        - kind (str): One of MONGO, ASYNC_MONGO, REDIS or ASYNC_REDIS.
+
+        Returns:
+        - The shared client.
+        """
+        with self.lock:
+            client = self.clients.get(kind)
+            if client is None:
+                client = self.clients[kind] = self.create(kind)
+            return client
+
+    @property
+    def mongo(self) -> pymongo.MongoClient:
+        return self.get(MONGO)
+
+    @property
+    def async_mongo(self) -> pymongo.AsyncMongoClient:
+        return self.get(ASYNC_MONGO)
+
+    @property
+    def async_redis(self) -> redis.asyncio.Redis:
+        return self.get(ASYNC_REDIS)
+
+    # Last, the property hides the module in the class body
+    @property
+    def redis(self) -> redis.Redis:
+        return self.get(REDIS)
+
+    def inject(self, setup, *kinds: str):
+        """
+        Set up a handler with the shared clients, and again whenever the
+        clients are recreated.
+
+        Parameters:
+        - setup (Callable): The setup function of the handler, called with the
+          clients in the order of kinds.
+        - kinds (str): The kinds of the clients.
+        """
+        self.consumers.append((setup, kinds))
+        setup(*[self.get(kind) for kind in kinds])
+
+    def reset(self):
+        """
+        Replace the clients inherited from the parent after a fork.
+        """
+        # The lock may have been held by another thread of the parent
+        self.lock = threading.Lock()
+        for kind in (REDIS, ASYNC_REDIS):
+            if kind in self.clients:
+                # The connections belong to the parent and are not closed
+                self.clients[kind].connection_pool.reset()
+        self.renew_mongo()
+
+    def renew_mongo(self):
+        """
+        Set up the handlers with new mongo clients.
+        """
+        with self.lock:
+            self.clients.pop(MONGO, None)
+            self.clients.pop(ASYNC_MONGO, None)
+        for setup, kinds in self.consumers:
+            if MONGO in kinds or ASYNC_MONGO in kinds:
+                setup(*[self.get(kind) for kind in kinds])
+
+    async def aclose(self):
+        """
+        Close the connections of all clients, called when the app shuts down.
+
+        Redis clients reconnect if they are used again, closed mongo clients
+        can not be used any more.
+        """
+        for kind, client in list(self.clients.items()):
+            try:
+                if kind == ASYNC_MONGO:
+                    await client.close()
+                elif kind == ASYNC_REDIS:
+                    await client.connection_pool.disconnect()
+                elif kind == REDIS:
+                    client.connection_pool.disconnect()
+                else:
+                    client.close()
+            except Exception as e:
+                logger.warning(f"Closing the {kind} client failed: {e}")
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import os
+from typing import Any, Awaitable, Callable
+
+import httpx
+
+from .embedding_cache import split_embedding_response
+
+
+class _Batch:
+    def __init__(self, data: dict, context: Any):
+        self.data = data
+        self.context = context
+        self.inputs: list[str] = []
+        # (future, first input, end of inputs) of each waiting caller
+        self.waiters: list[tuple[asyncio.Future, int, int]] = []
+        self.timer: asyncio.TimerHandle = None
+
+
+class EmbeddingBatcher:
+    """
+    Collects the inputs of concurrent embedding requests for the same model
+    (and parameters) and sends them upstream as a single batch, once max_items
+    inputs are collected or max_wait passed since the first of them arrived.
+
+    Parameters:
+    - send (Callable): Coroutine function sending a batch upstream. It is called with
+      the request data, the batched inputs and the context of the first caller and
+      returns the upstream response.
+    """
+
+    def __init__(
+        self, send: Callable[[dict, list[str], Any], Awaitable[httpx.Response]]
+    ):
+        self.send = send
+        self.enabled = int(os.environ.get("EMBEDDING_BATCHING", 0)) == 1
+        self.max_items = int(os.environ.get("EMBEDDING_BATCH_MAX_ITEMS", 64))
+        self.max_wait = float(os.environ.get("EMBEDDING_BATCH_MAX_WAIT_MS", 5)) / 1000
+        self.batches: dict[str, _Batch] = {}
+        self.tasks: set[asyncio.Task] = set()
+
+    def get_key(self, path: str, data: dict) -> str:
+        params = {key: value for key, value in data.items() if not key == "input"}
+        return path + json.dumps(params, sort_keys=True, separators=(",", ":"))
+
+    async def submit(self, path: str, data: dict, inputs: list[str], context=None):
+        """
+        Add inputs to the current batch and wait until the batch was computed.
+
+        Parameters:
+        - path (str): The endpoint of the request.
+        - data (dict): The request data, only requests with the same data (apart from the input) are batched.
+        - inputs (list): The inputs to embed.
+        - context (Any, optional): Passed to send, if this request starts a batch.
+
+        Returns:
+        - httpx.Response: The upstream response of the batch.
+        - list: The embeddings of the inputs, or None if the upstream request failed.
+        - list: The (estimated) tokens of the inputs, or None if the upstream request failed.
+        """
+        loop = asyncio.get_running_loop()
+        key = self.get_key(path, data)
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = _Batch(data, context)
+            self.batches[key] = batch
+            batch.timer = loop.call_later(self.max_wait, self.flush, key, batch)
+        future = loop.create_future()
+        batch.waiters.append(
+            (future, len(batch.inputs), len(batch.inputs) + len(inputs))
+        )
+        batch.inputs.extend(inputs)
+        if len(batch.inputs) >= self.max_items:
+            self.flush(key, batch)
+        return await future
+
+    def flush(self, key: str, batch: _Batch):
+        if not self.batches.get(key) is batch:
+            # Already sent
+            return
+        del self.batches[key]
+        batch.timer.cancel()
+        task = asyncio.create_task(self.run(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, batch: _Batch):
+        try:
+            r = await self.send(batch.data, batch.inputs, batch.context)
+            if r.is_success:
+                embeddings, tokens = split_embedding_response(r.json(), batch.inputs)
+        except Exception as e:
+            for future, _, _ in batch.waiters:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, start, end in batch.waiters:
+            # Callers that were cancelled in the meantime are skipped.
+            if future.done():
+                continue
+            if r.is_success:
+                future.set_result((r, embeddings[start:end], tokens[start:end]))
+            else:
+                future.set_result((r, None, None))
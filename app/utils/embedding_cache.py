@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+
+import redis.asyncio
+
+from .metrics import Metrics
+from .response_cache import TieredCache
+
+
+def apportion_tokens(inputs: list[str], total: int) -> list[int]:
+    """
+    Split the token count of a batch over its inputs proportional to their length.
+    The inference server only reports the total, so this is an estimate, but the
+    shares always add up to the total.
+    """
+    if len(inputs) == 1:
+        return [total]
+    lengths = [max(len(text), 1) for text in inputs]
+    length_sum = sum(lengths)
+    shares = [total * length / length_sum for length in lengths]
+    tokens = [int(share) for share in shares]
+    # Hand out the remaining tokens to the largest remainders
+    remainders = sorted(
+        range(len(inputs)), key=lambda i: shares[i] - tokens[i], reverse=True
+    )
+    for i in remainders[: total - sum(tokens)]:
+        tokens[i] += 1
+    return tokens
+
+
+def get_text_inputs(data: dict) -> list[str] | None:
+    """
+    Get the inputs of an embedding request as list, or None if they are not text (i.e. tokens).
+    """
+    inputs = data.get("input")
+    if isinstance(inputs, str):
+        return [inputs]
+    if (
+        isinstance(inputs, list)
+        and len(inputs) > 0
+        and all(isinstance(text, str) for text in inputs)
+    ):
+        return inputs
+    return None
+
+
+def split_embedding_response(
+    response_data: dict, inputs: list[str]
+) -> tuple[list, list[int]]:
+    """
+    Get the embeddings and the (estimated) tokens of each input from an upstream embedding response.
+    """
+    embeddings = [None] * len(inputs)
+    for item in response_data["data"]:
+        embeddings[item["index"]] = item["embedding"]
+    tokens = apportion_tokens(inputs, response_data["usage"]["prompt_tokens"])
+    return embeddings, tokens
+
+
+def build_embedding_response(model: str, embeddings: list, prompt_tokens: int):
+    return {
+        "object": "list",
+        "data": [
+            {"object": "embedding", "embedding": embedding, "index": index}
+            for index, embedding in enumerate(embeddings)
+        ],
+        "model": model,
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+    }
+
+
+class EmbeddingCache(TieredCache):
+    """
+    Cache for embeddings of single inputs. Entries are keyed on a hash of the
+    request parameters and the input text, and store the embedding and the
+    (estimated) number of tokens of the input.
+    """
+
+    def __init__(self, redis_client: redis.asyncio.Redis, metrics: Metrics):
+        super().__init__(
+            redis_client,
+            prefix="embedding_cache",
+            ttl=int(os.environ.get("EMBEDDING_CACHE_TTL", 7 * 24 * 3600)),
+            max_entries=int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 16384)),
+            max_bytes=int(
+                os.environ.get("EMBEDDING_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+            ),
+            metrics=metrics,
+            generation_ttl=float(os.environ.get("EMBEDDING_CACHE_GENERATION_TTL", 5)),
+        )
+        self.enabled = int(os.environ.get("EMBEDDING_CACHE", 0)) == 1
+
+    def get_keys(self, path: str, data: dict, inputs: list[str]) -> list[str]:
+        """
+        Get the cache keys for the inputs of an embedding request.
+        """
+        params = {key: value for key, value in data.items() if not key == "input"}
+        params_key = path + json.dumps(params, sort_keys=True, separators=(",", ":"))
+        return [
+            hashlib.sha256(f"{params_key}\n{text}".encode()).hexdigest()
+            for text in inputs
+        ]
+
+    def encode_entry(self, embedding: list, tokens: int) -> bytes:
+        return json.dumps({"embedding": embedding, "tokens": tokens}).encode()
+
+    def decode_entry(self, value: bytes) -> dict:
+        return json.loads(value)
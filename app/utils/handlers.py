@@ -1,9 +1,20 @@
-from .logging_handler import LoggingHandler
-from .key_handler import KeyHandler
-from .model_handler import model_handler
+from .connections import ConnectionRegistry
+from .logging_handler import LoggingHandler, AsyncLoggingHandler
+from .key_handler import KeyHandler, AsyncKeyHandler
+from .model_handler import ModelHandler, AsyncModelHandler
 from .request_building import BodyHandler
-from security.session import SessionHandler
+from .upstream_clients import UpstreamClientManager
+from .load_balancing import LoadBalancer
+from .upstream_health import UpstreamHealth, HealthChecker
+from .metrics import Metrics
+from .response_cache import ResponseCache
+from .embedding_cache import EmbeddingCache
+from .admission import AdmissionController
+from .rate_limiting import RateLimiter
+from .redis_sync import RedisSync
+from security.session import AsyncSessionHandler
 from contextlib import asynccontextmanager
+from functools import partial
 
 
 from fastapi import FastAPI
@@ -14,12 +25,48 @@ import os
 import httpx
 
 uvlogger = logging.getLogger("app")
-inference_request_builder = BodyHandler(uvlogger, model_handler)
 inference_apikey = "Bearer " + os.environ.get("INFERENCE_KEY")
 
-# stream_client = httpx.AsyncClient(base_url="https://llm.k8s-test.cs.aalto.fi")
 api_key_header = APIKeyHeader(name="Authorization")
-logging_handler = LoggingHandler()
-session_handler = SessionHandler()
-key_handler = KeyHandler()
+# The database clients of the worker, shared by all handlers
+connections = ConnectionRegistry()
+# Workers forked after the app was imported (e.g. gunicorn --preload) get new mongo clients
+os.register_at_fork(after_in_child=connections.reset)
+# The sync handlers are used by threads (and sync endpoints), the async ones on the event loop
+logging_handler = LoggingHandler(connections=connections)
+async_logging_handler = AsyncLoggingHandler(connections=connections)
+session_handler = AsyncSessionHandler(connections=connections)
+key_handler = KeyHandler(connections=connections)
 key_handler.set_logger(uvlogger)
+async_key_handler = AsyncKeyHandler(
+    key_cache=key_handler.key_cache,
+    key_filter=key_handler.key_filter,
+    connections=connections,
+)
+async_key_handler.set_logger(uvlogger)
+model_handler = ModelHandler(connections=connections)
+async_model_handler = AsyncModelHandler(connections=connections)
+upstream_clients = UpstreamClientManager()
+load_balancer = LoadBalancer()
+upstream_health = UpstreamHealth()
+health_checker = HealthChecker(upstream_health, async_model_handler, upstream_clients)
+inference_request_builder = BodyHandler(
+    uvlogger, async_model_handler, upstream_clients, load_balancer, upstream_health
+)
+metrics = Metrics()
+# The sync model handler is used by the threadpool and the redis sync, it
+# invalidates the caches with the sync redis client
+response_cache = ResponseCache(connections.async_redis, metrics)
+model_handler.add_change_listener(
+    partial(response_cache.invalidate_model_sync, connections.redis)
+)
+async_model_handler.add_change_listener(response_cache.invalidate_model)
+embedding_cache = EmbeddingCache(connections.async_redis, metrics)
+model_handler.add_change_listener(
+    partial(embedding_cache.invalidate_model_sync, connections.redis)
+)
+async_model_handler.add_change_listener(embedding_cache.invalidate_model)
+admission_controller = AdmissionController(metrics)
+rate_limiter = RateLimiter(connections.async_redis)
+async_logging_handler.add_usage_listener(rate_limiter.record_tokens)
+redis_sync = RedisSync(key_handler, model_handler)
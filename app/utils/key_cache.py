@@ -0,0 +1,171 @@
+from collections import OrderedDict
+import logging
+import os
+import threading
+import time
+
+import redis
+
+logger = logging.getLogger("app")
+
+# Channel on which changed keys are published ("*" for all keys)
+KEY_CHANNEL = "key_changes"
+ALL_KEYS = "*"
+
+
+class KeyCache:
+    """
+    Per worker TTL/LRU cache of the results of key checks.
+
+    Valid and rejected keys are cached with separate TTLs. Changes of keys are
+    published on a redis channel, and every worker listening to it drops the
+    changed keys from its cache, so the TTL only bounds how long a missed
+    change (e.g. while the connection to redis was down) can be served.
+    """
+
+    def __init__(
+        self,
+        ttl: float = None,
+        negative_ttl: float = None,
+        max_entries: int = None,
+    ):
+        self.ttl = float(os.environ.get("KEY_CACHE_TTL", 60)) if ttl is None else ttl
+        self.negative_ttl = (
+            float(os.environ.get("KEY_CACHE_NEGATIVE_TTL", 5))
+            if negative_ttl is None
+            else negative_ttl
+        )
+        self.max_entries = (
+            int(os.environ.get("KEY_CACHE_SIZE", 100000))
+            if max_entries is None
+            else max_entries
+        )
+        # key -> (valid, expiry)
+        self.entries: OrderedDict[str, tuple[bool, float]] = OrderedDict()
+        # Incremented by every invalidation, results of checks started before an
+        # invalidation are not cached.
+        self.generation = 0
+        # Keys are checked on the event loop and invalidated by the listener thread
+        self.lock = threading.Lock()
+        self.change_listeners = []
+        self.pubsub = None
+        self.listener = None
+        self.stopped = threading.Event()
+
+    def get(self, key: str) -> bool | None:
+        """
+        Get the cached result of a key check.
+
+        Parameters:
+        - key (str): The key to look up.
+
+        Returns:
+        - bool: Whether the key is valid, None if it is not cached (or expired).
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: str, valid: bool, generation: int):
+        """
+        Cache the result of a key check.
+
+        Parameters:
+        - key (str): The checked key.
+        - valid (bool): The result of the check.
+        - generation (int): The generation when the check was started, the
+          result is dropped if the keys were invalidated since.
+        """
+        ttl = self.ttl if valid else self.negative_ttl
+        if ttl <= 0:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (valid, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key: str):
+        with self.lock:
+            self.generation += 1
+            if key == ALL_KEYS:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def add_change_listener(self, listener):
+        """
+        Register a function that is called with the key (or ALL_KEYS) whenever a
+        change is received from the channel.
+        """
+        self.change_listeners.append(listener)
+
+    def notify_change(self, key: str):
+        self.invalidate(key)
+        for listener in self.change_listeners:
+            try:
+                listener(key)
+            except Exception as e:
+                logger.exception(e)
+
+    def publish(self, redis_client: redis.Redis, key: str):
+        """
+        Drop a changed key from the caches of all workers.
+
+        Parameters:
+        - redis_client (redis.Redis): The client to publish with.
+        - key (str): The changed key, or ALL_KEYS.
+        """
+        # The publishing worker does not wait for its own message
+        self.invalidate(key)
+        redis_client.publish(KEY_CHANNEL, key)
+
+    def handle_message(self, message: dict):
+        if message["type"] == "message":
+            self.notify_change(message["data"].decode())
+        elif message["type"] == "subscribe":
+            # (Re)subscribed, changes may have been missed while disconnected
+            self.notify_change(ALL_KEYS)
+
+    def listen(self):
+        while not self.stopped.is_set():
+            try:
+                message = self.pubsub.get_message(timeout=1.0)
+            except redis.RedisError as e:
+                logger.warning(f"Key invalidation channel failed: {e}")
+                self.notify_change(ALL_KEYS)
+                self.stopped.wait(1.0)
+                continue
+            if message is not None:
+                self.handle_message(message)
+
+    def start(self, redis_client: redis.Redis):
+        """
+        Start listening for key changes of other workers in a background thread.
+        """
+        if self.listener is not None:
+            return
+        self.stopped.clear()
+        self.pubsub = redis_client.pubsub()
+        self.pubsub.subscribe(KEY_CHANNEL)
+        self.listener = threading.Thread(
+            target=self.listen, name="key-cache-listener", daemon=True
+        )
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is None:
+            return
+        self.stopped.set()
+        self.listener.join()
+        self.listener = None
+        self.pubsub.close()
+        self.pubsub = None
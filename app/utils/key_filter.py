@@ -0,0 +1,126 @@
+import hashlib
+import math
+import os
+import threading
+from typing import Iterable
+
+
+class BloomFilter:
+    """
+    Bloom filter of strings with a fixed capacity.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        capacity = max(capacity, 1)
+        self.size = max(
+            8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _indices(self, value: str):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, value: str):
+        for index in self._indices(value):
+            self.bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, value: str) -> bool:
+        for index in self._indices(value):
+            if not self.bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+
+class KeyFilter:
+    """
+    Bloom filter of the active keys, used to reject keys that certainly do not
+    exist without asking redis.
+
+    Until the filter is built (and whenever it may have missed added keys) every
+    key passes. Keys are never removed, removed keys are rejected by the key
+    check itself.
+    """
+
+    def __init__(self, error_rate: float = None, min_capacity: int = None):
+        self.enabled = int(os.environ.get("KEY_FILTER", 1)) == 1
+        self.error_rate = (
+            float(os.environ.get("KEY_FILTER_ERROR_RATE", 0.001))
+            if error_rate is None
+            else error_rate
+        )
+        self.min_capacity = (
+            int(os.environ.get("KEY_FILTER_MIN_CAPACITY", 10000))
+            if min_capacity is None
+            else min_capacity
+        )
+        self.bloom: BloomFilter = None
+        # The filter being built, keys added meanwhile are added to both
+        self.rebuilding: BloomFilter = None
+        # Keys are added on the event loop, by the admin endpoints in the threadpool
+        # and by the key listener and redis sync threads
+        self.lock = threading.Lock()
+
+    def might_contain(self, key: str) -> bool:
+        """
+        Check whether a key may be active.
+
+        Parameters:
+        - key (str): The key to check.
+
+        Returns:
+        - bool: False if the key is certainly not active.
+        """
+        bloom = self.bloom
+        return bloom is None or key in bloom
+
+    def add(self, key: str):
+        with self.lock:
+            if self.bloom is not None:
+                self.bloom.add(key)
+            if self.rebuilding is not None:
+                self.rebuilding.add(key)
+
+    def clear(self):
+        """
+        Let all keys pass until the filter is rebuilt.
+        """
+        with self.lock:
+            self.bloom = None
+
+    def rebuild(self, count: int, keys: Iterable[str], batch_size: int = 1000):
+        """
+        Build the filter from all active keys.
+
+        Parameters:
+        - count (int): The number of active keys, the filter is sized for twice as many.
+        - keys (Iterable[str]): The active keys.
+        - batch_size (int): Number of keys added at once while holding the lock.
+        """
+        if not self.enabled:
+            return
+        bloom = BloomFilter(max(2 * count, self.min_capacity), self.error_rate)
+        with self.lock:
+            self.rebuilding = bloom
+        try:
+            batch = []
+            for key in keys:
+                batch.append(key)
+                if len(batch) >= batch_size:
+                    self._add_batch(bloom, batch)
+                    batch = []
+            self._add_batch(bloom, batch)
+            with self.lock:
+                self.bloom = bloom
+        finally:
+            with self.lock:
+                self.rebuilding = None
+
+    def _add_batch(self, bloom: BloomFilter, keys: list[str]):
+        with self.lock:
+            for key in keys:
+                bloom.add(key)
@@ -1,58 +1,156 @@
 import redis
+import redis.asyncio
 import pymongo
 import secrets
 import string
-import os
-import urllib
+import uuid
 from logging import Logger
 
+from .connections import ConnectionRegistry, MONGO, ASYNC_MONGO, REDIS, ASYNC_REDIS
+from .key_cache import KeyCache, ALL_KEYS, KEY_CHANNEL
+from .key_filter import KeyFilter
+
 
 class KeyHandler:
-    def __init__(self, testing: bool = False):
+    def __init__(self, testing: bool = False, connections: ConnectionRegistry = None):
+        # Results of key checks, invalidated when keys change
+        self.key_cache = KeyCache()
+        # Active keys, built and updated by the key listener
+        self.key_filter = KeyFilter()
+        self.key_cache.add_change_listener(self.handle_key_change)
         if not testing:
-            # Needs to be escaped if necessary
-            mongo_user = urllib.parse.quote_plus(os.environ.get("MONGOUSER"))
-            mongo_password = urllib.parse.quote_plus(os.environ.get("MONGOPASSWORD"))
-
-            mongo_URL = os.environ.get("MONGOHOST")
-            # Set up required endpoints.
-            mongo_client = pymongo.MongoClient(
-                "mongodb://%s:%s@%s/" % (mongo_user, mongo_password, mongo_URL)
-            )
-            redis_host = os.environ.get("REDISHOST")
-            redis_port = os.environ.get("REDISPORT")
-            redis_client = redis.StrictRedis(
-                host=redis_host, port=int(redis_port), db=0
-            )
-            self.setup(mongo_client, redis_client)
+            connections = ConnectionRegistry() if connections is None else connections
+            connections.inject(self.setup, MONGO, REDIS)
 
     def setup(self, mongo_client: pymongo.MongoClient, redis_client: redis.Redis):
         self.redis_client = redis_client
         self.mongo_client = mongo_client
         self.db = mongo_client["gateway"]
         self.key_collection = self.db["apikeys"]
+        self.user_collection = self.db["users"]
+
+    def init_database(self):
+        """
+        Create the indices of the key and user collections, called on startup.
+        The keys in redis are initialized by the leader of the redis sync.
+        """
         keyindices = self.key_collection.index_information()
         # Make sure, that key is an index (avoids duplicates);
         if not "key" in keyindices:
             self.key_collection.create_index("key", unique=True)
-        self.user_collection = self.db["users"]
         # Make sure, that username is an index (avoids duplicates when creating keys, which automatically adds a user if necessary);
         userindices = self.user_collection.index_information()
         if not "username" in userindices:
             self.user_collection.create_index("username", unique=True)
-        self.init_keys()
 
     def set_logger(self, logger: Logger):
         self.logger = logger
 
     def init_keys(self):
         """
-        Initialize keys from the database
+        Initialize keys from the database.
+
+        The new keys are written to temporary keys which replace the current
+        ones in a single transaction, so all keys stay valid during the rebuild.
+        Nothing is written if the keys in redis are already up to date.
+        """
+        activeKeys = [
+            x
+            for x in self.key_collection.find(
+                {"active": True}, {"key": 1, "priority": 1, "weight": 1}
+            )
+        ]
+        keys = {x["key"] for x in activeKeys}
+        # Compared as redis returns them
+        priorities = {
+            x["key"]: str(x["priority"]) for x in activeKeys if "priority" in x
+        }
+        weights = {x["key"]: str(x["weight"]) for x in activeKeys if "weight" in x}
+        # The keys of the documents, deletions in the change stream only have the _id
+        ids = {str(x["_id"]): x["key"] for x in activeKeys}
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.smembers("keys")
+        pipeline.hgetall("key_priorities")
+        pipeline.hgetall("key_weights")
+        pipeline.hgetall("key_ids")
+        current = [
+            (
+                {x.decode() for x in values}
+                if isinstance(values, set)
+                else {name.decode(): value.decode() for name, value in values.items()}
+            )
+            for values in pipeline.execute()
+        ]
+        if current == [keys, priorities, weights, ids]:
+            return
+        suffix = f":sync:{uuid.uuid4().hex}"
+        pipeline = self.redis_client.pipeline(transaction=False)
+        if len(keys) > 0:
+            pipeline.sadd("keys" + suffix, *keys)
+        if len(priorities) > 0:
+            pipeline.hset("key_priorities" + suffix, mapping=priorities)
+        if len(weights) > 0:
+            pipeline.hset("key_weights" + suffix, mapping=weights)
+        if len(ids) > 0:
+            pipeline.hset("key_ids" + suffix, mapping=ids)
+        pipeline.execute()
+        pipeline = self.redis_client.pipeline(transaction=True)
+        for name, values in (
+            ("keys", keys),
+            ("key_priorities", priorities),
+            ("key_weights", weights),
+            ("key_ids", ids),
+        ):
+            if len(values) > 0:
+                pipeline.rename(name + suffix, name)
+            else:
+                pipeline.delete(name)
+        pipeline.execute()
+        self.key_cache.publish(self.redis_client, ALL_KEYS)
+
+    def sync_key(self, key_object: dict):
+        """
+        Apply the state of a key in the database to redis.
+
+        Parameters:
+        - key_object (dict): The key object (see build_new_key_object) as stored in the database.
+        """
+        key = key_object["key"]
+        pipeline = self.redis_client.pipeline(transaction=True)
+        if key_object.get("active"):
+            self.key_filter.add(key)
+            pipeline.sadd("keys", key)
+            pipeline.hset("key_ids", str(key_object["_id"]), key)
+        else:
+            pipeline.srem("keys", key)
+            pipeline.hdel("key_ids", str(key_object["_id"]))
+        for name, field in (("key_priorities", "priority"), ("key_weights", "weight")):
+            if key_object.get("active") and field in key_object:
+                pipeline.hset(name, key, key_object[field])
+            else:
+                pipeline.hdel(name, key)
+        pipeline.execute()
+        self.key_cache.publish(self.redis_client, key)
+
+    def sync_deleted_key(self, key_id):
+        """
+        Remove a key whose object was deleted from the database from redis.
+
+        Parameters:
+        - key_id: The _id of the deleted key object.
         """
-        activeKeys = [x["key"] for x in self.key_collection.find({"active": True})]
-        self.redis_client.delete("keys")
-        if len(activeKeys) > 0:
-            self.redis_client.sadd("keys", *activeKeys)
+        key = self.redis_client.hget("key_ids", str(key_id))
+        if key is None:
+            # Was not active, so it is not in redis
+            return
+        key = key.decode()
+        pipeline = self.redis_client.pipeline(transaction=True)
+        pipeline.srem("keys", key)
+        pipeline.hdel("key_priorities", key)
+        pipeline.hdel("key_weights", key)
+        pipeline.hdel("key_ids", str(key_id))
+        pipeline.execute()
+        self.key_cache.publish(self.redis_client, key)
 
     def generate_api_key(self, length: int = 64):
         """
@@ -68,18 +166,32 @@ class KeyHandler:
         api_key = "".join(secrets.choice(alphabet) for _ in range(length))
         return api_key
 
-    def build_new_key_object(self, user: string, key: string, name: string):
+    def build_new_key_object(
+        self,
+        user: string,
+        key: string,
+        name: string,
+        priority: string = None,
+        weight: float = None,
+    ):
         """
         Function to create a new key object.
 
         Parameters:
         - key (str): The key value.
         - name (str): The name associated with the key.
+        - priority (str, optional): The priority class of requests with this key.
+        - weight (float, optional): The share of this key when requests are queued.
 
         Returns:
         - dict: A dictionary representing the key object with "active" status, key, and name.
         """
-        return {"user": user, "active": True, "key": key, "name": name}
+        key_object = {"user": user, "active": True, "key": key, "name": name}
+        if not priority == None:
+            key_object["priority"] = priority
+        if not weight == None:
+            key_object["weight"] = weight
+        return key_object
 
     def check_key(self, key: string):
         """
@@ -91,7 +203,120 @@ class KeyHandler:
         Returns:
         - bool: True if the key exists
         """
-        return self.redis_client.sismember("keys", key)
+        if not self.key_filter.might_contain(key):
+            # Invalid keys (e.g. of scanners) neither reach redis nor the cache
+            return False
+        valid = self.key_cache.get(key)
+        if valid is None:
+            generation = self.key_cache.generation
+            valid = bool(self.redis_client.sismember("keys", key))
+            self.key_cache.set(key, valid, generation)
+        return valid
+
+    def start_key_listener(self):
+        """
+        Listen for keys changed by other workers to drop them from the key cache.
+        """
+        self.key_cache.start(self.redis_client)
+
+    def stop_key_listener(self):
+        self.key_cache.stop()
+
+    def handle_key_change(self, key: string):
+        """
+        Update the key filter with a key changed in any worker.
+
+        Parameters:
+        - key (str): The changed key, or ALL_KEYS if any key may have changed.
+        """
+        if key == ALL_KEYS:
+            # Until it is rebuilt, the filter may lack added keys
+            self.key_filter.clear()
+            self.rebuild_key_filter()
+        else:
+            self.key_filter.add(key)
+
+    def rebuild_key_filter(self):
+        """
+        Build the key filter from the active keys in redis.
+        """
+        self.key_filter.rebuild(
+            self.redis_client.scard("keys"),
+            (key.decode() for key in self.redis_client.sscan_iter("keys", count=1000)),
+        )
+
+    def get_key_priority(self, key: string):
+        """
+        Function to get the priority class of a key
+
+        Parameters:
+        - key (str): The key to check.
+
+        Returns:
+        - str: The priority class of the key or None if it has none set.
+        """
+        priority = self.redis_client.hget("key_priorities", key)
+        if priority == None:
+            return None
+        return priority.decode()
+
+    def set_key_priority(self, key: string, priority: string):
+        """
+        Function to set the priority class of a key
+
+        Parameters:
+        - key (str): The key to update.
+        - priority (str): The priority class of requests with this key.
+
+        Returns:
+        - bool: true, if the key exists.
+        """
+        result = self.key_collection.update_one(
+            {"key": key}, {"$set": {"priority": priority}}
+        )
+        if result.matched_count == 0:
+            return False
+        self.redis_client.hset("key_priorities", key, priority)
+        return True
+
+    def set_key_weight(self, key: string, weight: float):
+        """
+        Function to set the weight of a key, i.e. its share when requests are queued
+
+        Parameters:
+        - key (str): The key to update.
+        - weight (float): The weight relative to other keys (default is 1).
+
+        Returns:
+        - bool: true, if the key exists.
+        """
+        result = self.key_collection.update_one(
+            {"key": key}, {"$set": {"weight": weight}}
+        )
+        if result.matched_count == 0:
+            return False
+        self.redis_client.hset("key_weights", key, weight)
+        return True
+
+    def get_key_scheduling(self, key: string):
+        """
+        Function to get the priority class and weight of a key in a single redis call
+
+        Parameters:
+        - key (str): The key to check.
+
+        Returns:
+        - str: The priority class of the key or None if it has none set.
+        - float: The weight of the key.
+        """
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.hget("key_priorities", key)
+        pipeline.hget("key_weights", key)
+        priority, weight = pipeline.execute()
+        return (
+            None if priority == None else priority.decode(),
+            1.0 if weight == None else float(weight),
+        )
 
     def delete_key_for_user(self, key: string, user: string):
         """
@@ -113,6 +338,7 @@ class KeyHandler:
             # removal should be instantaneous
             self.key_collection.update_one({"key": key}, {"$set": {"active": False}})
             self.redis_client.srem("keys", key)
+            self.key_cache.publish(self.redis_client, key)
 
     def delete_key(self, key: string, user: string = None):
         """
@@ -140,6 +366,9 @@ class KeyHandler:
             self.key_collection.delete_one({"key": key})
             # NOTE: We do NOT remove any log files for the key.
             self.redis_client.srem("keys", key)
+            self.redis_client.hdel("key_priorities", key)
+            self.redis_client.hdel("key_weights", key)
+            self.key_cache.publish(self.redis_client, key)
 
     def set_key_activity(self, key: string, user: string, active: bool):
         """
@@ -158,11 +387,20 @@ class KeyHandler:
             # the requesting user has access to this key
             self.key_collection.update_one({"key": key}, {"$set": {"active": active}})
             if active:
+                self.key_filter.add(key)
                 self.redis_client.sadd("keys", key)
             else:
                 self.redis_client.srem("keys", key)
-
-    def add_key(self, user: string, name: string, api_key: str):
+            self.key_cache.publish(self.redis_client, key)
+
+    def add_key(
+        self,
+        user: string,
+        name: string,
+        api_key: str,
+        priority: string = None,
+        weight: float = None,
+    ):
         """
         Adds a key for a specific user if the key doesn't exist yet.
 
@@ -170,6 +408,8 @@ class KeyHandler:
         - user: Username of the user to whom the API key will be associated.
         - name: Name or label for the API key.
         - api_key: The key itself
+        - priority: The priority class of requests with the key (optional)
+        - weight: The share of the key when requests are queued (optional)
 
         Returns:
         - bool: true, if the key was added false if not.
@@ -178,12 +418,19 @@ class KeyHandler:
         found = self.key_collection.find_one({"key": api_key})
         if found == None:
             self.key_collection.insert_one(
-                self.build_new_key_object(user, api_key, name)
+                self.build_new_key_object(user, api_key, name, priority, weight)
             )
             self.user_collection.update_one(
                 {"username": user}, {"$addToSet": {"keys": api_key}}, upsert=True
             )
+            self.key_filter.add(api_key)
             self.redis_client.sadd("keys", api_key)
+            if not priority == None:
+                self.redis_client.hset("key_priorities", api_key, priority)
+            if not weight == None:
+                self.redis_client.hset("key_weights", api_key, weight)
+            # Drops a cached rejection of the key
+            self.key_cache.publish(self.redis_client, api_key)
             key_created = True
         return key_created
 
@@ -230,3 +477,223 @@ class KeyHandler:
         return [
             {"key": x["key"], "active": x["active"], "name": x["name"]} for x in keys
         ]
+
+
+class AsyncKeyHandler:
+    """
+    KeyHandler with async mongo and redis clients, for use on the event loop.
+
+    The methods are the same as those of KeyHandler, except for the startup
+    and sync of the keys (init_database, sync_key and the key listener) which stay
+    with the KeyHandler of the worker. The key cache and filter should be
+    shared with it, so both see the changes of the other.
+    """
+
+    def __init__(
+        self,
+        testing: bool = False,
+        key_cache: KeyCache = None,
+        key_filter: KeyFilter = None,
+        connections: ConnectionRegistry = None,
+    ):
+        self.key_cache = KeyCache() if key_cache is None else key_cache
+        self.key_filter = KeyFilter() if key_filter is None else key_filter
+        if not testing:
+            connections = ConnectionRegistry() if connections is None else connections
+            connections.inject(self.setup, ASYNC_MONGO, ASYNC_REDIS)
+
+    def setup(
+        self, mongo_client: pymongo.AsyncMongoClient, redis_client: redis.asyncio.Redis
+    ):
+        self.redis_client = redis_client
+        self.mongo_client = mongo_client
+        self.db = mongo_client["gateway"]
+        self.key_collection = self.db["apikeys"]
+        self.user_collection = self.db["users"]
+
+    set_logger = KeyHandler.set_logger
+    generate_api_key = KeyHandler.generate_api_key
+    build_new_key_object = KeyHandler.build_new_key_object
+
+    async def publish_key_change(self, key: string):
+        """
+        Drop a changed key from the key caches of all workers.
+        """
+        self.key_cache.invalidate(key)
+        await self.redis_client.publish(KEY_CHANNEL, key)
+
+    async def check_key(self, key: string):
+        """
+        Function to check if a key currently exists
+
+        Parameters:
+        - key (str): The key to check.
+
+        Returns:
+        - bool: True if the key exists
+        """
+        if not self.key_filter.might_contain(key):
+            return False
+        valid = self.key_cache.get(key)
+        if valid is None:
+            generation = self.key_cache.generation
+            valid = bool(await self.redis_client.sismember("keys", key))
+            self.key_cache.set(key, valid, generation)
+        return valid
+
+    async def get_key_priority(self, key: string):
+        priority = await self.redis_client.hget("key_priorities", key)
+        if priority == None:
+            return None
+        return priority.decode()
+
+    async def set_key_priority(self, key: string, priority: string):
+        result = await self.key_collection.update_one(
+            {"key": key}, {"$set": {"priority": priority}}
+        )
+        if result.matched_count == 0:
+            return False
+        await self.redis_client.hset("key_priorities", key, priority)
+        return True
+
+    async def set_key_weight(self, key: string, weight: float):
+        result = await self.key_collection.update_one(
+            {"key": key}, {"$set": {"weight": weight}}
+        )
+        if result.matched_count == 0:
+            return False
+        await self.redis_client.hset("key_weights", key, weight)
+        return True
+
+    async def get_key_scheduling(self, key: string):
+        """
+        Function to get the priority class and weight of a key in a single redis call
+
+        Parameters:
+        - key (str): The key to check.
+
+        Returns:
+        - str: The priority class of the key or None if it has none set.
+        - float: The weight of the key.
+        """
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.hget("key_priorities", key)
+        pipeline.hget("key_weights", key)
+        priority, weight = await pipeline.execute()
+        return (
+            None if priority == None else priority.decode(),
+            1.0 if weight == None else float(weight),
+        )
+
+    async def delete_key_for_user(self, key: string, user: string):
+        updated_user = await self.user_collection.find_one_and_update(
+            {"username": user, "keys": {"$elemMatch": {"$eq": key}}},
+            {"$pull": {"keys": key}},
+        )
+        if not updated_user == None:
+            await self.key_collection.update_one(
+                {"key": key}, {"$set": {"active": False}}
+            )
+            await self.redis_client.srem("keys", key)
+            await self.publish_key_change(key)
+
+    async def delete_key(self, key: string, user: string = None):
+        query = {"keys": {"$elemMatch": {"$eq": key}}}
+        if not user == None:
+            query["username"] = user
+        updated_user = await self.user_collection.find_one_and_update(
+            query, {"$pull": {"keys": key}}
+        )
+        # Since all keys have to be associated with a user...
+        if not updated_user == None:
+            await self.key_collection.delete_one({"key": key})
+            # NOTE: We do NOT remove any log files for the key.
+            pipeline = self.redis_client.pipeline(transaction=False)
+            pipeline.srem("keys", key)
+            pipeline.hdel("key_priorities", key)
+            pipeline.hdel("key_weights", key)
+            await pipeline.execute()
+            await self.publish_key_change(key)
+
+    async def set_key_activity(self, key: string, user: string, active: bool):
+        user_has_key = await self.user_collection.find_one(
+            {"username": user, "keys": {"$elemMatch": {"$eq": key}}}
+        )
+        if not user_has_key == None:
+            await self.key_collection.update_one(
+                {"key": key}, {"$set": {"active": active}}
+            )
+            if active:
+                self.key_filter.add(key)
+                await self.redis_client.sadd("keys", key)
+            else:
+                await self.redis_client.srem("keys", key)
+            await self.publish_key_change(key)
+
+    async def add_key(
+        self,
+        user: string,
+        name: string,
+        api_key: str,
+        priority: string = None,
+        weight: float = None,
+    ):
+        """
+        Adds a key for a specific user if the key doesn't exist yet.
+
+        Returns:
+        - bool: true, if the key was added false if not.
+        """
+        found = await self.key_collection.find_one({"key": api_key})
+        if not found == None:
+            return False
+        await self.key_collection.insert_one(
+            self.build_new_key_object(user, api_key, name, priority, weight)
+        )
+        await self.user_collection.update_one(
+            {"username": user}, {"$addToSet": {"keys": api_key}}, upsert=True
+        )
+        self.key_filter.add(api_key)
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.sadd("keys", api_key)
+        if not priority == None:
+            pipeline.hset("key_priorities", api_key, priority)
+        if not weight == None:
+            pipeline.hset("key_weights", api_key, weight)
+        await pipeline.execute()
+        # Drops a cached rejection of the key
+        await self.publish_key_change(api_key)
+        return True
+
+    async def create_key(self, user: string, name: string):
+        """
+        Generates a unique API key and associates it with a specified user.
+
+        Returns:
+        - api_key: The generated unique API key, None if the user has the maximum number of keys.
+        """
+        userinfo = await self.user_collection.find_one({"username": user})
+        if userinfo == None or len(userinfo["keys"]) < 10:
+            api_key = self.generate_api_key()
+            while not await self.add_key(user=user, name=name, api_key=api_key):
+                api_key = self.generate_api_key()
+            return api_key
+        else:
+            return None
+
+    async def list_keys(self, user=None):
+        """
+        List the available
+
+        Returns:
+        - a list of keys in the format [{'key' : key, 'active' : True/False, 'name' : keyname}]
+        """
+        if user == None:
+            query = {}
+        else:
+            userinfo = await self.user_collection.find_one({"username": user})
+            query = {"key": {"$in": [] if userinfo == None else userinfo["keys"]}}
+        return [
+            {"key": x["key"], "active": x["active"], "name": x["name"]}
+            async for x in self.key_collection.find(query)
+        ]
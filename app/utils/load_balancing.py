@@ -0,0 +1,93 @@
+import os
+import random
+
+LEAST_OUTSTANDING = "least_outstanding"
+POWER_OF_TWO = "p2c"
+
+
+class BackendLease:
+    """
+    A backend chosen for one request. The request counts as outstanding on
+    the backend until the lease is released.
+    """
+
+    def __init__(self, balancer: "LoadBalancer", backend: dict):
+        self.balancer = balancer
+        self.url = backend["url"]
+        self.path = backend["path"]
+        self.key = (self.url, self.path)
+        self.client = None
+        # Admission permit of the request, released together with the lease
+        self.permit = None
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.balancer.release(self.key)
+            if self.permit is not None:
+                self.permit.release()
+
+
+class LoadBalancer:
+    """
+    Distributes requests over the backends (replicas) of a model based on the
+    number of requests this gateway currently has outstanding on each of them.
+
+    Strategies:
+    - least_outstanding: Use the backend with the fewest outstanding requests relative to its weight.
+    - p2c: Sample two backends (by weight) and use the one with fewer outstanding requests.
+    """
+
+    def __init__(self, strategy: str = None):
+        if strategy is None:
+            strategy = os.environ.get("LOAD_BALANCING_STRATEGY", LEAST_OUTSTANDING)
+        if strategy not in (LEAST_OUTSTANDING, POWER_OF_TWO):
+            raise ValueError(f"Unknown load balancing strategy: {strategy}")
+        self.strategy = strategy
+        self.in_flight: dict[tuple, int] = {}
+
+    def load(self, backend: dict) -> float:
+        outstanding = self.in_flight.get((backend["url"], backend["path"]), 0)
+        return (outstanding + 1) / max(backend.get("weight", 1), 1e-6)
+
+    def choose(self, backends: list[dict]) -> dict:
+        """
+        Choose a backend for a request.
+
+        Parameters:
+        - backends (list): The available backends, each with url, path and weight.
+
+        Returns:
+        - dict: The chosen backend.
+        """
+        if len(backends) == 1:
+            return backends[0]
+        if self.strategy == POWER_OF_TWO:
+            weights = [max(backend.get("weight", 1), 0) for backend in backends]
+            first, second = random.choices(range(len(backends)), weights=weights, k=2)
+            if first == second:
+                second = random.choice(
+                    [i for i in range(len(backends)) if not i == first]
+                )
+            return min(backends[first], backends[second], key=self.load)
+        loads = [self.load(backend) for backend in backends]
+        lowest = min(loads)
+        return random.choice(
+            [backend for backend, load in zip(backends, loads) if load == lowest]
+        )
+
+    def acquire(self, backends: list[dict]) -> BackendLease:
+        """
+        Choose a backend and count the request as outstanding on it.
+        """
+        lease = BackendLease(self, self.choose(backends))
+        self.in_flight[lease.key] = self.in_flight.get(lease.key, 0) + 1
+        return lease
+
+    def release(self, key: tuple):
+        remaining = self.in_flight.get(key, 0) - 1
+        if remaining > 0:
+            self.in_flight[key] = remaining
+        else:
+            self.in_flight.pop(key, None)
@@ -1,9 +1,12 @@
-import pymongo
 from datetime import datetime
-import os
-import urllib
+from functools import partial
+import inspect
 import logging
 
+import anyio
+
+from .connections import ConnectionRegistry, MONGO, ASYNC_MONGO
+
 logger = logging.getLogger("app")
 
 
@@ -99,16 +102,12 @@ def obtain_key_usage(
 
 # Needs to be escaped if necessary
 class LoggingHandler:
-    def __init__(self, testing=False):
+    def __init__(self, testing=False, connections: ConnectionRegistry = None):
+        # Called with the arguments of log_usage_for_key after usage was logged
+        self.usage_listeners = []
         if not testing:
-            mongo_user = urllib.parse.quote_plus(os.environ.get("MONGOUSER"))
-            mongo_password = urllib.parse.quote_plus(os.environ.get("MONGOPASSWORD"))
-            mongo_URL = os.environ.get("MONGOHOST")
-            # Set up required endpoints.
-            mongo_client = pymongo.MongoClient(
-                "mongodb://%s:%s@%s/" % (mongo_user, mongo_password, mongo_URL)
-            )
-            self.setup(mongo_client)
+            connections = ConnectionRegistry() if connections is None else connections
+            connections.inject(self.setup, MONGO)
 
     def setup(self, mongo_client):
         self.db = mongo_client["gateway"]
@@ -116,28 +115,40 @@ class LoggingHandler:
         self.key_collection = self.db["apikeys"]
         self.user_collection = self.db["users"]
 
-    def create_log_entry(self, tokencount, model, source, sourcetype="apikey"):
+    def create_log_entry(
+        self,
+        tokencount,
+        model,
+        source,
+        sourcetype="apikey",
+        cachedtokens=0,
+        isprompt=False,
+    ):
         """
         Function to create a log entry.
 
         Parameters:
-        - tokencount (int): The count of tokens.
+        - tokencount (int): The count of tokens computed by the inference server.
         - model (str): The model related to the log entry.
         - source (str): The source that authorized the request that is being logged. This could be a user name or an apikey.
         - sourcetype (str): Specification of what kind of source authorized the request that is being logged (either 'apikey' or 'user').
+        - cachedtokens (int): The count of tokens that were served from a cache instead of being computed.
+        - isprompt (bool): Whether the tokens are prompt tokens (or completion tokens).
 
         Returns:
         - dict: A dictionary representing the log entry with timestamp.
         """
         return {
             "tokencount": tokencount,
+            "cachedtokens": cachedtokens,
+            "isprompt": isprompt,
             "model": model,
             "source": source,
             "sourcetype": sourcetype,
             "timestamp": datetime.now(),  # Current timestamp in UTC
         }
 
-    def log_usage_for_key(self, tokencount, model, key):
+    def log_usage_for_key(self, tokencount, model, key, cachedtokens=0, isprompt=False):
         """
         Function to log usage for a specific key.
 
@@ -145,13 +156,30 @@ class LoggingHandler:
         - tokencount (int): The count of tokens used.
         - model (str): The model associated with the usage.
         - key (str): The key for which the usage is logged.
+        - cachedtokens (int, optional): The count of tokens served from a cache.
+        - isprompt (bool, optional): Whether the tokens are prompt tokens.
         """
         log_entry = self.create_log_entry(
-            tokencount=tokencount, model=model, source=key
+            tokencount=tokencount,
+            model=model,
+            source=key,
+            cachedtokens=cachedtokens,
+            isprompt=isprompt,
         )
         self.log_collection.insert_one(log_entry)
+        for listener in self.usage_listeners:
+            try:
+                listener(tokencount, model, key, cachedtokens, isprompt)
+            except Exception as e:
+                logger.exception(e)
+
+    def add_usage_listener(self, listener):
+        """
+        Add a function to be called whenever usage for a key was logged.
+        """
+        self.usage_listeners.append(listener)
 
-    def log_usage_for_user(self, tokencount, model, user):
+    def log_usage_for_user(self, tokencount, model, user, isprompt=False):
         """
         Function to log usage for a specific user.
 
@@ -159,9 +187,14 @@ class LoggingHandler:
         - tokencount (int): The count of tokens used.
         - model (str): The model associated with the usage.
         - user (str): The user for which the usage is logged.
+        - isprompt (bool, optional): Whether the tokens are prompt tokens.
         """
         log_entry = self.create_log_entry(
-            tokencount=tokencount, model=model, source=user, sourcetype="user"
+            tokencount=tokencount,
+            model=model,
+            source=user,
+            sourcetype="user",
+            isprompt=isprompt,
         )
         self.log_collection.insert_one(log_entry)
 
@@ -290,3 +323,176 @@ class LoggingHandler:
         ]
 
         return self.log_collection.aggregate(pipeline)[0]["tokencount"]
+
+
+class AsyncLoggingHandler:
+    """
+    LoggingHandler with an async mongo client, for use on the event loop.
+    """
+
+    def __init__(self, testing=False, connections: ConnectionRegistry = None):
+        # Called with the arguments of log_usage_for_key after usage was logged,
+        # sync listeners are run in a worker thread.
+        self.usage_listeners = []
+        if not testing:
+            connections = ConnectionRegistry() if connections is None else connections
+            connections.inject(self.setup, ASYNC_MONGO)
+
+    setup = LoggingHandler.setup
+    create_log_entry = LoggingHandler.create_log_entry
+    add_usage_listener = LoggingHandler.add_usage_listener
+
+    async def log_usage_for_key(
+        self, tokencount, model, key, cachedtokens=0, isprompt=False
+    ):
+        """
+        Function to log usage for a specific key.
+
+        Parameters:
+        - tokencount (int): The count of tokens used.
+        - model (str): The model associated with the usage.
+        - key (str): The key for which the usage is logged.
+        - cachedtokens (int, optional): The count of tokens served from a cache.
+        - isprompt (bool, optional): Whether the tokens are prompt tokens.
+        """
+        log_entry = self.create_log_entry(
+            tokencount=tokencount,
+            model=model,
+            source=key,
+            cachedtokens=cachedtokens,
+            isprompt=isprompt,
+        )
+        await self.log_collection.insert_one(log_entry)
+        for listener in self.usage_listeners:
+            try:
+                if inspect.iscoroutinefunction(listener):
+                    await listener(tokencount, model, key, cachedtokens, isprompt)
+                else:
+                    await anyio.to_thread.run_sync(
+                        partial(
+                            listener, tokencount, model, key, cachedtokens, isprompt
+                        )
+                    )
+            except Exception as e:
+                logger.exception(e)
+
+    async def log_usage_for_user(self, tokencount, model, user, isprompt=False):
+        """
+        Function to log usage for a specific user.
+
+        Parameters:
+        - tokencount (int): The count of tokens used.
+        - model (str): The model associated with the usage.
+        - user (str): The user for which the usage is logged.
+        - isprompt (bool, optional): Whether the tokens are prompt tokens.
+        """
+        log_entry = self.create_log_entry(
+            tokencount=tokencount,
+            model=model,
+            source=user,
+            sourcetype="user",
+            isprompt=isprompt,
+        )
+        await self.log_collection.insert_one(log_entry)
+
+    async def get_usage_for_user(
+        self,
+        username: str,
+        from_time: datetime = datetime.fromtimestamp(0),
+        to_time: datetime = None,
+    ):
+        userData = await self.user_collection.find_one({"username": username})
+        if userData == None:
+            # The user has no entry yet.
+            return {"keys": {}, "total_use": 0}
+        data = await self.get_usage_for_keys(userData["keys"])
+        total_use = sum([element["usage"] for element in data])
+        return {"total_use": total_use, "keys": data}
+
+    async def get_usage_for_keys(
+        self,
+        restrict_to_keys,
+        from_time: datetime = datetime.fromtimestamp(0),
+        to_time: datetime = None,
+    ):
+        if to_time == None:
+            to_time = datetime.now()
+        key_data = await self.log_collection.aggregate(
+            obtain_key_usage(restrict_to_keys, from_time=from_time, to_time=to_time)
+        )
+        result = [
+            {
+                "key": entry["key"],
+                "name": entry["key_name"],
+                "usage": entry["tokencount"],
+                "modeldata": entry["models"],
+            }
+            async for entry in key_data
+        ]
+        no_use_keys = set(restrict_to_keys) - set(entry["key"] for entry in result)
+        async for keydata in self.key_collection.find(
+            {"key": {"$in": restrict_to_keys}}
+        ):
+            if keydata["key"] in no_use_keys:
+                result.append(
+                    {
+                        "key": keydata["key"],
+                        "name": keydata["name"],
+                        "usage": 0,
+                        "modeldata": [],
+                    }
+                )
+        return result
+
+    async def get_usage_for_model(
+        self,
+        model: str,
+        from_time: datetime = datetime.fromtimestamp(0),
+        to_time: datetime = None,
+    ):
+        if to_time == None:
+            to_time = datetime.now()
+
+        result = await self.db.users.aggregate(
+            model_usage_pipeline(model, from_time, to_time)
+        )
+        return [
+            {
+                "key": entry["key"],
+                "name": entry["key_name"],
+                "usage": entry["total_tokens"],
+            }
+            async for entry in result
+        ]
+
+    async def get_usage_for_time_range(
+        self,
+        from_time: datetime,
+        to_time: datetime = None,
+        model: str = None,
+        user: str = None,
+    ):
+        base_match = {
+            "timestamp": {"$gte": from_time},
+        }
+        if not model == None:
+            base_match["model"] = model
+        if not to_time == None:
+            base_match["timestamp"] = {"$gte": from_time, "$lte": to_time}
+        if not user == None:
+            keys = [
+                entry["key"]
+                async for entry in self.key_collection.find(
+                    {"user": user}, {"_id": 0, "key": 1}
+                )
+            ]
+            if len(keys) == 0:
+                return {"total_usage": 0, "data": []}
+            else:
+                base_match["source"] = {"$in": keys}
+        pipeline = [
+            {"$match": base_match},
+            {"$group": {"_id": "sum", "tokencount": {"$sum": "$tokencount"}}},
+        ]
+        result = await (await self.log_collection.aggregate(pipeline)).to_list()
+        return result[0]["tokencount"] if len(result) > 0 else 0
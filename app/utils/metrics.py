@@ -0,0 +1,16 @@
+class Metrics:
+    """
+    Simple in-process counters (per worker) for gateway events.
+    """
+
+    def __init__(self):
+        self.counters: dict[str, int] = {}
+
+    def increment(self, name: str, amount: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def get(self, name: str) -> int:
+        return self.counters.get(name, 0)
+
+    def get_counters(self) -> dict[str, int]:
+        return dict(self.counters)
@@ -1,10 +1,14 @@
 import redis
+import redis.asyncio
 import pymongo
+import anyio
+import inspect
 import json
 import os
-import urllib
 import logging
 
+from .connections import ConnectionRegistry, MONGO, ASYNC_MONGO, REDIS, ASYNC_REDIS
+
 
 testing = False
 if "PYTEST_CURRENT_TEST" in os.environ:
@@ -14,8 +18,8 @@ if "PYTEST_CURRENT_TEST" in os.environ:
 modelLogger = logging.getLogger(__name__)
 
 
-def gen_model_object(id, owned_by, path):
-    return {
+def gen_model_object(id, owned_by, path, backends=None, limits=None):
+    model = {
         "data": {
             "id": id,
             "owned_by": owned_by,
@@ -24,50 +28,148 @@ def gen_model_object(id, owned_by, path):
         },
         "path": path,
     }
+    if backends:
+        model["backends"] = backends
+    if limits:
+        model["limits"] = limits
+    return model
+
+
+def gen_backend_object(path, url=None, weight=1):
+    """
+    Function to create a backend (replica) entry of a model.
+
+    Parameters:
+    - path (str): The path of the model on the inference server.
+    - url (str, optional): Base url of the inference server, None for the default server (LLM_BASE_URL).
+    - weight (float, optional): Relative share of requests this replica should get.
+    """
+    return {"url": url, "path": path, "weight": weight}
+
+
+# The fields of the model objects stored in redis
+_model_projection = {"data": 1, "path": 1, "backends": 1, "limits": 1}
+
+
+def project_models(documents) -> dict:
+    """
+    Function to build the models stored in redis from the model documents
+
+    Returns:
+    - dict: The model objects by model id
+    """
+    return {
+        x["data"]["id"]: gen_model_object(
+            x["data"]["id"],
+            x["data"]["owned_by"],
+            x["path"],
+            x.get("backends"),
+            x.get("limits"),
+        )
+        for x in documents
+    }
+
+
+def project_model_ids(documents) -> dict:
+    """
+    Function to map the _id of the model documents to the model ids, deletions
+    in the change stream only have the _id of the document
+
+    Returns:
+    - dict: The model ids by the _id (as string) of their documents
+    """
+    return {str(x["_id"]): x["data"]["id"] for x in documents}
+
+
+def write_models(pipeline, models: dict, ids: dict):
+    """
+    Function to queue writing the models and the ids of their documents to redis
+    """
+    # if there are no models we won't init them.
+    if len(models) > 0:
+        pipeline.set("models", json.dumps(models))
+    else:
+        pipeline.delete("models")
+    pipeline.delete("model_ids")
+    if len(ids) > 0:
+        pipeline.hset("model_ids", mapping=ids)
 
 
 class ModelHandler:
-    def __init__(self):
+    def __init__(self, connections: ConnectionRegistry = None):
+        self.change_listeners = []
         if not testing:
-            # Needs to be escaped if necessary
-            mongo_user = urllib.parse.quote_plus(os.environ.get("MONGOUSER"))
-            mongo_password = urllib.parse.quote_plus(os.environ.get("MONGOPASSWORD"))
-
-            mongo_URL = os.environ.get("MONGOHOST")
-            # Set up required endpoints.
-            mongo_client = pymongo.MongoClient(
-                "mongodb://%s:%s@%s/" % (mongo_user, mongo_password, mongo_URL)
-            )
-            redis_host = os.environ.get("REDISHOST")
-            redis_port = os.environ.get("REDISPORT")
-            redis_client = redis.StrictRedis(
-                host=redis_host, port=int(redis_port), db=0
-            )
-            self.setup(mongo_client, redis_client)
+            connections = ConnectionRegistry() if connections is None else connections
+            connections.inject(self.setup, MONGO, REDIS)
 
     def setup(self, mongo_client: pymongo.MongoClient, redis_client: redis.Redis):
         self.redis_client = redis_client
         self.mongo_client = mongo_client
         self.db = mongo_client["gateway"]
         self.model_collection = self.db["model"]
-        # Make sure, that key is an index (avoids duplicates);
-        self.init_models()
+
+    def add_change_listener(self, listener):
+        """
+        Register a function that is called with the model id whenever a model is added or removed.
+        """
+        self.change_listeners.append(listener)
+
+    def notify_change(self, model: str):
+        for listener in self.change_listeners:
+            try:
+                listener(model)
+            except Exception as e:
+                modelLogger.exception(e)
 
     def init_models(self):
         """
         Initialize models from the database
         """
-        models = {
-            x["data"]["id"]: gen_model_object(
-                x["data"]["id"], x["data"]["owned_by"], x["path"]
-            )
-            for x in self.model_collection.find({}, {"data": 1, "path": 1})
-        }
-        # if there are no models we won't init them.
-        if len(models) > 0:
-            self.redis_client.set("models", json.dumps(models))
-        else:
-            self.redis_client.delete("models")
+        documents = list(self.model_collection.find({}, _model_projection))
+        pipeline = self.redis_client.pipeline(transaction=True)
+        write_models(pipeline, project_models(documents), project_model_ids(documents))
+        pipeline.execute()
+
+    def sync_model(self, document_id, document: dict = None) -> list:
+        """
+        Apply the state of a model document in the database to redis. Only the
+        entry of this model is changed, concurrent writes of the models are retried.
+
+        Parameters:
+        - document_id: The _id of the model document.
+        - document (dict, optional): The model document, None if it was deleted.
+
+        Returns:
+        - list: The ids of the changed models.
+        """
+        document_id = str(document_id)
+
+        def update(pipeline):
+            previous = pipeline.hget("model_ids", document_id)
+            models = pipeline.get("models")
+            models = {} if models is None else json.loads(models)
+            changed = []
+            if previous is not None:
+                # The model id may have changed as well
+                changed.append(previous.decode())
+                models.pop(previous.decode(), None)
+            if document is not None:
+                models.update(project_models([document]))
+                changed.append(document["data"]["id"])
+            pipeline.multi()
+            if len(models) > 0:
+                pipeline.set("models", json.dumps(models))
+            else:
+                pipeline.delete("models")
+            if document is not None:
+                pipeline.hset("model_ids", document_id, document["data"]["id"])
+            else:
+                pipeline.hdel("model_ids", document_id)
+            return list(dict.fromkeys(changed))
+
+        return self.redis_client.transaction(
+            update, "models", "model_ids", value_from_callable=True
+        )
 
     def load_models(self):
         try:
@@ -91,19 +193,86 @@ class ModelHandler:
         else:
             return None
 
-    def add_model(self, model: str, owner: str, path: str):
+    def get_model_backends(self, model_id):
         """
-        Function to add a model to the served models
+        Function to get the backends (replicas) serving a model
+
         Returns:
-        - list: A list of all models available
+        - list: The backend entries of the model, models without explicit backends have
+          a single backend with their path on the default inference server.
+        """
+        requested_model = self.load_models()[model_id]
+        if "backends" in requested_model:
+            return requested_model["backends"]
+        return [gen_backend_object(requested_model["path"])]
+
+    def get_model_limits(self, model_id):
+        """
+        Function to get the limits for the streamed responses of a model
+
+        Returns:
+        - dict: The limits set for the model (stream_idle_timeout, max_output_tokens,
+          max_output_bytes), empty if the model has none or does not exist.
+        """
+        return self.load_models().get(model_id, {}).get("limits", {})
+
+    def get_all_backends(self):
+        """
+        Function to get the backends of all models
+
+        Returns:
+        - list: The backend entries of all models
+        """
+        return [
+            backend
+            for model in self.load_models().values()
+            for backend in model.get("backends", [gen_backend_object(model["path"])])
+        ]
+
+    def get_backend_urls(self):
+        """
+        Function to get all inference server urls used by explicit model backends
+
+        Returns:
+        - list: The distinct base urls
+        """
+        models = self.load_models()
+        return list(
+            {
+                backend["url"]
+                for model in models.values()
+                for backend in model.get("backends", [])
+                if backend["url"] is not None
+            }
+        )
+
+    def add_model(
+        self,
+        model: str,
+        owner: str,
+        path: str,
+        backends: list = None,
+        limits: dict = None,
+    ):
+        """
+        Function to add a model to the served models
+
+        Parameters:
+        - backends (list, optional): Replicas serving the model (see gen_backend_object).
+          If not given, the model is served from path on the default inference server.
+        - limits (dict, optional): Limits for streamed responses of the model
+          (stream_idle_timeout, max_output_tokens, max_output_bytes).
         """
         exists = self.model_collection.find_one({"data.id": model})
         if exists:
             raise KeyError("Model already exists")
         else:
-            self.model_collection.insert_one(gen_model_object(model, owner, path))
+            self.model_collection.insert_one(
+                gen_model_object(model, owner, path, backends, limits)
+            )
             # Update the models, setting them.
             self.init_models()
+            self.notify_change(model)
 
     def remove_model(self, model: str):
         """
@@ -115,9 +284,135 @@ class ModelHandler:
         if exists:
             # update redis
             self.init_models()
+            self.notify_change(model)
         else:
             raise KeyError("Model does not exist")
 
 
-if not testing:
-    model_handler = ModelHandler()
+class AsyncModelHandler:
+    """
+    ModelHandler with async mongo and redis clients, for use on the event loop.
+    """
+
+    def __init__(self, testing: bool = False, connections: ConnectionRegistry = None):
+        self.change_listeners = []
+        if not testing:
+            connections = ConnectionRegistry() if connections is None else connections
+            connections.inject(self.setup, ASYNC_MONGO, ASYNC_REDIS)
+
+    def setup(
+        self, mongo_client: pymongo.AsyncMongoClient, redis_client: redis.asyncio.Redis
+    ):
+        # The models are initialized by the ModelHandler
+        self.redis_client = redis_client
+        self.mongo_client = mongo_client
+        self.db = mongo_client["gateway"]
+        self.model_collection = self.db["model"]
+
+    add_change_listener = ModelHandler.add_change_listener
+
+    async def notify_change(self, model: str):
+        # Sync listeners are run in a worker thread
+        for listener in self.change_listeners:
+            try:
+                if inspect.iscoroutinefunction(listener):
+                    await listener(model)
+                else:
+                    await anyio.to_thread.run_sync(listener, model)
+            except Exception as e:
+                modelLogger.exception(e)
+
+    async def init_models(self):
+        """
+        Initialize models from the database
+        """
+        documents = await self.model_collection.find({}, _model_projection).to_list()
+        pipeline = self.redis_client.pipeline(transaction=True)
+        write_models(pipeline, project_models(documents), project_model_ids(documents))
+        await pipeline.execute()
+
+    async def load_models(self):
+        try:
+            return json.loads(await self.redis_client.get("models"))
+        except:
+            return {}
+
+    async def get_models(self):
+        models = await self.load_models()
+        return [models[x]["data"] for x in models]
+
+    async def get_model_path(self, model_id):
+        requested_model = (await self.load_models())[model_id]
+        if requested_model:
+            return requested_model["path"]
+        else:
+            return None
+
+    async def get_model_backends(self, model_id):
+        """
+        Function to get the backends (replicas) serving a model, see ModelHandler.get_model_backends
+
+        Raises:
+        - KeyError: If the model does not exist.
+        """
+        requested_model = (await self.load_models())[model_id]
+        if "backends" in requested_model:
+            return requested_model["backends"]
+        return [gen_backend_object(requested_model["path"])]
+
+    async def get_model_limits(self, model_id):
+        return (await self.load_models()).get(model_id, {}).get("limits", {})
+
+    async def get_all_backends(self):
+        return [
+            backend
+            for model in (await self.load_models()).values()
+            for backend in model.get("backends", [gen_backend_object(model["path"])])
+        ]
+
+    async def get_backend_urls(self):
+        models = await self.load_models()
+        return list(
+            {
+                backend["url"]
+                for model in models.values()
+                for backend in model.get("backends", [])
+                if backend["url"] is not None
+            }
+        )
+
+    async def add_model(
+        self,
+        model: str,
+        owner: str,
+        path: str,
+        backends: list = None,
+        limits: dict = None,
+    ):
+        """
+        Function to add a model to the served models, see ModelHandler.add_model
+
+        Raises:
+        - KeyError: If the model already exists.
+        """
+        exists = await self.model_collection.find_one({"data.id": model})
+        if exists:
+            raise KeyError("Model already exists")
+        await self.model_collection.insert_one(
+            gen_model_object(model, owner, path, backends, limits)
+        )
+        await self.init_models()
+        await self.notify_change(model)
+
+    async def remove_model(self, model: str):
+        """
+        Function to remove a model from the served models
+
+        Raises:
+        - KeyError: If the model does not exist.
+        """
+        exists = await self.model_collection.find_one_and_delete({"data.id": model})
+        if not exists:
+            raise KeyError("Model does not exist")
+        await self.init_models()
+        await self.notify_change(model)
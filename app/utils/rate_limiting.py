@@ -0,0 +1,187 @@
+import logging
+import math
+import os
+
+import redis.asyncio
+
+logger = logging.getLogger("app")
+
+# Token buckets for requests and tokens of a key, refilled continuously at the
+# per minute rate. Both buckets are checked and updated in one atomic call, so
+# the limits hold across all workers using the same redis. Tokens are only known
+# once a response is done, so they are taken afterwards (with no request cost)
+# and a bucket can go negative. Requests are rejected while it is not positive.
+#
+# KEYS[1]: request bucket, KEYS[2]: token bucket
+# ARGV[1]: requests per minute, ARGV[2]: tokens per minute (0 = unlimited)
+# ARGV[3]: requests to take, ARGV[4]: tokens to take
+_bucket_script = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local rpm = tonumber(ARGV[1])
+local tpm = tonumber(ARGV[2])
+local request_cost = tonumber(ARGV[3])
+local token_cost = tonumber(ARGV[4])
+
+local function refill(key, limit)
+    if limit <= 0 then
+        return nil
+    end
+    local state = redis.call('HMGET', key, 'level', 'updated')
+    local level = tonumber(state[1]) or limit
+    local updated = tonumber(state[2]) or now
+    return math.min(limit, level + (now - updated) * limit / 60)
+end
+
+local function store(key, level, limit)
+    if level == nil then
+        return
+    end
+    redis.call('HSET', key, 'level', level, 'updated', now)
+    -- A full bucket needs no state
+    redis.call('EXPIRE', key, math.ceil((limit - level) * 60 / limit) + 1)
+end
+
+local requests = refill(KEYS[1], rpm)
+local tokens = refill(KEYS[2], tpm)
+local allowed = 1
+local retry_after = 0
+if requests ~= nil and requests < request_cost then
+    allowed = 0
+    retry_after = (request_cost - requests) * 60 / rpm
+end
+if tokens ~= nil and request_cost > 0 and tokens <= 0 then
+    allowed = 0
+    retry_after = math.max(retry_after, (1 - tokens) * 60 / tpm)
+end
+if allowed == 1 then
+    if requests ~= nil then
+        requests = requests - request_cost
+    end
+    if tokens ~= nil then
+        tokens = tokens - token_cost
+    end
+end
+store(KEYS[1], requests, rpm)
+store(KEYS[2], tokens, tpm)
+return {allowed, tostring(requests or -1), tostring(tokens or -1), tostring(retry_after)}
+"""
+
+
+class RateLimitResult:
+    """
+    The state of the rate limits of a key after a request.
+    """
+
+    def __init__(
+        self,
+        allowed: bool,
+        requests_per_minute: int,
+        tokens_per_minute: int,
+        requests: float,
+        tokens: float,
+        retry_after: float,
+    ):
+        self.allowed = allowed
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.requests = requests
+        self.tokens = tokens
+        self.retry_after = retry_after
+
+    def headers(self) -> dict[str, str]:
+        """
+        The x-ratelimit-* headers (as used by OpenAI) describing the limits.
+        """
+        headers = {}
+        for name, limit, level in (
+            ("requests", self.requests_per_minute, self.requests),
+            ("tokens", self.tokens_per_minute, self.tokens),
+        ):
+            if limit > 0:
+                reset = (limit - level) * 60 / limit
+                headers[f"x-ratelimit-limit-{name}"] = str(limit)
+                headers[f"x-ratelimit-remaining-{name}"] = str(
+                    max(math.floor(level), 0)
+                )
+                headers[f"x-ratelimit-reset-{name}"] = f"{math.ceil(reset)}s"
+        if not self.allowed:
+            headers["Retry-After"] = str(max(math.ceil(self.retry_after), 1))
+        return headers
+
+
+class RateLimiter:
+    """
+    Per key rate limits for requests and tokens per minute, stored in redis.
+    The script is awaited on the event loop with the async redis client.
+    """
+
+    def __init__(self, redis_client: redis.asyncio.Redis):
+        self.redis_client = redis_client
+        self.requests_per_minute = int(
+            os.environ.get("RATE_LIMIT_REQUESTS_PER_MINUTE", 0)
+        )
+        self.tokens_per_minute = int(os.environ.get("RATE_LIMIT_TOKENS_PER_MINUTE", 0))
+        self.enabled = self.requests_per_minute > 0 or self.tokens_per_minute > 0
+        self.script = redis_client.register_script(_bucket_script)
+
+    async def take(self, key: str, requests: int, tokens: int) -> RateLimitResult:
+        allowed, request_level, token_level, retry_after = await self.script(
+            keys=[f"ratelimit:{key}:requests", f"ratelimit:{key}:tokens"],
+            args=[self.requests_per_minute, self.tokens_per_minute, requests, tokens],
+        )
+        return RateLimitResult(
+            allowed == 1,
+            self.requests_per_minute,
+            self.tokens_per_minute,
+            float(request_level),
+            float(token_level),
+            float(retry_after),
+        )
+
+    async def check_request(self, key: str) -> RateLimitResult | None:
+        """
+        Take a request from the limits of a key.
+
+        Returns:
+        - RateLimitResult: Whether the request is allowed and the state of the limits, None if rate limiting is disabled.
+        """
+        if not self.enabled:
+            return None
+        return await self.take(key, 1, 0)
+
+    async def record_tokens(
+        self, tokencount, model, key, cachedtokens=0, isprompt=False
+    ):
+        """
+        Take the tokens of a finished request from the limits of its key.
+        Has the signature of AsyncLoggingHandler.log_usage_for_key, to be used as usage listener.
+        """
+        if self.tokens_per_minute > 0 and tokencount > 0:
+            await self.take(key, 0, tokencount)
+
+
+class RateLimitHeaders:
+    """
+    ASGI middleware adding the rate limit headers stored in request.state.ratelimit_headers to the response.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not scope["type"] == "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                headers = scope.get("state", {}).get("ratelimit_headers")
+                if headers:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (name.encode(), value.encode())
+                        for name, value in headers.items()
+                    ]
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
@@ -0,0 +1,261 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+import redis
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger("app")
+
+LEADER_KEY = "sync:leader"
+RESUME_TOKEN_KEY = "sync:resume_token"
+STATUS_KEY = "sync:status"
+
+# Change streams are only available on replica sets (and sharded clusters)
+_NO_CHANGE_STREAMS = 40573
+
+_watched_collections = ["apikeys", "model"]
+# The keys and models in redis (and the ids of their documents), written by a full sync
+_synced_keys = ("keys", "key_ids", "models", "model_ids")
+
+# Extends the lock if it is still held by this instance, releases it if the ttl is 0
+_lock_script = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if tonumber(ARGV[2]) == 0 then
+    redis.call('del', KEYS[1])
+else
+    redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+
+class RedisSync:
+    """
+    Keeps the keys and models in redis in sync with the database.
+
+    One instance over all workers and pods holds the leader lock. It follows a
+    change stream of the gateway database and applies each change of a key or
+    model to redis, resuming after the last applied change when it is
+    restarted. If the database does not support change streams, everything is
+    resynced every REDIS_SYNC_INTERVAL seconds instead. The state of the sync
+    (including the lag of the last change) is kept in redis.
+    """
+
+    def __init__(self, key_handler, model_handler):
+        self.key_handler = key_handler
+        self.model_handler = model_handler
+        self.enabled = int(os.environ.get("REDIS_SYNC", 1)) == 1
+        self.interval = float(os.environ.get("REDIS_SYNC_INTERVAL", 60))
+        self.lock_ttl = float(os.environ.get("REDIS_SYNC_LOCK_TTL", 15))
+        self.id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lock_renewed = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+        self.lock_script = self.redis_client.register_script(_lock_script)
+
+    @property
+    def redis_client(self) -> redis.Redis:
+        return self.key_handler.redis_client
+
+    def acquire_lock(self) -> bool:
+        # Still held if the previous sync ended (e.g. after an error)
+        held = self._update_lock(self.lock_ttl)
+        if not held and self.redis_client.set(
+            LEADER_KEY, self.id, nx=True, px=int(self.lock_ttl * 1000)
+        ):
+            logger.info(f"Redis sync started by {self.id}")
+            held = True
+        if held:
+            self.lock_renewed = time.monotonic()
+        return held
+
+    def _update_lock(self, ttl: float) -> bool:
+        return self.lock_script(keys=[LEADER_KEY], args=[self.id, int(ttl * 1000)]) == 1
+
+    def keep_leading(self) -> bool:
+        """
+        Check whether to continue syncing, renews the lock when a third of its
+        ttl has passed.
+        """
+        if self.stopped.is_set():
+            return False
+        if time.monotonic() - self.lock_renewed < self.lock_ttl / 3:
+            return True
+        if not self._update_lock(self.lock_ttl):
+            logger.warning(f"Redis sync lock lost by {self.id}")
+            return False
+        self.lock_renewed = time.monotonic()
+        return True
+
+    def set_status(self, **status):
+        status["leader"] = self.id
+        status["updated"] = time.time()
+        self.redis_client.hset(STATUS_KEY, mapping=status)
+
+    def get_status(self) -> dict:
+        """
+        Get the state of the sync.
+
+        Returns:
+        - dict: The leader, the mode (change_stream or polling), the lag of the
+          last applied change in seconds and the times of the last change, full
+          sync and status update.
+        """
+        status = {
+            name.decode(): value.decode()
+            for name, value in self.redis_client.hgetall(STATUS_KEY).items()
+        }
+        for name in ("lag", "last_change", "last_full_sync", "updated"):
+            if name in status:
+                status[name] = float(status[name])
+        return status
+
+    def full_sync(self):
+        """
+        Rebuild the keys and models in redis from the database.
+        """
+        self.key_handler.init_keys()
+        self.model_handler.init_models()
+        self.set_status(last_full_sync=time.time())
+
+    def apply_change(self, change: dict) -> float:
+        """
+        Apply a change event of the change stream to redis.
+
+        Returns:
+        - float: The lag of the change in seconds.
+        """
+        collection = change.get("ns", {}).get("coll")
+        operation = change.get("operationType")
+        document = change.get("fullDocument")
+        if operation in ("insert", "update", "replace") and document is None:
+            # Deleted before the document was looked up, the deletion follows
+            pass
+        elif collection == "apikeys" and document is not None:
+            self.key_handler.sync_key(document)
+        elif collection == "apikeys" and operation == "delete":
+            self.key_handler.sync_deleted_key(change["documentKey"]["_id"])
+        elif collection == "apikeys":
+            # Dropped or renamed
+            self.key_handler.init_keys()
+        elif collection == "model" and (document is not None or operation == "delete"):
+            changed = self.model_handler.sync_model(
+                change["documentKey"]["_id"], document
+            )
+            if len(changed) == 0:
+                # The model of a deleted document is not known
+                self.model_handler.init_models()
+            for model in changed:
+                # E.g. invalidates the cached responses of the model
+                self.model_handler.notify_change(model)
+        elif collection == "model":
+            self.model_handler.init_models()
+        if "clusterTime" not in change:
+            return 0.0
+        return max(0.0, time.time() - change["clusterTime"].time)
+
+    def checkpoint(self, token: dict | None, **status):
+        """
+        Save the resume token of the last applied change (or of the stream, if
+        there were no changes) together with the status.
+        """
+        status["leader"] = self.id
+        status["updated"] = time.time()
+        pipeline = self.redis_client.pipeline()
+        if token is not None:
+            pipeline.set(RESUME_TOKEN_KEY, token["_data"])
+        pipeline.hset(STATUS_KEY, mapping=status)
+        pipeline.execute()
+
+    def watch(self):
+        """
+        Apply the changes of the change stream until the lock is lost or the sync stopped.
+        """
+        token = self.redis_client.get(RESUME_TOKEN_KEY)
+        resume_after = None if token is None else {"_data": token.decode()}
+        if resume_after is not None and self.redis_client.exists(*_synced_keys) < len(
+            _synced_keys
+        ):
+            # Redis was flushed (or lost the keys) since the last applied change
+            logger.info("Keys or models missing in redis, resyncing")
+            resume_after = None
+        with self.key_handler.db.watch(
+            [{"$match": {"ns.coll": {"$in": _watched_collections}}}],
+            full_document="updateLookup",
+            resume_after=resume_after,
+            max_await_time_ms=1000,
+        ) as stream:
+            self.set_status(mode="change_stream")
+            if resume_after is None:
+                # Changes during the full sync are applied (again) afterwards
+                self.full_sync()
+                resume_after = stream.resume_token
+                self.checkpoint(resume_after, lag=0.0)
+            while stream.alive and self.keep_leading():
+                change = stream.try_next()
+                if change is not None:
+                    lag = self.apply_change(change)
+                    resume_after = stream.resume_token
+                    self.checkpoint(resume_after, lag=lag, last_change=time.time())
+                elif stream.resume_token != resume_after:
+                    # Caught up, the token advances without changes as well
+                    resume_after = stream.resume_token
+                    self.checkpoint(resume_after, lag=0.0)
+
+    def poll(self):
+        self.set_status(mode="polling")
+        while self.keep_leading():
+            self.full_sync()
+            deadline = time.monotonic() + self.interval
+            while time.monotonic() < deadline and self.keep_leading():
+                self.stopped.wait(min(1.0, self.lock_ttl / 3))
+
+    def sync(self):
+        try:
+            self.watch()
+        except OperationFailure as e:
+            if e.code == _NO_CHANGE_STREAMS:
+                logger.info("Change streams are not available, polling the database")
+                self.poll()
+            else:
+                # E.g. the resume token is no longer in the oplog, start over
+                logger.warning(f"Change stream failed, resyncing: {e}")
+                self.redis_client.delete(RESUME_TOKEN_KEY)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                if self.acquire_lock():
+                    self.sync()
+            except (PyMongoError, redis.RedisError) as e:
+                logger.warning(f"Redis sync failed: {e}")
+            self.stopped.wait(self.lock_ttl / 3)
+
+    def start(self):
+        """
+        Start the sync in a background thread, it waits for the lock if another
+        instance holds it.
+        """
+        if not self.enabled or self.thread is not None:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="redis-sync", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        try:
+            # Let another instance take over right away
+            self._update_lock(0)
+        except redis.RedisError:
+            pass
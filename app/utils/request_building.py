@@ -1,67 +1,233 @@
-from starlette.datastructures import MutableHeaders
+from starlette.datastructures import Headers
 from fastapi import HTTPException
 from fastapi import status
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
 import httpx
 
-from llmapi.llama_requests import (
-    CompletionRequest,
-    ChatCompletionRequest,
-    EmbeddingRequest,
-)
-from .model_handler import ModelHandler
+from .model_handler import AsyncModelHandler
+from .upstream_clients import UpstreamClientManager
+from .load_balancing import LoadBalancer
+from .upstream_health import UpstreamHealth
+from .admission import DEFAULT_PRIORITY
 from logging import Logger
+import hashlib
+import json
+import math
 import os
 
-llm_url = "http://llm.k8s-test.cs.aalto.fi"
-if "LLM_DEFAULT_URL" in os.environ:
-    llm_url = os.environ.get("LLM_DEFAULT_URL")
+# Headers of the incoming request that are forwarded to the inference server.
+# Everything else (cookies, the users authorization etc) stays at the gateway.
+FORWARDED_HEADERS = ("accept", "content-type", "user-agent", "x-request-id")
+
+
+class InferenceRequest:
+    """
+    An inference request as it is forwarded by the gateway.
+    The body is only parsed once, and the original bytes are kept for forwarding.
+    """
+
+    def __init__(self, body: bytes, data: dict):
+        self.body = body
+        self.data = data
+        self.model = data.get("model")
+        self.stream = data.get("stream", False) == True
+        self.max_tokens = data.get("max_tokens")
+        # Scheduling of the request in the admission queues
+        self.priority = DEFAULT_PRIORITY
+        self.tenant = ""
+        self.weight = 1.0
+        # Whether the usage event of a stream was requested by the gateway, not the client
+        self.strip_usage = False
+        # Events of a stream arriving within this window (in seconds) are sent together
+        self.coalesce_window = 0.0
+
+    def is_deterministic(self) -> bool:
+        """
+        Whether identical requests give identical results, i.e. greedy
+        sampling (temperature 0) or a fixed seed.
+        """
+        seed = self.data.get("seed")
+        return self.data.get("temperature") == 0 or (
+            isinstance(seed, int) and not seed == -1
+        )
+
+    def request_stream_usage(self):
+        """
+        Ask the inference server to report the usage at the end of the stream.
+        The option is added to the raw body, the body is only serialized again
+        if the client sent stream_options without include_usage.
+        """
+        options = self.data.get("stream_options")
+        if isinstance(options, dict) and options.get("include_usage") == True:
+            return
+        self.strip_usage = True
+        if "stream_options" not in self.data:
+            start = self.body.index(b"{") + 1
+            separator = b"" if self.body[start:].lstrip().startswith(b"}") else b","
+            self.body = (
+                self.body[:start]
+                + b'"stream_options":{"include_usage":true}'
+                + separator
+                + self.body[start:]
+            )
+        else:
+            if not isinstance(options, dict):
+                options = {}
+            data = {**self.data, "stream_options": {**options, "include_usage": True}}
+            self.body = json.dumps(data).encode()
+
+    def as_stream(self) -> "InferenceRequest":
+        """
+        A streaming copy of a non streaming request that reports the usage,
+        so that the response can be aggregated by the gateway.
+        """
+        data = {**self.data, "stream": True, "stream_options": {"include_usage": True}}
+        request = InferenceRequest(json.dumps(data).encode(), data)
+        request.priority = self.priority
+        request.tenant = self.tenant
+        request.weight = self.weight
+        return request
+
+    def get_key(self, path: str) -> str:
+        """
+        A hash identifying identical requests (same endpoint, model and normalized body).
+        """
+        normalized = json.dumps(self.data, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(f"{path}\n{normalized}".encode()).hexdigest()
 
 
 class BodyHandler:
-    def __init__(self, logger: Logger, model_handler: ModelHandler):
+    def __init__(
+        self,
+        logger: Logger,
+        model_handler: AsyncModelHandler,
+        upstream_clients: UpstreamClientManager,
+        load_balancer: LoadBalancer,
+        upstream_health: UpstreamHealth,
+    ):
         self.model_handler = model_handler
+        self.upstream_clients = upstream_clients
+        self.load_balancer = load_balancer
+        self.upstream_health = upstream_health
         self.logger = logger
         self.inference_apikey = "Bearer " + os.environ.get("INFERENCE_KEY")
+        # Full validation against the llama_cpp request models is optional.
+        self.strict = int(os.environ.get("STRICT_REQUEST_VALIDATION", 0)) == 1
+        self.url_cache: dict[tuple[str, str], httpx.URL] = {}
 
-    def parse_body(
-        self,
-        data: CompletionRequest | ChatCompletionRequest | EmbeddingRequest,
-    ):
-        # Extract data from request body
-        # Replace this with your logic to extract data from the request body
+    def parse_request(self, body: bytes, request_type: type[BaseModel] = None):
+        """
+        Parse the body of an inference request.
+
+        Parameters:
+        - body (bytes): The raw request body.
+        - request_type (BaseModel, optional): The model to validate the request against in strict mode.
+
+        Returns:
+        - InferenceRequest: The parsed request.
+
+        Raises:
+        - HTTPException: If the body is not a JSON object or has an invalid model/stream field (422).
+        - RequestValidationError: In strict mode, if the body does not match the request model.
+        """
         try:
-            model = self.model_handler.get_model_path(data.model)
+            data = json.loads(body)
+        except ValueError:
+            raise HTTPException(
+                status.HTTP_422_UNPROCESSABLE_ENTITY, "Request body is not valid JSON"
+            )
+        if not isinstance(data, dict):
+            raise HTTPException(
+                status.HTTP_422_UNPROCESSABLE_ENTITY, "Request body must be an object"
+            )
+        if self.strict and request_type is not None:
+            try:
+                request_type.model_validate(data)
+            except ValidationError as e:
+                raise RequestValidationError(e.errors())
+        request = InferenceRequest(body, data)
+        if not isinstance(request.model, (str, type(None))) or not isinstance(
+            data.get("stream", False), bool
+        ):
+            raise HTTPException(
+                status.HTTP_422_UNPROCESSABLE_ENTITY, "Invalid model or stream field"
+            )
+        return request
+
+    async def get_backends(self, data: InferenceRequest):
+        try:
+            return await self.model_handler.get_model_backends(data.model)
         except KeyError as e:
             raise HTTPException(
                 status.HTTP_400_BAD_REQUEST, "Requested Model not available"
             )
 
-        return model
+    def get_url(self, model_path: str, path: str) -> httpx.URL:
+        """
+        Get the (cached) upstream url for a model path and endpoint.
+        """
+        url = self.url_cache.get((model_path, path))
+        if url is None:
+            url = httpx.URL(path=model_path + path)
+            self.url_cache[(model_path, path)] = url
+        return url
+
+    def build_headers(self, headers: Headers) -> dict:
+        """
+        Build the headers for the upstream request from the allowed incoming headers.
+        """
+        forwarded = {
+            name: headers[name] for name in FORWARDED_HEADERS if name in headers
+        }
+        forwarded.setdefault("content-type", "application/json")
+        # We forward raw stream bytes, so the upstream must not compress them.
+        forwarded["accept-encoding"] = "identity"
+        # Add the API Key for the inference server
+        forwarded["authorization"] = self.inference_apikey
+        return forwarded
 
     async def build_request(
         self,
-        requestData: ChatCompletionRequest | CompletionRequest | EmbeddingRequest,
-        headers: MutableHeaders,
+        requestData: InferenceRequest,
+        headers: Headers,
         path: str,
         method: str,
-        body: str,
-        stream_client: httpx.AsyncClient,
+        exclude: list = (),
     ):
-        model = self.parse_body(requestData)
+        """
+        Build the upstream request for an inference request.
+        One of the model's available backends (i.e. without an open circuit breaker
+        and not in exclude) is chosen by the load balancer and the request counts
+        as outstanding on it until the returned lease is released.
+
+        Returns:
+        - httpx.Request: The request to send.
+        - str: The requested model.
+        - BackendLease: The chosen backend, its client is available as lease.client.
+
+        Raises:
+        - HTTPException: 503 if none of the model's backends is available.
+        """
+        backends = await self.get_backends(requestData)
         self.logger.info("Got Request")
-        # Update the request path
-        # TODO: Need to handle model not found error!
-        url = httpx.URL(path=model + path)
-        # Add the API Key for the inference server
-        headers["Authorization"] = self.inference_apikey
-        headers["host"] = llm_url
-        # extract the body for forwarding.
-        req = stream_client.build_request(
+        available = self.upstream_health.filter_backends(backends, exclude)
+        if len(available) == 0:
+            retry_after = max(math.ceil(self.upstream_health.retry_after(backends)), 1)
+            raise HTTPException(
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+                "No healthy backend available for the requested model",
+                headers={"Retry-After": str(retry_after)},
+            )
+        backend = self.load_balancer.acquire(available)
+        self.upstream_health.on_request(backend.key)
+        backend.client = self.upstream_clients.get_client(backend.url)
+        # Update the request path and forward the original body.
+        req = backend.client.build_request(
             method,
-            url,
-            headers=headers,
-            content=body,
-            timeout=300.0,
+            self.get_url(backend.path, path),
+            headers=self.build_headers(headers),
+            content=requestData.body,
         )
 
-        return req, model
+        return req, requestData.model, backend
@@ -0,0 +1,201 @@
+from collections import OrderedDict
+import logging
+import os
+import re
+import time
+
+import redis
+import redis.asyncio
+
+from .metrics import Metrics
+
+logger = logging.getLogger("app")
+
+# An event of an event stream ends with an empty line.
+_event_expr = re.compile(rb".*?(?:\r\n\r\n|\n\n|\r\r)", re.S)
+
+
+class LRUCache:
+    """
+    Bounded in-process LRU cache for bytes values.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict[str, bytes] = OrderedDict()
+
+    def get(self, key: str) -> bytes | None:
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        self.delete(key)
+        self.entries[key] = value
+        self.size += len(value)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def delete(self, key: str):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.size -= len(value)
+
+    def delete_prefix(self, prefix: str):
+        for key in [key for key in self.entries if key.startswith(prefix)]:
+            self.delete(key)
+
+
+class TieredCache:
+    """
+    Two tier cache with a bounded in-process LRU in front of a shared redis tier.
+    The redis tier uses the async client, the cache is used on the event loop.
+
+    Entries belong to a model. Each model has a generation counter in redis which
+    is part of the entry keys, so all entries of a model (in all workers) are
+    invalidated by incrementing it. Workers keep the generations they read for
+    generation_ttl seconds, a change in another worker is seen after at most
+    that long.
+    """
+
+    def __init__(
+        self,
+        redis_client: redis.asyncio.Redis,
+        prefix: str,
+        ttl: int,
+        max_entries: int,
+        max_bytes: int,
+        metrics: Metrics,
+        generation_ttl: float = 5,
+    ):
+        self.redis_client = redis_client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.local = LRUCache(max_entries, max_bytes)
+        self.metrics = metrics
+        self.generation_ttl = generation_ttl
+        # model -> (generation, time it was read from redis)
+        self.generations: dict[str, tuple[int, float]] = {}
+
+    def _generation_key(self, model: str) -> str:
+        return f"{self.prefix}:generation:{model}"
+
+    async def _model_prefix(self, model: str) -> str:
+        cached = self.generations.get(model)
+        if cached is not None and time.monotonic() - cached[1] < self.generation_ttl:
+            generation = cached[0]
+        else:
+            generation = await self.redis_client.get(self._generation_key(model))
+            generation = 0 if generation is None else int(generation)
+            self.generations[model] = (generation, time.monotonic())
+        return f"{self.prefix}:{model}:{generation}:"
+
+    async def get(self, model: str, key: str) -> bytes | None:
+        """
+        Get an entry, first from the local tier, then from redis.
+        """
+        return (await self.get_many(model, [key]))[0]
+
+    async def get_many(self, model: str, keys: list[str]) -> list[bytes | None]:
+        """
+        Get several entries of a model, entries missing locally are fetched with a single redis call.
+        """
+        prefix = await self._model_prefix(model)
+        values = [self.local.get(prefix + key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if len(missing) > 0:
+            fetched = await self.redis_client.mget([prefix + keys[i] for i in missing])
+            for i, value in zip(missing, fetched):
+                if value is not None:
+                    values[i] = value
+                    self.local.set(prefix + keys[i], value)
+        hits = sum(1 for value in values if value is not None)
+        self.metrics.increment(f"{self.prefix}_hits", hits)
+        self.metrics.increment(f"{self.prefix}_misses", len(values) - hits)
+        return values
+
+    async def set(self, model: str, key: str, value: bytes):
+        await self.set_many(model, {key: value})
+
+    async def set_many(self, model: str, entries: dict[str, bytes]):
+        prefix = await self._model_prefix(model)
+        pipeline = self.redis_client.pipeline()
+        for key, value in entries.items():
+            pipeline.set(prefix + key, value, ex=self.ttl)
+            self.local.set(prefix + key, value)
+        await pipeline.execute()
+
+    async def invalidate_model(self, model: str):
+        """
+        Invalidate all entries of a model.
+        """
+        self.local.delete_prefix(f"{self.prefix}:{model}:")
+        generation = await self.redis_client.incr(self._generation_key(model))
+        self.generations[model] = (generation, time.monotonic())
+        self.metrics.increment(f"{self.prefix}_invalidations")
+
+    def invalidate_model_sync(self, redis_client: redis.Redis, model: str):
+        """
+        Invalidate all entries of a model from a thread (the threadpool, the
+        redis sync or a script), with a sync redis client.
+        The generation is read again on the next lookup of this worker, the
+        local entries of the old generation are evicted over time.
+        """
+        redis_client.incr(self._generation_key(model))
+        self.generations.pop(model, None)
+        self.metrics.increment(f"{self.prefix}_invalidations")
+
+
+class ResponseCache(TieredCache):
+    """
+    Cache for the responses to deterministic completion requests.
+    Non streaming responses are stored as the response body, streamed
+    responses as the events that were sent.
+    """
+
+    def __init__(self, redis_client: redis.asyncio.Redis, metrics: Metrics):
+        super().__init__(
+            redis_client,
+            prefix="response_cache",
+            ttl=int(os.environ.get("RESPONSE_CACHE_TTL", 3600)),
+            max_entries=int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 1024)),
+            max_bytes=int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+            metrics=metrics,
+            generation_ttl=float(os.environ.get("RESPONSE_CACHE_GENERATION_TTL", 5)),
+        )
+        self.enabled = int(os.environ.get("RESPONSE_CACHE", 0)) == 1
+        # Larger responses are not cached
+        self.max_entry_bytes = int(
+            os.environ.get("RESPONSE_CACHE_MAX_ENTRY_BYTES", 1024 * 1024)
+        )
+
+    async def record_stream(self, iterator, model: str, key: str):
+        """
+        Pass through a response stream and cache it once it has completed.
+        """
+        chunks = []
+        size = 0
+        async for chunk in iterator:
+            if chunks is not None:
+                size += len(chunk)
+                if size > self.max_entry_bytes:
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            await self.set(model, key, b"".join(chunks))
+
+
+async def replay_events(data: bytes):
+    """
+    Replay a cached event stream event by event.
+    """
+    for event in _event_expr.finditer(data):
+        yield event.group(0)
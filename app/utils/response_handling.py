@@ -30,10 +30,14 @@
 
 # TODO: Need to see if this can be achieved more simply by allowing a logger in here...
 
+import asyncio
 import io
+import json
 import logging
+import math
+import os
 import re
-from datetime import datetime
+import time
 from functools import partial
 from typing import (
     Any,
@@ -54,6 +58,8 @@ from starlette.concurrency import iterate_in_threadpool
 from starlette.responses import Response
 from starlette.types import Receive, Scope, Send
 from utils.stream_logger import StreamLogger
+from utils.sse_parsing import last_event_end
+from utils.metrics import Metrics
 
 _log = logging.getLogger(__name__)
 
@@ -68,9 +74,28 @@ class AppStatus:
 
     should_exit = False
     should_exit_event: Union[anyio.Event, None] = None
+    # Drain mode: On the first exit signal the gateway stops accepting inference
+    # requests and reports not ready. The exit is only passed on to uvicorn once
+    # all requests and streams are done or the grace period has elapsed.
+    draining = False
+    drain_timeout = float(os.environ.get("DRAIN_TIMEOUT", 30))
+    DRAIN_POLL_INTERVAL = 0.1
+    # Inference requests that are being handled (streams are tracked by the heartbeat)
+    in_flight = 0
+    _drain_task = None
 
     @staticmethod
     def handle_exit(*args, **kwargs):
+        if not AppStatus.draining and AppStatus.drain_timeout > 0:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                loop = None
+            if loop is not None:
+                AppStatus.draining = True
+                loop.call_soon_threadsafe(AppStatus.start_drain, args, kwargs)
+                return
+        # A second signal (or the end of the drain) exits right away.
         # set bool flag before checking the event to avoid race condition
         AppStatus.should_exit = True
         # Check if event has been initialized, if so notify listeners
@@ -78,6 +103,28 @@ class AppStatus:
             AppStatus.should_exit_event.set()
         original_handler(*args, **kwargs)
 
+    @staticmethod
+    def start_drain(args: tuple, kwargs: dict):
+        _log.info(
+            "Draining: %d requests and %d streams in flight",
+            AppStatus.in_flight,
+            len(heartbeat_scheduler.streams),
+        )
+        AppStatus._drain_task = asyncio.ensure_future(AppStatus.drain(args, kwargs))
+
+    @staticmethod
+    async def drain(args: tuple, kwargs: dict):
+        deadline = time.monotonic() + AppStatus.drain_timeout
+        while (
+            AppStatus.in_flight > 0 or len(heartbeat_scheduler.streams) > 0
+        ) and time.monotonic() < deadline:
+            await asyncio.sleep(AppStatus.DRAIN_POLL_INTERVAL)
+        _log.info(
+            "Drained, exiting with %d streams left", len(heartbeat_scheduler.streams)
+        )
+        if not AppStatus.should_exit:
+            AppStatus.handle_exit(*args, **kwargs)
+
 
 try:
     from uvicorn.main import Server
@@ -96,6 +143,9 @@ except ModuleNotFoundError:
 
 
 class ServerSentEvent:
+    DEFAULT_SEPARATOR = "\r\n"
+    LINE_SEP_EXPR = re.compile(r"\r\n|\r|\n")
+
     def __init__(
         self,
         data: Optional[Any] = None,
@@ -131,8 +181,6 @@ class ServerSentEvent:
         self.id = id
         self.retry = retry
         self.comment = comment
-        self.DEFAULT_SEPARATOR = "\r\n"
-        self.LINE_SEP_EXPR = re.compile(r"\r\n|\r|\n")
         self._sep = sep if sep is not None else self.DEFAULT_SEPARATOR
 
     def encode(self) -> bytes:
@@ -188,6 +236,69 @@ async def event_generator(iterator: AsyncIterator[bytes]) -> ContentStream:
         yield chunk
 
 
+class HeartbeatScheduler:
+    """
+    Process wide heartbeat for all open event streams.
+
+    A single timer checks the registered streams once per tick and sends a ping
+    to every stream that has not sent anything for its ping interval. It also
+    ends all streams when the server is shutting down. The timer task only runs
+    while streams are registered.
+    """
+
+    TICK = 1.0
+
+    def __init__(self):
+        self.streams: set["LoggingStreamResponse"] = set()
+        self.task: asyncio.Task = None
+        # Running ping sends, referenced until they are done
+        self.pings: set[asyncio.Task] = set()
+
+    def register(self, stream: "LoggingStreamResponse"):
+        stream._heartbeat_count = stream.chunks_sent
+        stream._heartbeat_time = anyio.current_time()
+        self.streams.add(stream)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    def unregister(self, stream: "LoggingStreamResponse"):
+        self.streams.discard(stream)
+
+    def tick(self, now: float):
+        if AppStatus.should_exit:
+            for stream in list(self.streams):
+                stream.cancel()
+            return
+        for stream in self.streams:
+            if stream.chunks_sent != stream._heartbeat_count:
+                # The stream is not idle
+                stream._heartbeat_count = stream.chunks_sent
+                stream._heartbeat_time = now
+            elif now - stream._heartbeat_time >= stream.ping_interval:
+                stream._heartbeat_time = now
+                task = asyncio.ensure_future(stream.ping())
+                self.pings.add(task)
+                task.add_done_callback(self.pings.discard)
+
+    async def run(self):
+        while self.streams:
+            await asyncio.sleep(self.TICK)
+            self.tick(anyio.current_time())
+
+
+heartbeat_scheduler = HeartbeatScheduler()
+# Pre-encoded ping frames per separator
+_ping_frames: dict[str, bytes] = {}
+
+
+def get_ping_frame(sep: str) -> bytes:
+    frame = _ping_frames.get(sep)
+    if frame is None:
+        frame = ServerSentEvent(comment="ping", sep=sep).encode()
+        _ping_frames[sep] = frame
+    return frame
+
+
 class LoggingStreamResponse(Response):
     """Implements the ServerSentEvent Protocol:
     https://www.w3.org/TR/2009/WD-eventsource-20090421/
@@ -199,6 +310,11 @@ class LoggingStreamResponse(Response):
     body_iterator: AsyncContentStream
 
     DEFAULT_PING_INTERVAL = 15
+    DEFAULT_COALESCE_BYTES = 16384
+    # Chunks read ahead from the upstream while coalescing
+    COALESCE_BUFFER = 64
+    # Seconds to wait for the usage to be logged when the stream ends
+    LOG_TIMEOUT = 5.0
 
     # noinspection PyMissingConstructor
     def __init__(
@@ -216,6 +332,12 @@ class LoggingStreamResponse(Response):
         ] = None,
         send_timeout: Optional[float] = None,
         streamlogger: StreamLogger = None,
+        coalesce_window: float = 0,
+        coalesce_bytes: Optional[int] = None,
+        idle_timeout: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        metrics: Metrics = None,
     ) -> None:
         if sep is not None and sep not in ["\r\n", "\r", "\n"]:
             raise ValueError(f"sep must be one of: \\r\\n, \\r, \\n, got: {sep}")
@@ -234,6 +356,19 @@ class LoggingStreamResponse(Response):
         self.data_sender_callable = data_sender_callable
         self.send_timeout = send_timeout
         self.streamlogger = streamlogger
+        # Events arriving within the window (in seconds) are sent together
+        self.coalesce_window = coalesce_window
+        self.coalesce_bytes = (
+            self.DEFAULT_COALESCE_BYTES if coalesce_bytes is None else coalesce_bytes
+        )
+        # Watchdog: the stream is ended with an error event if nothing is received
+        # from the upstream for idle_timeout seconds or it exceeds the limits.
+        self.idle_timeout = idle_timeout
+        self.max_tokens = max_tokens
+        self.max_bytes = max_bytes
+        self.limited = max_tokens is not None or max_bytes is not None
+        self.bytes_received = 0
+        self.metrics = metrics
         _headers: dict[str, str] = {}
         if headers is not None:  # pragma: no cover
             _headers.update(headers)
@@ -249,8 +384,11 @@ class LoggingStreamResponse(Response):
 
         self.ping_interval = self.DEFAULT_PING_INTERVAL if ping is None else ping
         self.active = True
-
-        self._ping_task = None
+        # Counts the sent chunks, the heartbeat only pings idle streams
+        self.chunks_sent = 0
+        self._sending = False
+        self._send: Send = None
+        self._cancel_scope: anyio.CancelScope = None
 
         # https://github.com/sysid/sse-starlette/pull/55#issuecomment-1732374113
         self._send_lock = anyio.Lock()
@@ -263,23 +401,6 @@ class LoggingStreamResponse(Response):
                 _log.debug("Got event: http.disconnect. Stop streaming.")
                 break
 
-    @staticmethod
-    async def listen_for_exit_signal() -> None:
-        # Check if should_exit was set before anybody started waiting
-        if AppStatus.should_exit:
-            return
-
-        # Setup an Event
-        if AppStatus.should_exit_event is None:
-            AppStatus.should_exit_event = anyio.Event()
-
-        # Check if should_exit got set while we set up the event
-        if AppStatus.should_exit:
-            return
-
-        # Await the event
-        await AppStatus.should_exit_event.wait()
-
     async def stream_response(self, send: Send) -> None:
         await send(
             {
@@ -288,23 +409,188 @@ class LoggingStreamResponse(Response):
                 "headers": self.raw_headers,
             }
         )
-        async for data in self.body_iterator:
-            chunk = ensure_bytes(data, self.sep)
-            _log.debug(f"chunk: {chunk.decode()}")
-            self.streamlogger.handle_chunk(chunk.decode())
-            with anyio.move_on_after(self.send_timeout) as timeout:
-                await send(
-                    {"type": "http.response.body", "body": chunk, "more_body": True}
-                )
+        reason = None
+        try:
+            # A single cancel scope for the whole stream. Its deadline is set while
+            # a chunk is sent, and while waiting for the upstream if the idle
+            # timeout is set.
+            with anyio.CancelScope() as timeout:
+                if self.coalesce_window > 0:
+                    reason = await self.stream_coalesced(send, timeout)
+                else:
+                    reason = await self.stream_direct(send, timeout)
             if timeout.cancel_called:
-                await self.body_iterator.aclose()
-                raise SendTimeoutError()
+                if self._sending:
+                    await self.body_iterator.aclose()
+                    raise SendTimeoutError()
+                reason = "stalled"
+            if reason is not None:
+                await self.abort(send, reason)
+        finally:
+            # The usage is also logged if the stream was cancelled (e.g. the
+            # client disconnected) or timed out.
+            self.active = False
+            # Shielded, as the surrounding scope may be cancelled already
+            with anyio.move_on_after(self.LOG_TIMEOUT, shield=True):
+                await self.streamlogger.finish()
 
         async with self._send_lock:
-            self.active = False
-            self.streamlogger.finish()
             await send({"type": "http.response.body", "body": b"", "more_body": False})
 
+    async def stream_direct(
+        self, send: Send, timeout: anyio.CancelScope
+    ) -> Optional[str]:
+        """
+        Forward the stream chunk by chunk, raw upstream bytes are forwarded as they are.
+
+        Returns:
+        - str: Why the stream has to be aborted, None if it completed.
+        """
+        debug = _log.isEnabledFor(logging.DEBUG)
+        idle_timeout = self.idle_timeout
+        if idle_timeout is not None:
+            timeout.deadline = anyio.current_time() + idle_timeout
+        async for data in self.body_iterator:
+            chunk = data if type(data) is bytes else ensure_bytes(data, self.sep)
+            if debug:
+                _log.debug("chunk: %r", chunk)
+            self.streamlogger.handle_chunk(chunk)
+            if self.limited:
+                reason = self.check_limits(chunk)
+                if reason is not None:
+                    return reason
+            if self.send_timeout is not None:
+                timeout.deadline = anyio.current_time() + self.send_timeout
+            elif idle_timeout is not None:
+                timeout.deadline = math.inf
+            self._sending = True
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            self._sending = False
+            self.chunks_sent += 1
+            timeout.deadline = (
+                math.inf
+                if idle_timeout is None
+                else anyio.current_time() + idle_timeout
+            )
+        return None
+
+    def check_limits(self, chunk: bytes) -> Optional[str]:
+        self.bytes_received += len(chunk)
+        if (
+            self.max_tokens is not None
+            and self.streamlogger.tokenCount > self.max_tokens
+        ):
+            return "max_tokens"
+        if self.max_bytes is not None and self.bytes_received > self.max_bytes:
+            return "max_bytes"
+        return None
+
+    async def abort(self, send: Send, reason: str) -> None:
+        """
+        End the stream early with an error event and close the upstream.
+        """
+        await self.body_iterator.aclose()
+        if reason == "stalled":
+            message = f"No data received from the inference server for {self.idle_timeout} seconds"
+        elif reason == "max_tokens":
+            message = f"The response exceeded the limit of {self.max_tokens} tokens"
+        else:
+            message = f"The response exceeded the limit of {self.max_bytes} bytes"
+        _log.warning("Stream aborted: %s", message)
+        if self.metrics is not None:
+            self.metrics.increment(f"streams_aborted_{reason}")
+        error = {
+            "error": {"message": message, "type": "stream_aborted", "code": reason}
+        }
+        event = ServerSentEvent(json.dumps(error), sep=self.sep).encode()
+        with anyio.move_on_after(self.send_timeout):
+            await send({"type": "http.response.body", "body": event, "more_body": True})
+
+    async def send_chunk(
+        self, send: Send, chunk: bytes, timeout: anyio.CancelScope
+    ) -> None:
+        if self.send_timeout is not None:
+            timeout.deadline = anyio.current_time() + self.send_timeout
+        self._sending = True
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        self._sending = False
+        self.chunks_sent += 1
+        timeout.deadline = math.inf
+
+    async def stream_coalesced(
+        self, send: Send, timeout: anyio.CancelScope
+    ) -> Optional[str]:
+        """
+        Forward the stream with all events that arrive within the coalescing window
+        (or up to coalesce_bytes) merged into one send. The first event is sent
+        as soon as it is complete, and chunks are only split at the end of an event.
+
+        Returns:
+        - str: Why the stream has to be aborted, None if it completed.
+        """
+        chunks, received = anyio.create_memory_object_stream(self.COALESCE_BUFFER)
+
+        async def read() -> None:
+            async with chunks:
+                async for data in self.body_iterator:
+                    await chunks.send(
+                        data if type(data) is bytes else ensure_bytes(data, self.sep)
+                    )
+
+        debug = _log.isEnabledFor(logging.DEBUG)
+        buffer = bytearray()
+        deadline = math.inf
+        idle_deadline = math.inf
+        reason = None
+        async with anyio.create_task_group() as task_group, received:
+            task_group.start_soon(read)
+            while True:
+                if self.idle_timeout is not None and idle_deadline == math.inf:
+                    idle_deadline = anyio.current_time() + self.idle_timeout
+                chunk = None
+                with anyio.CancelScope(deadline=min(deadline, idle_deadline)):
+                    try:
+                        chunk = await received.receive()
+                    except anyio.EndOfStream:
+                        break
+                if chunk is not None:
+                    idle_deadline = math.inf
+                    if debug:
+                        _log.debug("chunk: %r", chunk)
+                    self.streamlogger.handle_chunk(chunk)
+                    if self.limited:
+                        reason = self.check_limits(chunk)
+                        if reason is not None:
+                            break
+                    buffer += chunk
+                    end = last_event_end(buffer)
+                    if end < 0 or (
+                        self.chunks_sent > 0 and len(buffer) < self.coalesce_bytes
+                    ):
+                        if end > 0 and deadline == math.inf:
+                            deadline = anyio.current_time() + self.coalesce_window
+                        continue
+                elif anyio.current_time() >= idle_deadline:
+                    reason = "stalled"
+                    break
+                else:
+                    # The window has elapsed
+                    end = last_event_end(buffer)
+                deadline = math.inf
+                if end > 0:
+                    await self.send_chunk(send, bytes(buffer[:end]), timeout)
+                    del buffer[:end]
+            task_group.cancel_scope.cancel()
+        if reason is not None:
+            # Only complete events are sent before the error event
+            end = last_event_end(buffer)
+            if end > 0:
+                await self.send_chunk(send, bytes(buffer[:end]), timeout)
+            return reason
+        if buffer:
+            await self.send_chunk(send, bytes(buffer), timeout)
+        return None
+
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
         async with anyio.create_task_group() as task_group:
             # https://trio.readthedocs.io/en/latest/reference-core.html#custom-supervisors
@@ -313,14 +599,19 @@ class LoggingStreamResponse(Response):
                 # noinspection PyAsyncCall
                 task_group.cancel_scope.cancel()
 
-            task_group.start_soon(wrap, partial(self.stream_response, send))
-            task_group.start_soon(wrap, partial(self._ping, send))
-            task_group.start_soon(wrap, self.listen_for_exit_signal)
+            # Pings and the shutdown are handled by the shared heartbeat
+            self._send = send
+            self._cancel_scope = task_group.cancel_scope
+            heartbeat_scheduler.register(self)
+            try:
+                task_group.start_soon(wrap, partial(self.stream_response, send))
 
-            if self.data_sender_callable:
-                task_group.start_soon(self.data_sender_callable)
+                if self.data_sender_callable:
+                    task_group.start_soon(self.data_sender_callable)
 
-            await wrap(partial(self.listen_for_disconnect, receive))
+                await wrap(partial(self.listen_for_disconnect, receive))
+            finally:
+                heartbeat_scheduler.unregister(self)
 
         if self.background is not None:  # pragma: no cover, tested in StreamResponse
             await self.background()
@@ -347,24 +638,31 @@ class LoggingStreamResponse(Response):
 
         self._ping_interval = value
 
-    async def _ping(self, send: Send) -> None:
+    def cancel(self) -> None:
+        if self._cancel_scope is not None:
+            self._cancel_scope.cancel()
+
+    async def ping(self) -> None:
         # Legacy proxy servers are known to, in certain cases, drop HTTP connections after a short timeout.
         # To protect against such proxy servers, authors can send a custom (ping) event
         # every 15 seconds or so.
         # Alternatively one can send periodically a comment line
         # (one starting with a ':' character)
-        while self.active:
-            await anyio.sleep(self._ping_interval)
-            if self.ping_message_factory:
-                assert isinstance(self.ping_message_factory, Callable)  # type: ignore  # https://github.com/python/mypy/issues/6864
-            ping = (
-                ServerSentEvent(comment=f"ping - {datetime.utcnow()}").encode()
-                if self.ping_message_factory is None
-                else ensure_bytes(self.ping_message_factory(), self.sep)
-            )
-            _log.debug(f"ping: {ping.decode()}")
+        if self.ping_message_factory:
+            assert isinstance(self.ping_message_factory, Callable)  # type: ignore  # https://github.com/python/mypy/issues/6864
+        ping = (
+            get_ping_frame(self.sep)
+            if self.ping_message_factory is None
+            else ensure_bytes(self.ping_message_factory(), self.sep)
+        )
+        _log.debug("ping: %r", ping)
+        try:
             async with self._send_lock:
                 if self.active:
-                    await send(
+                    await self._send(
                         {"type": "http.response.body", "body": ping, "more_body": True}
                     )
+        except Exception:
+            # The stream can't be continued if sending failed
+            _log.debug("Sending ping failed. Stop streaming.", exc_info=True)
+            self.cancel()
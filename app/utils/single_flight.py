@@ -0,0 +1,52 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: while a call for a key is in flight,
+    further callers with the same key wait for its result instead of starting
+    their own call. The call is only cancelled if all of its callers are cancelled.
+    """
+
+    def __init__(self):
+        self.calls: dict[str, _Call] = {}
+
+    def _remove(self, key: str, call: _Call):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run fn, or wait for the result of the running call for key.
+
+        Parameters:
+        - key (str): Identifies identical calls.
+        - fn (Callable): Coroutine function performing the call.
+
+        Returns:
+        - The result of the (shared) call.
+        """
+        call = self.calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn()))
+            self.calls[key] = call
+            call.task.add_done_callback(lambda _: self._remove(key, call))
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # Nobody is interested in the result any more.
+                call.task.cancel()
+                self._remove(key, call)
+
+    def in_flight(self) -> int:
+        return len(self.calls)
@@ -0,0 +1,154 @@
+import json
+import re
+from typing import AsyncIterator, Callable
+
+from .usage_extraction import extract_usage
+
+_line_ends = (b"\n", b"\r")
+_whitespace = b" \t\r\n"
+# An event of an event stream ends with an empty line.
+_event_end = re.compile(rb"\r\n\r\n|\n\n|\r\r")
+
+
+class SSEParser:
+    """
+    Incremental parser for event streams. Chunks can be split at arbitrary
+    positions (also within lines), incomplete lines are kept until the next chunk.
+    Only the data fields of the events are collected, everything else is skipped.
+    """
+
+    def __init__(self):
+        self.buffer = b""
+        self.data: list[bytes] = []
+
+    def feed(self, chunk: bytes) -> list[bytes]:
+        """
+        Parse the next chunk of the stream.
+
+        Returns:
+        - list: The data of all events completed by this chunk.
+        """
+        if self.buffer:
+            chunk = self.buffer + chunk
+            self.buffer = b""
+        lines = chunk.splitlines(keepends=True)
+        # The last line is incomplete, or a \r that could be the start of \r\n.
+        if len(lines) > 0 and (
+            not lines[-1].endswith(_line_ends) or lines[-1].endswith(b"\r")
+        ):
+            self.buffer = lines.pop()
+        events = []
+        for line in lines:
+            if line[0] in b"\r\n":
+                # An empty line ends the event
+                if self.data:
+                    events.append(b"\n".join(self.data))
+                    self.data = []
+            elif line.startswith(b"data:"):
+                value = line[5:].rstrip(b"\r\n")
+                if value.startswith(b" "):
+                    value = value[1:]
+                self.data.append(value)
+        return events
+
+    def flush(self) -> list[bytes]:
+        """
+        End the stream and get the data of a final event that was not terminated.
+        """
+        events = self.feed(b"\n\n") if self.buffer or self.data else []
+        self.buffer = b""
+        return events
+
+
+def decode_choices(data: bytes) -> int:
+    try:
+        choices = json.loads(data)["choices"]
+    except (ValueError, KeyError, TypeError):
+        return 0
+    return len(choices) if isinstance(choices, list) else 0
+
+
+def count_choices(data: bytes) -> int:
+    """
+    Count the choices in the data of a streamed completion event without decoding it.
+    Streamed chunks almost always have a single choice with a single index,
+    the event is only decoded if that is not obviously the case.
+
+    Parameters:
+    - data (bytes): The data of the event.
+
+    Returns:
+    - int: The number of choices, 0 for events without choices (e.g. [DONE] or the usage).
+    """
+    pos = data.rfind(b'"choices"')
+    if pos < 0:
+        return 0
+    # Quotes within strings are escaped, so this is a key if a colon follows.
+    head = data[pos + 9 : pos + 20].lstrip(_whitespace)
+    if not head.startswith(b":"):
+        return decode_choices(data)
+    head = head[1:].lstrip(_whitespace)
+    if not head.startswith(b"["):
+        return 0
+    if head[1:].lstrip(_whitespace).startswith(b"]"):
+        return 0
+    if data.count(b'"index"', pos) == 1:
+        return 1
+    return decode_choices(data)
+
+
+def last_event_end(data: bytes) -> int:
+    """
+    Get the end of the last complete event in data, or -1 if there is none.
+    """
+    end = -1
+    for separator in (b"\r\n\r\n", b"\n\n", b"\r\r"):
+        pos = data.rfind(separator)
+        if pos >= 0:
+            end = max(end, pos + len(separator))
+    return end
+
+
+def is_usage_event(event: bytes) -> bool:
+    """
+    Whether an event only reports the usage of the stream (the final chunk with include_usage).
+    """
+    return (
+        b'"usage"' in event
+        and count_choices(event) == 0
+        and extract_usage(event) is not None
+    )
+
+
+async def strip_usage_events(
+    iterator: AsyncIterator[bytes], handle_chunk: Callable[[bytes], None]
+):
+    """
+    Pass through an event stream without the usage events. The usage was
+    requested by the gateway, and clients that did not ask for it might not
+    expect an event without choices. The removed events are passed to handle_chunk,
+    e.g. of the StreamLogger, so that the usage can still be logged.
+    """
+    buffer = b""
+    async for chunk in iterator:
+        buffer = buffer + chunk if buffer else chunk
+        end = last_event_end(buffer)
+        if end < 0:
+            continue
+        complete, buffer = buffer[:end], buffer[end:]
+        if b'"usage"' not in complete:
+            yield complete
+            continue
+        start = 0
+        passed = []
+        for match in _event_end.finditer(complete):
+            event = complete[start : match.end()]
+            start = match.end()
+            if is_usage_event(event):
+                handle_chunk(event)
+            else:
+                passed.append(event)
+        if passed:
+            yield b"".join(passed)
+    if buffer:
+        yield buffer
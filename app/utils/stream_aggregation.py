@@ -0,0 +1,134 @@
+import json
+
+# The response objects of the streamed chunk objects
+_aggregated_objects = {
+    "chat.completion.chunk": "chat.completion",
+    "text_completion": "text_completion",
+}
+
+
+def merge_logprobs(merged: dict | None, logprobs: dict | None) -> dict | None:
+    """
+    Append the logprobs of a chunk, all list fields are concatenated.
+    """
+    if not isinstance(logprobs, dict):
+        return merged
+    if merged is None:
+        return {
+            name: list(value) if isinstance(value, list) else value
+            for name, value in logprobs.items()
+        }
+    for name, value in logprobs.items():
+        if isinstance(value, list) and isinstance(merged.get(name), list):
+            merged[name].extend(value)
+        elif name not in merged:
+            merged[name] = value
+    return merged
+
+
+class StreamAggregator:
+    """
+    Aggregates the events of a streamed (chat) completion into the response
+    the inference server would have sent for the non streaming request.
+    """
+
+    def __init__(self):
+        self.response: dict = None
+        self.choices: dict[int, dict] = {}
+        # The content (or text) of each choice, joined at the end
+        self.parts: dict[int, list[str]] = {}
+        self.usage: dict = None
+        # An error event sent by the inference server
+        self.error: dict = None
+
+    def handle_event(self, data: bytes):
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            # [DONE]
+            return
+        if not isinstance(chunk, dict):
+            return
+        if "error" in chunk:
+            self.error = chunk
+            return
+        if self.response is None:
+            self.response = {
+                name: value
+                for name, value in chunk.items()
+                if name not in ("choices", "usage")
+            }
+            self.response["object"] = _aggregated_objects.get(
+                chunk.get("object"), chunk.get("object")
+            )
+        if isinstance(chunk.get("usage"), dict):
+            self.usage = chunk["usage"]
+        for choice in chunk.get("choices") or []:
+            self.handle_choice(choice)
+
+    def handle_choice(self, choice: dict):
+        index = choice.get("index", 0)
+        merged = self.choices.get(index)
+        if merged is None:
+            merged = {"index": index, "logprobs": None, "finish_reason": None}
+            if "delta" in choice:
+                merged["message"] = {"role": "assistant", "content": None}
+            else:
+                merged["text"] = ""
+            self.choices[index] = merged
+            self.parts[index] = []
+        if "delta" in choice:
+            self.handle_delta(merged["message"], choice["delta"] or {}, index)
+        elif isinstance(choice.get("text"), str):
+            self.parts[index].append(choice["text"])
+        merged["logprobs"] = merge_logprobs(merged["logprobs"], choice.get("logprobs"))
+        if choice.get("finish_reason") is not None:
+            merged["finish_reason"] = choice["finish_reason"]
+
+    def handle_delta(self, message: dict, delta: dict, index: int):
+        for name, value in delta.items():
+            if name == "content" and isinstance(value, str):
+                self.parts[index].append(value)
+            elif name == "tool_calls" and isinstance(value, list):
+                self.handle_tool_calls(message.setdefault("tool_calls", []), value)
+            elif value is not None:
+                message[name] = value
+
+    def handle_tool_calls(self, tool_calls: list, deltas: list):
+        for delta in deltas:
+            index = delta.get("index", len(tool_calls))
+            while len(tool_calls) <= index:
+                tool_calls.append(
+                    {
+                        "id": None,
+                        "type": "function",
+                        "function": {"name": "", "arguments": ""},
+                    }
+                )
+            call = tool_calls[index]
+            for name in ("id", "type"):
+                if delta.get(name) is not None:
+                    call[name] = delta[name]
+            function = delta.get("function") or {}
+            for name in ("name", "arguments"):
+                if isinstance(function.get(name), str):
+                    call["function"][name] += function[name]
+
+    def result(self) -> dict:
+        """
+        Get the aggregated response.
+        """
+        response = dict(self.response or {})
+        response["choices"] = []
+        for index in sorted(self.choices):
+            choice = self.choices[index]
+            content = "".join(self.parts[index])
+            if "message" in choice:
+                if len(self.parts[index]) > 0:
+                    choice["message"]["content"] = content
+            else:
+                choice["text"] = content
+            response["choices"].append(choice)
+        if self.usage is not None:
+            response["usage"] = self.usage
+        return response
@@ -1,23 +1,8 @@
-from .logging_handler import LoggingHandler
-
-# from .requests import ChatCompletionRequest
-import re
-import json
-
-
-def getTokensForChunk(streamChunk: str):
-    regex = "(?:^data: )(.*)"
-    matches = re.findall(regex, streamChunk)
-    tokenCount = 0
-    for tokens in matches:
-        if tokens.strip() == "[DONE]":
-            pass
-        else:
-            parsed_json = json.loads(tokens)
-            dataChoices = parsed_json["choices"]
-            tokenCount = tokenCount + len(dataChoices)
+import inspect
 
-    return tokenCount
+from .logging_handler import LoggingHandler
+from .sse_parsing import SSEParser, count_choices
+from .usage_extraction import extract_usage
 
 
 class StreamLogger:
@@ -29,25 +14,62 @@ class StreamLogger:
         self.model = model
         self.source = source
         self.iskey = iskey
+        self.parser = SSEParser()
+        # The usage reported at the end of the stream, if requested
+        self.usage = None
 
     #    def log_request(self, requestData: ChatCompletionRequest):
     # Not implemented for now, will come later but needs model specific
     # Token calculation
     #        pass
 
-    def handle_chunk(self, chunk: str):
-        self.tokenCount = self.tokenCount + getTokensForChunk(chunk)
+    def handle_event(self, data: bytes):
+        if b'"usage"' in data:
+            usage = extract_usage(data)
+            if usage is not None:
+                self.usage = usage
+        # Fallback, if the usage is not reported: Each chunk contains one token per choice
+        self.tokenCount = self.tokenCount + count_choices(data)
+
+    def handle_chunk(self, chunk: bytes | str):
+        """
+        Count the tokens in a chunk of the stream. Chunks don't need to contain complete events.
+        """
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        for data in self.parser.feed(chunk):
+            self.handle_event(data)
 
     def debug(self, data: str):
         if data.startswith("chunk:"):
             self.handle_chunk(data.split("chunk:")[1])
 
-    def finish(self):
+    async def log(self, tokencount: int, isprompt: bool):
+        """
+        Log the usage with the logging handler, which may be sync or async.
+        """
         if self.iskey:
-            self.logger.log_usage_for_key(
-                tokencount=self.tokenCount, model=self.model, key=self.source
+            result = self.logger.log_usage_for_key(
+                tokencount=tokencount,
+                model=self.model,
+                key=self.source,
+                isprompt=isprompt,
             )
         else:
-            self.logger.log_usage_for_user(
-                tokencount=self.tokenCount, model=self.model, user=self.source
+            result = self.logger.log_usage_for_user(
+                tokencount=tokencount,
+                model=self.model,
+                user=self.source,
+                isprompt=isprompt,
             )
+        if inspect.isawaitable(result):
+            await result
+
+    async def finish(self):
+        for data in self.parser.flush():
+            self.handle_event(data)
+        if self.usage is not None:
+            await self.log(self.usage.get("completion_tokens", self.tokenCount), False)
+            await self.log(self.usage.get("prompt_tokens", 0), True)
+        else:
+            await self.log(self.tokenCount, False)
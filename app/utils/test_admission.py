@@ -0,0 +1,127 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+
+from utils.admission import AdmissionController, FairQueue, get_priority
+from utils.metrics import Metrics
+
+
+def test_get_priority():
+    assert get_priority(None, None) == "standard"
+    assert get_priority("interactive", None) == "interactive"
+    # Requests can only lower their priority
+    assert get_priority("interactive", "batch") == "batch"
+    assert get_priority("batch", "interactive") == "batch"
+    assert get_priority("standard", "unknown") == "standard"
+
+
+def make_controller(limit, depth, timeout=5):
+    controller = AdmissionController(Metrics())
+    controller.enabled = True
+    controller.max_concurrency = limit
+    controller.max_queue = depth
+    controller.queue_timeout = timeout
+    return controller
+
+
+def test_priority_order():
+    async def run():
+        controller = make_controller(1, 10)
+        order = []
+        first = await controller.acquire("model", "standard")
+
+        async def request(name, priority):
+            permit = await controller.acquire("model", priority)
+            order.append(name)
+            permit.release()
+
+        tasks = [
+            asyncio.create_task(request("batch", "batch")),
+            asyncio.create_task(request("standard", "standard")),
+            asyncio.create_task(request("interactive", "interactive")),
+        ]
+        await asyncio.sleep(0)
+        assert controller.get_status()["models"]["model"]["queued"]["batch"] == 1
+        first.release()
+        await asyncio.gather(*tasks)
+        assert controller.get_status()["models"]["model"]["active"] == 0
+        return order
+
+    assert asyncio.run(run()) == ["interactive", "standard", "batch"]
+
+
+def test_full_queue_is_rejected():
+    async def run():
+        controller = make_controller(1, 1)
+        permit = await controller.acquire("model", "standard")
+        waiting = asyncio.create_task(controller.acquire("model", "standard"))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as e:
+            await controller.acquire("model", "standard")
+        assert e.value.status_code == 429
+        assert "Retry-After" in e.value.headers
+        # Other models have their own queue
+        (await controller.acquire("other", "standard")).release()
+        permit.release()
+        (await waiting).release()
+        assert controller.metrics.get("admission_rejected") == 1
+
+    asyncio.run(run())
+
+
+def test_queue_timeout_and_cancellation():
+    async def run():
+        controller = make_controller(1, 5, timeout=0.01)
+        permit = await controller.acquire("model", "standard")
+        with pytest.raises(HTTPException) as e:
+            await controller.acquire("model", "batch")
+        assert e.value.status_code == 429
+        cancelled = asyncio.create_task(controller.acquire("model", "standard"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        queue = controller.get_queue("model")
+        assert queue.depth == 0
+        permit.release()
+        assert queue.active == 0
+
+    asyncio.run(run())
+
+
+def test_fair_queue_weights():
+    queue = FairQueue()
+    for i in range(6):
+        queue.push("heavy", 1, f"heavy{i}")
+    queue.push("light", 1, "light0")
+    queue.push("light", 1, "light1")
+    queue.push("double", 2, "double0")
+    queue.push("double", 2, "double1")
+    queue.push("double", 2, "double2")
+    order = [queue.pop() for _ in range(11)]
+    # The heavy key does not delay the others
+    assert order[:6] == ["heavy0", "light0", "double0", "double1", "heavy1", "light1"]
+    assert order[6:] == ["double2", "heavy2", "heavy3", "heavy4", "heavy5"]
+    assert len(queue) == 0
+    # Fractional weights accumulate
+    queue.push("slow", 0.5, "slow0")
+    queue.push("slow", 0.5, "slow1")
+    queue.push("fast", 1, "fast0")
+    queue.push("fast", 1, "fast1")
+    assert [queue.pop() for _ in range(4)] == ["fast0", "slow0", "fast1", "slow1"]
+
+
+def test_tenant_stats():
+    async def run():
+        controller = make_controller(1, 10)
+        permit = await controller.acquire("model", "standard", "a")
+        waiting = asyncio.create_task(controller.acquire("model", "standard", "b"))
+        await asyncio.sleep(0)
+        assert controller.get_status()["tenants"]["b"]["queued"] == 1
+        permit.release()
+        (await waiting).release()
+        return controller.get_status()["tenants"]
+
+    tenants = asyncio.run(run())
+    assert tenants["a"]["admitted"] == 1
+    assert tenants["b"]["queued"] == 0
+    assert tenants["b"]["admitted"] == 1
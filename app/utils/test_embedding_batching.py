@@ -0,0 +1,67 @@
+import asyncio
+import httpx
+
+from utils.embedding_batching import EmbeddingBatcher
+
+
+def embedding_response(inputs):
+    return httpx.Response(
+        200,
+        json={
+            "object": "list",
+            "data": [
+                {"object": "embedding", "embedding": [len(text)], "index": i}
+                for i, text in enumerate(inputs)
+            ],
+            "usage": {
+                "prompt_tokens": 2 * len(inputs),
+                "total_tokens": 2 * len(inputs),
+            },
+        },
+    )
+
+
+def test_concurrent_requests_are_batched():
+    batches = []
+
+    async def send(data, inputs, context):
+        batches.append((data["model"], list(inputs)))
+        return embedding_response(inputs)
+
+    async def run():
+        batcher = EmbeddingBatcher(send)
+        batcher.max_items = 4
+        batcher.max_wait = 0.01
+        return await asyncio.gather(
+            batcher.submit("/v1/embeddings", {"model": "a"}, ["x"]),
+            batcher.submit("/v1/embeddings", {"model": "a"}, ["yy", "zzz"]),
+            batcher.submit("/v1/embeddings", {"model": "b"}, ["x"]),
+            # fills the first batch, which is sent right away
+            batcher.submit("/v1/embeddings", {"model": "a"}, ["x"]),
+            batcher.submit("/v1/embeddings", {"model": "a"}, ["w"]),
+        )
+
+    results = asyncio.run(run())
+    assert batches == [("a", ["x", "yy", "zzz", "x"]), ("b", ["x"]), ("a", ["w"])]
+    _, embeddings, tokens = results[1]
+    assert embeddings == [[2], [3]]
+    # The tokens of the batch are split over all callers
+    assert sum(sum(result[2]) for result in [results[0], results[1], results[3]]) == 8
+    assert results[2][1:] == ([[1]], [2])
+
+
+def test_failed_batch():
+    async def send(data, inputs, context):
+        return httpx.Response(500, json={"error": "failed"})
+
+    async def run():
+        batcher = EmbeddingBatcher(send)
+        batcher.max_wait = 0.001
+        return await asyncio.gather(
+            batcher.submit("/v1/embeddings", {"model": "a"}, ["x"]),
+            batcher.submit("/v1/embeddings", {"model": "a"}, ["y"]),
+        )
+
+    for r, embeddings, tokens in asyncio.run(run()):
+        assert r.status_code == 500
+        assert embeddings == None
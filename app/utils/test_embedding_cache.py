@@ -0,0 +1,36 @@
+from utils.embedding_cache import apportion_tokens, get_text_inputs, EmbeddingCache
+from utils.metrics import Metrics
+
+
+def test_apportion_tokens():
+    assert apportion_tokens(["abc"], 7) == [7]
+    tokens = apportion_tokens(["a", "abc", "ab"], 10)
+    assert sum(tokens) == 10
+    assert tokens[1] >= tokens[2] >= tokens[0]
+    assert sum(apportion_tokens(["", "a", "b"], 2)) == 2
+
+
+def test_get_text_inputs():
+    assert get_text_inputs({"input": "text"}) == ["text"]
+    assert get_text_inputs({"input": ["a", "b"]}) == ["a", "b"]
+    # Token inputs are not cached
+    assert get_text_inputs({"input": [1, 2, 3]}) == None
+    assert get_text_inputs({"input": [[1, 2], [3]]}) == None
+    assert get_text_inputs({"input": []}) == None
+
+
+def test_embedding_cache_keys():
+    cache = EmbeddingCache(None, Metrics())
+    data = {"model": "model", "input": ["a", "b"]}
+    keys = cache.get_keys("/v1/embeddings", data, ["a", "b"])
+    assert len(set(keys)) == 2
+    # The input field itself is not part of the key
+    assert cache.get_keys("/v1/embeddings", {**data, "input": "b"}, ["b"]) == keys[1:]
+    other = cache.get_keys("/v1/embeddings", {**data, "model": "other"}, ["a"])
+    assert not other[0] == keys[0]
+
+
+def test_embedding_cache_generation_ttl(monkeypatch):
+    assert EmbeddingCache(None, Metrics()).generation_ttl == 5
+    monkeypatch.setenv("EMBEDDING_CACHE_GENERATION_TTL", "0.5")
+    assert EmbeddingCache(None, Metrics()).generation_ttl == 0.5
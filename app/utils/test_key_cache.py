@@ -0,0 +1,58 @@
+import time
+
+from pytest_mock_resources import create_redis_fixture
+from utils.key_cache import KeyCache, ALL_KEYS
+
+redis = create_redis_fixture()
+
+
+def test_key_cache_ttl():
+    cache = KeyCache(ttl=60, negative_ttl=0.05, max_entries=10)
+    cache.set("valid", True, cache.generation)
+    cache.set("invalid", False, cache.generation)
+    assert cache.get("valid") == True
+    assert cache.get("invalid") == False
+    assert cache.get("missing") == None
+    # rejections expire sooner
+    time.sleep(0.06)
+    assert cache.get("invalid") == None
+    assert cache.get("valid") == True
+
+
+def test_key_cache_bounds_and_invalidation():
+    cache = KeyCache(ttl=60, negative_ttl=60, max_entries=2)
+    cache.set("a", True, cache.generation)
+    cache.set("b", True, cache.generation)
+    assert cache.get("a") == True
+    # evicts b, the least recently used entry
+    cache.set("c", False, cache.generation)
+    assert cache.get("b") == None
+    cache.invalidate("a")
+    assert cache.get("a") == None
+    assert cache.get("c") == False
+    cache.invalidate(ALL_KEYS)
+    assert cache.get("c") == None
+
+
+def test_key_cache_ignores_outdated_checks():
+    cache = KeyCache(ttl=60, negative_ttl=60, max_entries=10)
+    generation = cache.generation
+    # The key is revoked while it is being checked
+    cache.invalidate("key")
+    cache.set("key", True, generation)
+    assert cache.get("key") == None
+
+
+def test_key_cache_invalidation_channel(redis):
+    cache = KeyCache(ttl=60, negative_ttl=60, max_entries=10)
+    other_worker = KeyCache(ttl=60, negative_ttl=60, max_entries=10)
+    cache.start(redis)
+    try:
+        cache.set("key", True, cache.generation)
+        other_worker.publish(redis, "key")
+        deadline = time.monotonic() + 2
+        while cache.get("key") is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert cache.get("key") == None
+    finally:
+        cache.stop()
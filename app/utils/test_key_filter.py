@@ -0,0 +1,33 @@
+from utils.key_filter import BloomFilter, KeyFilter
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, 0.01)
+    keys = [f"key-{i}" for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    false_positives = sum(f"other-{i}" in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+def test_key_filter_rebuild():
+    key_filter = KeyFilter(error_rate=0.001, min_capacity=100)
+    # Not built yet, every key passes
+    assert key_filter.might_contain("missing") == True
+
+    def keys():
+        yield "a"
+        # Added while the filter is rebuilt
+        key_filter.add("b")
+        yield "c"
+
+    key_filter.rebuild(2, keys(), batch_size=1)
+    assert key_filter.might_contain("a") == True
+    assert key_filter.might_contain("b") == True
+    assert key_filter.might_contain("c") == True
+    assert key_filter.might_contain("missing") == False
+    key_filter.add("d")
+    assert key_filter.might_contain("d") == True
+    key_filter.clear()
+    assert key_filter.might_contain("missing") == True
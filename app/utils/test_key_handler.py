@@ -1,6 +1,10 @@
+import asyncio
+
 from pytest_mock_resources import create_redis_fixture
 from pytest_mock_resources import create_mongo_fixture
-from key_handler import KeyHandler
+from pymongo import AsyncMongoClient
+from redis.asyncio import Redis as AsyncRedis
+from utils.key_handler import AsyncKeyHandler, KeyHandler
 
 
 redis = create_redis_fixture()
@@ -94,3 +98,101 @@ def test_set_key_activity(redis, mongo):
     key_data = key_collection.find_one({"key": newKey})
     assert key_data["active"] == True
     assert handler.check_key(newKey) == True
+
+
+def test_key_priority(redis, mongo):
+    handler = KeyHandler(True)
+    handler.setup(mongo, redis)
+    newKey = handler.create_key("NewUser", "NewKey")
+    assert handler.get_key_priority(newKey) == None
+    handler.add_key("NewUser", "BatchKey", "BATCH", priority="batch")
+    assert handler.get_key_priority("BATCH") == "batch"
+    assert handler.set_key_priority(newKey, "interactive") == True
+    assert handler.set_key_priority("Missing", "interactive") == False
+    # Priorities are restored from the database
+    redis.delete("key_priorities")
+    handler.init_keys()
+    assert handler.get_key_priority(newKey) == "interactive"
+    assert handler.get_key_priority("BATCH") == "batch"
+    handler.delete_key("BATCH")
+    assert handler.get_key_priority("BATCH") == None
+
+
+def test_key_weight(redis, mongo):
+    handler = KeyHandler(True)
+    handler.setup(mongo, redis)
+    handler.add_key("NewUser", "Key", "KEY", priority="batch", weight=2)
+    assert handler.get_key_scheduling("KEY") == ("batch", 2.0)
+    assert handler.set_key_weight("KEY", 0.5) == True
+    redis.delete("key_weights")
+    handler.init_keys()
+    assert handler.get_key_scheduling("KEY") == ("batch", 0.5)
+    assert handler.get_key_scheduling("Missing") == (None, 1.0)
+
+
+# Testing whether changes of keys reach the key cache
+def test_key_cache(redis, mongo):
+    handler = KeyHandler(True)
+    handler.setup(mongo, redis)
+    assert handler.check_key("KEY") == False
+    # The rejection is cached, but adding the key drops it
+    assert handler.add_key("User", "Name", "KEY") == True
+    assert handler.check_key("KEY") == True
+    redis.srem("keys", "KEY")
+    # Served from the cache
+    assert handler.check_key("KEY") == True
+    handler.set_key_activity("KEY", "User", False)
+    assert handler.check_key("KEY") == False
+
+
+# Testing whether keys missing from the key filter are rejected
+def test_key_filter(redis, mongo):
+    handler = KeyHandler(True)
+    handler.setup(mongo, redis)
+    redis.sadd("keys", "ABC")
+    handler.rebuild_key_filter()
+    assert handler.check_key("ABC") == True
+    assert handler.check_key("BCE") == False
+    # keys added by other workers are added from the channel
+    redis.sadd("keys", "DEF")
+    handler.handle_key_change("DEF")
+    assert handler.check_key("DEF") == True
+
+
+def async_clients(redis, mongo):
+    # Async clients for the databases of the fixtures
+    credentials = mongo.pmr_credentials
+    mongo_client = AsyncMongoClient(
+        credentials.host,
+        credentials.port,
+        username=credentials.username,
+        password=credentials.password,
+        authSource=credentials.database,
+    )
+    credentials = redis.pmr_credentials
+    redis_client = AsyncRedis(
+        host=credentials.host, port=credentials.port, db=credentials.database
+    )
+    return mongo_client[mongo.pmr_credentials.database], redis_client
+
+
+def test_async_key_handler(redis, mongo):
+    async def run():
+        handler = AsyncKeyHandler(True)
+        handler.setup(*async_clients(redis, mongo))
+        redis.sadd("keys", "ABC")
+        assert await handler.check_key("ABC") == True
+        assert await handler.check_key("BCE") == False
+        newKey = await handler.create_key("NewUser", "NewKey")
+        user = mongo["gateway"]["users"].find_one({})
+        assert user["keys"] == [newKey]
+        assert await handler.check_key(newKey) == True
+        assert [key["key"] for key in await handler.list_keys("NewUser")] == [newKey]
+        await handler.set_key_priority(newKey, "batch")
+        assert await handler.get_key_priority(newKey) == "batch"
+        await handler.set_key_activity(newKey, "NewUser", False)
+        assert await handler.check_key(newKey) == False
+        await handler.delete_key(newKey)
+        assert mongo["gateway"]["apikeys"].count_documents({}) == 0
+
+    asyncio.run(run())
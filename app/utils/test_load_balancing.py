@@ -0,0 +1,42 @@
+import pytest
+
+from utils.load_balancing import LoadBalancer
+
+backends = [
+    {"url": None, "path": "a", "weight": 1},
+    {"url": None, "path": "b", "weight": 2},
+]
+
+
+def test_least_outstanding():
+    balancer = LoadBalancer("least_outstanding")
+    leases = [balancer.acquire(backends) for _ in range(6)]
+    # Backend b has twice the weight, so it should get twice the requests.
+    assert balancer.in_flight[(None, "a")] == 2
+    assert balancer.in_flight[(None, "b")] == 4
+    for lease in leases:
+        lease.release()
+        # releasing twice does not change the counts
+        lease.release()
+    assert len(balancer.in_flight) == 0
+
+
+def test_least_outstanding_prefers_idle_backend():
+    balancer = LoadBalancer("least_outstanding")
+    balancer.in_flight[(None, "b")] = 10
+    assert balancer.acquire(backends).path == "a"
+
+
+def test_power_of_two_choices():
+    balancer = LoadBalancer("p2c")
+    balancer.in_flight[(None, "a")] = 10
+    # With two backends, both are always sampled, so the less loaded one is used
+    for _ in range(10):
+        assert balancer.choose(backends)["path"] == "b"
+    single = [{"url": "http://other", "path": "c", "weight": 1}]
+    assert balancer.acquire(single).url == "http://other"
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        LoadBalancer("round_robin")
@@ -1,5 +1,9 @@
+import asyncio
+from datetime import datetime
+
 from pytest_mock_resources import create_mongo_fixture
-from logging_handler import LoggingHandler
+from pymongo import AsyncMongoClient
+from utils.logging_handler import AsyncLoggingHandler, LoggingHandler
 
 mongo = create_mongo_fixture()
 
@@ -40,3 +44,48 @@ def test_log_usage_for_user(mongo):
     first_log = log_collection.find_one({"model": "newModel"})
     second_log = log_collection.find_one({"tokencount": 70})
     assert first_log["timestamp"] <= second_log["timestamp"]
+
+
+def async_client(mongo):
+    # Async client for the database of the fixture
+    credentials = mongo.pmr_credentials
+    client = AsyncMongoClient(
+        credentials.host,
+        credentials.port,
+        username=credentials.username,
+        password=credentials.password,
+        authSource=credentials.database,
+    )
+    return client[credentials.database]
+
+
+def test_async_log_usage_for_key(mongo):
+    recorded = []
+
+    async def async_listener(tokencount, model, key, cachedtokens=0, isprompt=False):
+        recorded.append(("async", tokencount))
+
+    def listener(tokencount, model, key, cachedtokens=0, isprompt=False):
+        recorded.append(("sync", tokencount))
+
+    async def run():
+        handler = AsyncLoggingHandler(True)
+        handler.setup(async_client(mongo))
+        handler.add_usage_listener(async_listener)
+        handler.add_usage_listener(listener)
+        await handler.log_usage_for_key(50, "newModel", "123")
+        await handler.log_usage_for_key(70, "model2", "123", isprompt=True)
+        await handler.log_usage_for_user(30, "model2", "user")
+        assert await handler.get_usage_for_time_range(datetime.fromtimestamp(0)) == 150
+        assert (
+            await handler.get_usage_for_time_range(
+                datetime.fromtimestamp(0), model="newModel"
+            )
+            == 50
+        )
+
+    asyncio.run(run())
+    log_collection = mongo["gateway"]["logs"]
+    assert log_collection.count_documents({"sourcetype": "apikey"}) == 2
+    assert log_collection.count_documents({"sourcetype": "user"}) == 1
+    assert recorded == [("async", 50), ("sync", 50), ("async", 70), ("sync", 70)]
@@ -0,0 +1,68 @@
+import asyncio
+
+from pytest_mock_resources import create_redis_fixture
+from redis.asyncio import Redis as AsyncRedis
+from utils.rate_limiting import RateLimiter
+
+redis = create_redis_fixture()
+
+
+def async_redis(redis):
+    # Async client for the database of the fixture
+    credentials = redis.pmr_credentials
+    return AsyncRedis(
+        host=credentials.host, port=credentials.port, db=credentials.database
+    )
+
+
+def make_limiter(redis_client, requests_per_minute, tokens_per_minute):
+    limiter = RateLimiter(redis_client)
+    limiter.requests_per_minute = requests_per_minute
+    limiter.tokens_per_minute = tokens_per_minute
+    limiter.enabled = True
+    return limiter
+
+
+def test_request_limit(redis):
+    async def run():
+        client = async_redis(redis)
+        limiter = make_limiter(client, 2, 0)
+        first = await limiter.check_request("key")
+        assert first.allowed
+        assert first.headers()["x-ratelimit-limit-requests"] == "2"
+        assert first.headers()["x-ratelimit-remaining-requests"] == "1"
+        assert "x-ratelimit-limit-tokens" not in first.headers()
+        assert (await limiter.check_request("key")).allowed
+        rejected = await limiter.check_request("key")
+        assert not rejected.allowed
+        assert rejected.headers()["x-ratelimit-remaining-requests"] == "0"
+        assert 1 <= int(rejected.headers()["Retry-After"]) <= 30
+        # Limits are per key
+        assert (await limiter.check_request("other")).allowed
+        # Other workers share the limits
+        other_worker = async_redis(redis)
+        assert not (await make_limiter(other_worker, 2, 0).check_request("key")).allowed
+        await other_worker.aclose()
+        await client.aclose()
+
+    asyncio.run(run())
+
+
+def test_token_limit(redis):
+    async def run():
+        client = async_redis(redis)
+        limiter = make_limiter(client, 0, 100)
+        assert (await limiter.check_request("key")).allowed
+        await limiter.record_tokens(60, "model", "key")
+        result = await limiter.check_request("key")
+        assert result.allowed
+        assert result.headers()["x-ratelimit-remaining-tokens"] in ("40", "41")
+        # Tokens can exceed the limit, but further requests are rejected
+        await limiter.record_tokens(100, "model", "key")
+        rejected = await limiter.check_request("key")
+        assert not rejected.allowed
+        assert rejected.headers()["x-ratelimit-remaining-tokens"] == "0"
+        assert int(rejected.headers()["Retry-After"]) >= 30
+        await client.aclose()
+
+    asyncio.run(run())
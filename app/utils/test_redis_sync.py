@@ -0,0 +1,226 @@
+import time
+
+from bson import ObjectId, Timestamp
+from pytest_mock_resources import create_redis_fixture
+from pytest_mock_resources import create_mongo_fixture
+from utils.key_handler import KeyHandler
+from utils.model_handler import ModelHandler, gen_model_object
+from utils.redis_sync import RedisSync, LEADER_KEY, RESUME_TOKEN_KEY
+
+redis = create_redis_fixture()
+mongo = create_mongo_fixture()
+
+
+class NoConnections:
+    def inject(self, setup, *names):
+        pass
+
+
+class ModelSyncRecorder(ModelHandler):
+    def __init__(self):
+        super().__init__(connections=NoConnections())
+        self.syncs = 0
+
+    def init_models(self):
+        self.syncs += 1
+        super().init_models()
+
+
+def create_sync(redis, mongo):
+    key_handler = KeyHandler(True)
+    key_handler.setup(mongo, redis)
+    model_handler = ModelSyncRecorder()
+    model_handler.setup(mongo, redis)
+    return RedisSync(key_handler, model_handler)
+
+
+def test_init_keys_swaps_atomically(redis, mongo):
+    sync = create_sync(redis, mongo)
+    handler = sync.key_handler
+    handler.add_key("User", "Name", "ABC", priority="batch")
+    handler.key_collection.insert_one(
+        handler.build_new_key_object("User", "DEF", "Name", weight=0.5)
+    )
+    handler.init_keys()
+    assert redis.smembers("keys") == {b"ABC", b"DEF"}
+    assert redis.hgetall("key_priorities") == {b"ABC": b"batch"}
+    assert redis.hgetall("key_weights") == {b"DEF": b"0.5"}
+    key_id = handler.key_collection.find_one({"key": "ABC"})["_id"]
+    assert redis.hget("key_ids", str(key_id)) == b"ABC"
+    # No temporary keys are left
+    assert sorted(redis.keys("key*")) == [
+        b"key_ids",
+        b"key_priorities",
+        b"key_weights",
+        b"keys",
+    ]
+    # Nothing is written if the keys are up to date
+    generation = handler.key_cache.generation
+    handler.init_keys()
+    assert handler.key_cache.generation == generation
+
+
+def test_apply_changes(redis, mongo):
+    sync = create_sync(redis, mongo)
+    key_object = sync.key_handler.build_new_key_object("User", "ABC", "Name", "batch")
+    key_object["_id"] = ObjectId()
+    lag = sync.apply_change(
+        {
+            "ns": {"coll": "apikeys"},
+            "operationType": "insert",
+            "documentKey": {"_id": key_object["_id"]},
+            "fullDocument": key_object,
+            "clusterTime": Timestamp(int(time.time()) - 2, 1),
+        }
+    )
+    assert 1 <= lag <= 3
+    assert sync.key_handler.check_key("ABC") == True
+    assert redis.hget("key_priorities", "ABC") == b"batch"
+    key_object["active"] = False
+    sync.apply_change(
+        {
+            "ns": {"coll": "apikeys"},
+            "operationType": "update",
+            "documentKey": {"_id": key_object["_id"]},
+            "fullDocument": key_object,
+        }
+    )
+    assert sync.key_handler.check_key("ABC") == False
+    assert redis.hget("key_priorities", "ABC") == None
+    assert redis.hgetall("key_ids") == {}
+
+
+def test_apply_key_deletion(redis, mongo):
+    sync = create_sync(redis, mongo)
+    handler = sync.key_handler
+    handler.add_key("User", "Name", "ABC", priority="batch")
+    handler.add_key("User", "Name", "DEF")
+    handler.init_keys()
+    key_object = handler.key_collection.find_one_and_delete({"key": "ABC"})
+    sync.apply_change(
+        {
+            "ns": {"coll": "apikeys"},
+            "operationType": "delete",
+            "documentKey": {"_id": key_object["_id"]},
+        }
+    )
+    # Only the deleted key is removed
+    assert redis.smembers("keys") == {b"DEF"}
+    assert redis.hget("key_priorities", "ABC") == None
+    assert redis.hlen("key_ids") == 1
+    # Keys that were not active are not in redis
+    sync.apply_change(
+        {
+            "ns": {"coll": "apikeys"},
+            "operationType": "delete",
+            "documentKey": {"_id": ObjectId()},
+        }
+    )
+    assert redis.smembers("keys") == {b"DEF"}
+
+
+def test_apply_model_changes(redis, mongo):
+    sync = create_sync(redis, mongo)
+    handler = sync.model_handler
+    changes = []
+    handler.add_change_listener(changes.append)
+    handler.model_collection.insert_one(gen_model_object("other", "owner", "/other"))
+    handler.init_models()
+    assert handler.syncs == 1
+    document = gen_model_object("model", "owner", "/model")
+    document["_id"] = ObjectId()
+    sync.apply_change(
+        {
+            "ns": {"coll": "model"},
+            "operationType": "insert",
+            "documentKey": {"_id": document["_id"]},
+            "fullDocument": document,
+        }
+    )
+    assert handler.get_model_path("model") == "/model"
+    document["path"] = "/new"
+    sync.apply_change(
+        {
+            "ns": {"coll": "model"},
+            "operationType": "replace",
+            "documentKey": {"_id": document["_id"]},
+            "fullDocument": document,
+        }
+    )
+    assert handler.get_model_path("model") == "/new"
+    sync.apply_change(
+        {
+            "ns": {"coll": "model"},
+            "operationType": "delete",
+            "documentKey": {"_id": document["_id"]},
+        }
+    )
+    assert [model["id"] for model in handler.get_models()] == ["other"]
+    assert changes == ["model", "model", "model"]
+    # Only the changed entries were written
+    assert handler.syncs == 1
+    # The model of an unknown document is not known, all models are rebuilt
+    sync.apply_change(
+        {
+            "ns": {"coll": "model"},
+            "operationType": "delete",
+            "documentKey": {"_id": ObjectId()},
+        }
+    )
+    assert handler.syncs == 2
+
+
+def test_leader_lock(redis, mongo):
+    sync = create_sync(redis, mongo)
+    other = create_sync(redis, mongo)
+    assert sync.acquire_lock() == True
+    assert other.acquire_lock() == False
+    # The leader keeps the lock
+    assert sync.acquire_lock() == True
+    sync._update_lock(0)
+    assert other.acquire_lock() == True
+    assert redis.get(LEADER_KEY) == other.id.encode()
+
+
+class ChangeStream:
+    def __init__(self, resume_after):
+        self.resume_after = resume_after
+        self.resume_token = {"_data": "new"}
+        self.alive = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class Database:
+    def __init__(self):
+        self.streams = []
+
+    def watch(self, pipeline, resume_after=None, **kwargs):
+        self.streams.append(ChangeStream(resume_after))
+        return self.streams[-1]
+
+
+def test_resync_after_flush(redis, mongo):
+    sync = create_sync(redis, mongo)
+    sync.key_handler.add_key("User", "Name", "ABC")
+    database = Database()
+    sync.key_handler.db = database
+    sync.key_handler.init_keys()
+    redis.set("models", "{}")
+    redis.hset("model_ids", "id", "model")
+    redis.set(RESUME_TOKEN_KEY, "old")
+    # Redis is up to date, the stream is resumed
+    sync.watch()
+    assert database.streams[-1].resume_after == {"_data": "old"}
+    assert sync.model_handler.syncs == 0
+    # Redis was flushed, but kept the token
+    redis.delete("keys", "models")
+    sync.watch()
+    assert database.streams[-1].resume_after == None
+    assert sync.model_handler.syncs == 1
+    assert redis.smembers("keys") == {b"ABC"}
+    assert redis.get(RESUME_TOKEN_KEY) == b"new"
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import logging
+
+import pytest
+from fastapi import HTTPException
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel
+from starlette.datastructures import Headers
+
+from utils.load_balancing import LoadBalancer
+from utils.request_building import BodyHandler
+from utils.upstream_clients import UpstreamClientManager
+from utils.upstream_health import UpstreamHealth
+
+
+class Models:
+    async def get_model_backends(self, model):
+        if not model == "m1":
+            raise KeyError(model)
+        return [{"url": None, "path": "/m1", "weight": 1}]
+
+
+class ChatRequest(BaseModel):
+    model: str
+    messages: list[dict]
+
+
+def create_handler(monkeypatch, strict=False):
+    monkeypatch.setenv("INFERENCE_KEY", "inference")
+    monkeypatch.setenv("STRICT_REQUEST_VALIDATION", "1" if strict else "0")
+    return BodyHandler(
+        logging.getLogger("app"),
+        Models(),
+        UpstreamClientManager("http://upstream"),
+        LoadBalancer(),
+        UpstreamHealth(),
+    )
+
+
+def test_parse_request(monkeypatch):
+    handler = create_handler(monkeypatch)
+    body = b'{"model": "m1", "stream": true, "max_tokens": 5, "unknown": [1, 2]}'
+    # Not validated against the request model
+    request = handler.parse_request(body, ChatRequest)
+    assert request.model == "m1"
+    assert request.stream == True
+    assert request.max_tokens == 5
+    assert request.body is body
+    request = handler.parse_request(b'{"messages": []}')
+    assert request.model == None
+    assert request.stream == False
+    assert request.max_tokens == None
+
+
+def test_parse_request_strict(monkeypatch):
+    handler = create_handler(monkeypatch, strict=True)
+    body = b'{"model": "m1", "messages": [{"role": "user", "content": "hi"}]}'
+    assert handler.parse_request(body, ChatRequest).model == "m1"
+    with pytest.raises(RequestValidationError):
+        handler.parse_request(b'{"model": "m1"}', ChatRequest)
+
+
+def test_parse_invalid_request(monkeypatch):
+    handler = create_handler(monkeypatch)
+    for body, detail in (
+        (b'{"model": "m1",', "Request body is not valid JSON"),
+        (b"[1, 2]", "Request body must be an object"),
+        (b'{"model": 1}', "Invalid model or stream field"),
+        (b'{"model": "m1", "stream": "yes"}', "Invalid model or stream field"),
+    ):
+        with pytest.raises(HTTPException) as e:
+            handler.parse_request(body)
+        assert e.value.status_code == 422
+        assert e.value.detail == detail
+
+
+def test_build_request(monkeypatch):
+    handler = create_handler(monkeypatch)
+    body = b'{"model": "m1",  "messages": []}'
+    headers = Headers(
+        {
+            "cookie": "session=secret",
+            "authorization": "Bearer user-key",
+            "x-request-id": "abc",
+            "accept-encoding": "gzip",
+            "content-length": str(len(body)),
+        }
+    )
+
+    async def build(body):
+        return await handler.build_request(
+            handler.parse_request(body), headers, "/v1/chat/completions", "POST"
+        )
+
+    req, model, backend = asyncio.run(build(body))
+    assert model == "m1"
+    assert backend.key == (None, "/m1")
+    assert str(req.url) == "http://upstream/m1/v1/chat/completions"
+    # The raw bytes are forwarded, without parsing and serializing them again
+    assert req.content == body
+    assert "cookie" not in req.headers
+    assert req.headers["authorization"] == "Bearer inference"
+    assert req.headers["x-request-id"] == "abc"
+    assert req.headers["accept-encoding"] == "identity"
+    assert req.headers["content-type"] == "application/json"
+    assert req.headers["content-length"] == str(len(body))
+    backend.release()
+    # The url is only built once per model path and endpoint
+    assert handler.get_url("/m1", "/v1/chat/completions") is handler.get_url(
+        "/m1", "/v1/chat/completions"
+    )
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(build(b'{"model": "m2"}'))
+    assert e.value.status_code == 400
+
+
+def test_request_stream_usage(monkeypatch):
+    handler = create_handler(monkeypatch)
+    for body, expected in (
+        (b"{}", {"stream_options": {"include_usage": True}}),
+        (b" { } ", {"stream_options": {"include_usage": True}}),
+        (
+            b'{"model": "m1", "stream": true}',
+            {"model": "m1", "stream": True, "stream_options": {"include_usage": True}},
+        ),
+        (
+            b'{"model": "m1", "stream_options": {"other": 1}}',
+            {"model": "m1", "stream_options": {"other": 1, "include_usage": True}},
+        ),
+        (
+            b'{"model": "m1", "stream_options": null}',
+            {"model": "m1", "stream_options": {"include_usage": True}},
+        ),
+    ):
+        request = handler.parse_request(body)
+        request.request_stream_usage()
+        assert json.loads(request.body) == expected
+        # The usage was not requested by the client
+        assert request.strip_usage == True
+    # Without stream_options, the option is added to the raw bytes
+    request = handler.parse_request(b'{"model": "m1",  "stream": true}')
+    request.request_stream_usage()
+    assert request.body == (
+        b'{"stream_options":{"include_usage":true},"model": "m1",  "stream": true}'
+    )
+    body = b'{"model": "m1", "stream_options": {"include_usage": true}}'
+    request = handler.parse_request(body)
+    request.request_stream_usage()
+    assert request.body is body
+    assert request.strip_usage == False
@@ -0,0 +1,125 @@
+import asyncio
+import threading
+from functools import partial
+
+from pytest_mock_resources import create_redis_fixture
+from redis.asyncio import Redis as AsyncRedis
+from utils.response_cache import LRUCache, ResponseCache
+from utils.metrics import Metrics
+from utils.model_handler import AsyncModelHandler, ModelHandler
+
+redis = create_redis_fixture()
+
+
+def async_redis(redis):
+    # Async client for the database of the fixture
+    credentials = redis.pmr_credentials
+    return AsyncRedis(
+        host=credentials.host, port=credentials.port, db=credentials.database
+    )
+
+
+def test_lru_cache_bounds():
+    cache = LRUCache(max_entries=2, max_bytes=10)
+    cache.set("a", b"1234")
+    cache.set("b", b"1234")
+    assert cache.get("a") == b"1234"
+    # evicts b, the least recently used entry
+    cache.set("c", b"12")
+    assert cache.get("b") == None
+    assert cache.get("a") == b"1234"
+    # evicts entries until the size fits
+    cache.set("d", b"12345678")
+    assert cache.get("a") == None
+    assert cache.size <= 10
+    # too large values are not cached at all
+    cache.set("e", b"12345678901")
+    assert cache.get("e") == None
+    cache.delete_prefix("d")
+    assert cache.get("d") == None
+
+
+def test_response_cache_invalidation(redis):
+    async def run():
+        metrics = Metrics()
+        cache = ResponseCache(async_redis(redis), metrics)
+        await cache.set("model", "key", b"data")
+        await cache.set("other", "key", b"other")
+        assert await cache.get("model", "key") == b"data"
+        await cache.invalidate_model("model")
+        assert await cache.get("model", "key") == None
+        assert await cache.get("other", "key") == b"other"
+        # a second worker shares the redis tier
+        second_cache = ResponseCache(async_redis(redis), metrics)
+        assert await second_cache.get("other", "key") == b"other"
+        assert metrics.get("response_cache_hits") == 3
+        assert metrics.get("response_cache_misses") == 1
+
+    asyncio.run(run())
+
+
+def test_generation_is_kept_locally(redis):
+    async def run():
+        cache = ResponseCache(async_redis(redis), Metrics())
+        other_worker = ResponseCache(async_redis(redis), Metrics())
+        await cache.set("model", "key", b"data")
+        assert await other_worker.get("model", "key") == b"data"
+        await cache.invalidate_model("model")
+        assert await cache.get("model", "key") == None
+        # The other worker reads the generation from redis once it is stale
+        assert await other_worker.get("model", "key") == b"data"
+        other_worker.generation_ttl = 0
+        assert await other_worker.get("model", "key") == None
+
+    asyncio.run(run())
+
+
+def test_record_stream(redis, monkeypatch):
+    monkeypatch.setenv("RESPONSE_CACHE_MAX_ENTRY_BYTES", "8")
+
+    async def stream(chunks):
+        for chunk in chunks:
+            yield chunk
+
+    async def run():
+        cache = ResponseCache(async_redis(redis), Metrics())
+        received = [
+            chunk
+            async for chunk in cache.record_stream(stream([b"abc", b"def"]), "m", "k")
+        ]
+        assert received == [b"abc", b"def"]
+        assert await cache.get("m", "k") == b"abcdef"
+        # Too large streams are passed through, but not cached
+        chunks = [b"abcd", b"efgh", b"i"]
+        received = [
+            chunk async for chunk in cache.record_stream(stream(chunks), "m", "l")
+        ]
+        assert received == chunks
+        assert await cache.get("m", "l") == None
+
+    asyncio.run(run())
+
+
+class NoConnections:
+    def inject(self, setup, *names):
+        pass
+
+
+def test_model_change_invalidates(redis):
+    async def run():
+        cache = ResponseCache(async_redis(redis), Metrics())
+        async_handler = AsyncModelHandler(True)
+        async_handler.add_change_listener(cache.invalidate_model)
+        handler = ModelHandler(connections=NoConnections())
+        handler.add_change_listener(partial(cache.invalidate_model_sync, redis))
+        await cache.set("model", "key", b"data")
+        await async_handler.notify_change("model")
+        assert await cache.get("model", "key") == None
+        # The sync handler is used from threads that anyio does not know about
+        await cache.set("model", "key", b"data")
+        thread = threading.Thread(target=handler.notify_change, args=["model"])
+        thread.start()
+        thread.join()
+        assert await cache.get("model", "key") == None
+
+    asyncio.run(run())
@@ -0,0 +1,386 @@
+import asyncio
+import json
+
+import anyio
+import pytest
+
+from utils import response_handling
+from utils.response_handling import (
+    AppStatus,
+    LoggingStreamResponse,
+    SendTimeoutError,
+    heartbeat_scheduler,
+)
+from utils.stream_logger import StreamLogger
+from utils.metrics import Metrics
+
+
+class UsageRecorder:
+    def __init__(self):
+        self.entries = []
+
+    def log_usage_for_key(self, tokencount, model, key, isprompt=False):
+        self.entries.append((tokencount, isprompt))
+
+
+async def upstream(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def create_response(chunks, recorder, send_timeout=None):
+    return LoggingStreamResponse(
+        content=upstream(chunks),
+        send_timeout=send_timeout,
+        streamlogger=StreamLogger(recorder, "key", True, "model"),
+    )
+
+
+def test_stream_forwards_bytes():
+    chunks = [b'data: {"choices":[{"index":0}]}\r\n', b"\r\n", b"data: [DONE]\r\n\r\n"]
+    recorder = UsageRecorder()
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(create_response(chunks, recorder).stream_response(send))
+    bodies = [message["body"] for message in sent[1:-1]]
+    assert bodies == chunks
+    assert all(body is chunk for body, chunk in zip(bodies, chunks))
+    assert sent[-1]["more_body"] == False
+    assert recorder.entries == [(1, False)]
+
+
+def test_stream_send_timeout():
+    chunks = [b'data: {"choices":[{"index":0}]}\r\n\r\n'] * 3
+    recorder = UsageRecorder()
+    sent = []
+
+    async def send(message):
+        if len(sent) == 2:
+            # The client stops reading
+            await anyio.sleep(1)
+        sent.append(message)
+
+    with pytest.raises(SendTimeoutError):
+        asyncio.run(
+            create_response(chunks, recorder, send_timeout=0.05).stream_response(send)
+        )
+    assert len(sent) == 2
+
+
+def test_stream_slow_upstream():
+    # Only sending is limited by the timeout, not waiting for the upstream
+    async def slow_upstream():
+        for _ in range(3):
+            await anyio.sleep(0.05)
+            yield b'data: {"choices":[{"index":0}]}\r\n\r\n'
+
+    recorder = UsageRecorder()
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    response = LoggingStreamResponse(
+        content=slow_upstream(),
+        send_timeout=0.02,
+        streamlogger=StreamLogger(recorder, "key", True, "model"),
+    )
+    asyncio.run(response.stream_response(send))
+    assert len(sent) == 5
+    assert recorder.entries == [(3, False)]
+
+
+def test_heartbeat_pings_idle_streams(monkeypatch):
+    monkeypatch.setattr(heartbeat_scheduler, "TICK", 0.01)
+
+    async def idle_upstream():
+        yield b'data: {"choices":[{"index":0}]}\r\n\r\n'
+        await anyio.sleep(0.2)
+
+    async def busy_upstream():
+        for _ in range(20):
+            await anyio.sleep(0.01)
+            yield b'data: {"choices":[{"index":0}]}\r\n\r\n'
+
+    async def receive():
+        await anyio.sleep_forever()
+
+    async def run():
+        sent = {"idle": [], "busy": []}
+        async with anyio.create_task_group() as task_group:
+            for name, content in (("idle", idle_upstream()), ("busy", busy_upstream())):
+                response = LoggingStreamResponse(
+                    content=content,
+                    ping=0.05,
+                    streamlogger=StreamLogger(UsageRecorder(), "key", True, "model"),
+                )
+
+                async def send(message, name=name):
+                    sent[name].append(message.get("body"))
+
+                task_group.start_soon(response, {}, receive, send)
+        assert len(heartbeat_scheduler.streams) == 0
+        return sent
+
+    sent = asyncio.run(run())
+    assert sent["idle"].count(b": ping\r\n\r\n") >= 2
+    assert b": ping\r\n\r\n" not in sent["busy"]
+
+
+def test_heartbeat_ends_streams_on_exit(monkeypatch):
+    monkeypatch.setattr(heartbeat_scheduler, "TICK", 0.01)
+    monkeypatch.setattr(AppStatus, "should_exit", False)
+
+    async def endless_upstream():
+        while True:
+            await anyio.sleep(0.01)
+            yield b'data: {"choices":[{"index":0}]}\r\n\r\n'
+
+    async def receive():
+        await anyio.sleep_forever()
+
+    async def send(message):
+        pass
+
+    async def run():
+        response = LoggingStreamResponse(
+            content=endless_upstream(),
+            streamlogger=StreamLogger(UsageRecorder(), "key", True, "model"),
+        )
+        with anyio.fail_after(1):
+            async with anyio.create_task_group() as task_group:
+                task_group.start_soon(response, {}, receive, send)
+                await anyio.sleep(0.05)
+                AppStatus.should_exit = True
+        return response
+
+    response = asyncio.run(run())
+    assert response.chunks_sent > 0
+
+
+def test_stream_coalescing():
+    event = b'data: {"choices":[{"index":0}]}\r\n\r\n'
+    stream = event * 10 + b"data: [DONE]\r\n\r\n"
+
+    async def fast_upstream():
+        # Events are split over chunks
+        for i in range(0, len(stream), 20):
+            await anyio.sleep(0.001)
+            yield stream[i : i + 20]
+
+    recorder = UsageRecorder()
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    response = LoggingStreamResponse(
+        content=fast_upstream(),
+        coalesce_window=0.5,
+        streamlogger=StreamLogger(recorder, "key", True, "model"),
+    )
+    asyncio.run(response.stream_response(send))
+    bodies = [message["body"] for message in sent[1:-1]]
+    # The first event is sent as soon as it is complete, the rest together
+    assert bodies == [event, event * 9 + b"data: [DONE]\r\n\r\n"]
+    assert recorder.entries == [(10, False)]
+
+
+def test_stream_coalescing_max_bytes():
+    event = b'data: {"choices":[{"index":0}]}\r\n\r\n'
+
+    async def fast_upstream():
+        for _ in range(10):
+            yield event
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    response = LoggingStreamResponse(
+        content=fast_upstream(),
+        coalesce_window=0.5,
+        coalesce_bytes=len(event) * 3,
+        streamlogger=StreamLogger(UsageRecorder(), "key", True, "model"),
+    )
+    asyncio.run(response.stream_response(send))
+    bodies = [message["body"] for message in sent[1:-1]]
+    assert bodies == [event, event * 3, event * 3, event * 3]
+
+
+def test_stream_disconnect_logs_usage():
+    async def endless_upstream():
+        while True:
+            await anyio.sleep(0.01)
+            yield b'data: {"choices":[{"index":0}]}\r\n\r\n'
+
+    async def receive():
+        await anyio.sleep(0.055)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        pass
+
+    recorder = UsageRecorder()
+    response = create_response([], recorder)
+    response.body_iterator = endless_upstream()
+    asyncio.run(response({}, receive, send))
+    # The tokens streamed until the client disconnected
+    assert len(recorder.entries) == 1
+    assert recorder.entries[0][0] == response.chunks_sent > 0
+
+
+def run_watchdog(upstream, **kwargs):
+    recorder = UsageRecorder()
+    metrics = Metrics()
+    sent = []
+
+    async def send(message):
+        sent.append(message.get("body"))
+
+    response = LoggingStreamResponse(
+        content=upstream(),
+        streamlogger=StreamLogger(recorder, "key", True, "model"),
+        metrics=metrics,
+        **kwargs,
+    )
+    asyncio.run(response.stream_response(send))
+    return sent[1:-1], recorder.entries, metrics
+
+
+def error_code(event: bytes) -> str:
+    assert event.startswith(b"data: ")
+    return json.loads(event[6:])["error"]["code"]
+
+
+def test_watchdog_stalled_stream():
+    event = b'data: {"choices":[{"index":0}]}\r\n\r\n'
+
+    async def stalling_upstream():
+        yield event
+        yield event
+        await anyio.sleep(10)
+        yield event
+
+    for coalesce_window in (0, 0.01):
+        bodies, entries, metrics = run_watchdog(
+            stalling_upstream, idle_timeout=0.05, coalesce_window=coalesce_window
+        )
+        assert b"".join(bodies[:-1]) == event * 2
+        assert error_code(bodies[-1]) == "stalled"
+        assert entries == [(2, False)]
+        assert metrics.get("streams_aborted_stalled") == 1
+
+
+def test_watchdog_max_tokens():
+    event = b'data: {"choices":[{"index":0}]}\r\n\r\n'
+
+    async def runaway_upstream():
+        while True:
+            yield event
+
+    for coalesce_window in (0, 0.01):
+        bodies, entries, metrics = run_watchdog(
+            runaway_upstream, max_tokens=5, coalesce_window=coalesce_window
+        )
+        assert b"".join(bodies[:-1]) == event * 5
+        assert error_code(bodies[-1]) == "max_tokens"
+        assert entries == [(6, False)]
+        assert metrics.get("streams_aborted_max_tokens") == 1
+
+
+def test_watchdog_max_bytes():
+    event = b'data: {"choices":[{"index":0}]}\r\n\r\n'
+
+    async def runaway_upstream():
+        while True:
+            yield event
+
+    bodies, _, metrics = run_watchdog(runaway_upstream, max_bytes=len(event) * 3)
+    assert b"".join(bodies[:-1]) == event * 3
+    assert error_code(bodies[-1]) == "max_bytes"
+    assert metrics.get("streams_aborted_max_bytes") == 1
+
+
+def test_drain_waits_for_streams(monkeypatch):
+    exits = []
+    monkeypatch.setattr(response_handling, "original_handler", exits.append)
+    monkeypatch.setattr(AppStatus, "should_exit", False)
+    monkeypatch.setattr(AppStatus, "draining", False)
+    monkeypatch.setattr(AppStatus, "drain_timeout", 1)
+    monkeypatch.setattr(AppStatus, "DRAIN_POLL_INTERVAL", 0.01)
+
+    async def upstream():
+        for _ in range(5):
+            await anyio.sleep(0.02)
+            yield b'data: {"choices":[{"index":0}]}\r\n\r\n'
+
+    async def receive():
+        await anyio.sleep_forever()
+
+    async def send(message):
+        pass
+
+    async def run():
+        response = LoggingStreamResponse(
+            content=upstream(),
+            streamlogger=StreamLogger(UsageRecorder(), "key", True, "model"),
+        )
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(response, {}, receive, send)
+            await anyio.sleep(0.01)
+            AppStatus.handle_exit("signal")
+            await anyio.sleep(0.01)
+            # Not ready any more, but the stream is not cut
+            assert AppStatus.draining and not AppStatus.should_exit
+            assert exits == []
+        await AppStatus._drain_task
+        return response
+
+    response = asyncio.run(run())
+    assert response.chunks_sent == 5
+    assert AppStatus.should_exit
+    assert exits == ["signal"]
+
+
+def test_drain_timeout(monkeypatch):
+    exits = []
+    monkeypatch.setattr(response_handling, "original_handler", exits.append)
+    monkeypatch.setattr(heartbeat_scheduler, "TICK", 0.01)
+    monkeypatch.setattr(AppStatus, "should_exit", False)
+    monkeypatch.setattr(AppStatus, "draining", False)
+    monkeypatch.setattr(AppStatus, "drain_timeout", 0.1)
+    monkeypatch.setattr(AppStatus, "DRAIN_POLL_INTERVAL", 0.01)
+
+    async def endless_upstream():
+        while True:
+            await anyio.sleep(0.01)
+            yield b'data: {"choices":[{"index":0}]}\r\n\r\n'
+
+    async def receive():
+        await anyio.sleep_forever()
+
+    async def send(message):
+        pass
+
+    recorder = UsageRecorder()
+
+    async def run():
+        response = LoggingStreamResponse(
+            content=endless_upstream(),
+            streamlogger=StreamLogger(recorder, "key", True, "model"),
+        )
+        with anyio.fail_after(1):
+            async with anyio.create_task_group() as task_group:
+                task_group.start_soon(response, {}, receive, send)
+                await anyio.sleep(0.01)
+                AppStatus.handle_exit("signal")
+
+    asyncio.run(run())
+    # The stream was ended after the grace period and its usage logged
+    assert exits == ["signal"]
+    assert len(recorder.entries) == 1
@@ -0,0 +1,62 @@
+import asyncio
+
+from utils.single_flight import SingleFlight
+
+
+def test_identical_calls_are_shared():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def run():
+        flight = SingleFlight()
+        results = await asyncio.gather(*[flight.do("key", fetch) for _ in range(10)])
+        other = await flight.do("other", fetch)
+        return results, other, flight.in_flight()
+
+    results, other, in_flight = asyncio.run(run())
+    assert results == ["result"] * 10
+    assert other == "result"
+    assert len(calls) == 2
+    assert in_flight == 0
+
+
+def test_call_survives_single_cancellation():
+    async def fetch():
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def run():
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight.do("key", fetch))
+        second = asyncio.ensure_future(flight.do("key", fetch))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == "result"
+
+
+def test_call_cancelled_without_waiters():
+    cancelled = []
+
+    async def fetch():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def run():
+        flight = SingleFlight()
+        waiter = asyncio.ensure_future(flight.do("key", fetch))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+        return flight.in_flight()
+
+    assert asyncio.run(run()) == 0
+    assert cancelled == [1]
@@ -0,0 +1,63 @@
+import json
+from utils.sse_parsing import SSEParser, count_choices
+
+
+def make_stream(n, sep=b"\n"):
+    events = [
+        b"data: "
+        + json.dumps(
+            {
+                "id": "cmpl",
+                "object": "chat.completion.chunk",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": f'tok"en\\n{i}'},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+        ).encode()
+        + sep
+        + sep
+        for i in range(n)
+    ]
+    return b"".join(events) + b"data: [DONE]" + sep + sep
+
+
+def parse(stream, chunk_size):
+    parser = SSEParser()
+    events = []
+    for start in range(0, len(stream), chunk_size):
+        events.extend(parser.feed(stream[start : start + chunk_size]))
+    events.extend(parser.flush())
+    return events
+
+
+def test_arbitrary_chunk_boundaries():
+    for sep in (b"\n", b"\r\n", b"\r"):
+        stream = make_stream(5, sep)
+        expected = parse(stream, len(stream))
+        assert len(expected) == 6
+        assert expected[-1] == b"[DONE]"
+        assert json.loads(expected[2])["choices"][0]["delta"]["content"] == 'tok"en\\n2'
+        for chunk_size in (1, 2, 3, 7, 64):
+            assert parse(stream, chunk_size) == expected
+
+
+def test_event_fields():
+    stream = (
+        b": ping\r\n\r\nevent: message\nid: 1\ndata:a\ndata: b\n\ndata: unterminated"
+    )
+    assert parse(stream, 5) == [b"a\nb", b"unterminated"]
+
+
+def test_count_choices():
+    assert count_choices(b"[DONE]") == 0
+    assert count_choices(b'{"choices": [{"index": 0, "delta": {}}]}') == 1
+    assert count_choices(b'{"choices":[ ],"usage":{"completion_tokens":3}}') == 0
+    two = {"choices": [{"index": 0, "delta": {}}, {"index": 1, "delta": {}}]}
+    assert count_choices(json.dumps(two).encode()) == 2
+    # Quotes in the content are escaped and not mistaken for keys
+    content = {"choices": [{"index": 0, "delta": {"content": '"choices": []'}}]}
+    assert count_choices(json.dumps(content).encode()) == 1
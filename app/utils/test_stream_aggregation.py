@@ -0,0 +1,116 @@
+import json
+
+from utils.stream_aggregation import StreamAggregator
+
+
+def chat_event(delta, finish_reason=None, index=0):
+    return json.dumps(
+        {
+            "id": "chatcmpl-1",
+            "object": "chat.completion.chunk",
+            "created": 1718000000,
+            "model": "m1",
+            "choices": [
+                {
+                    "index": index,
+                    "delta": delta,
+                    "logprobs": None,
+                    "finish_reason": finish_reason,
+                }
+            ],
+        }
+    ).encode()
+
+
+def test_aggregate_chat_completion():
+    aggregator = StreamAggregator()
+    for data in (
+        chat_event({"role": "assistant"}),
+        chat_event({"content": "Hello"}),
+        chat_event({"content": " world"}),
+        chat_event({"content": "!"}, index=1),
+        chat_event({}, finish_reason="stop"),
+        json.dumps(
+            {
+                "id": "chatcmpl-1",
+                "object": "chat.completion.chunk",
+                "choices": [],
+                "usage": {"prompt_tokens": 3, "completion_tokens": 3},
+            }
+        ).encode(),
+        b"[DONE]",
+    ):
+        aggregator.handle_event(data)
+    result = aggregator.result()
+    assert result["object"] == "chat.completion"
+    assert result["id"] == "chatcmpl-1"
+    assert result["model"] == "m1"
+    assert result["usage"] == {"prompt_tokens": 3, "completion_tokens": 3}
+    assert result["choices"] == [
+        {
+            "index": 0,
+            "logprobs": None,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": "Hello world"},
+        },
+        {
+            "index": 1,
+            "logprobs": None,
+            "finish_reason": None,
+            "message": {"role": "assistant", "content": "!"},
+        },
+    ]
+
+
+def test_aggregate_tool_calls():
+    aggregator = StreamAggregator()
+    for delta in (
+        {"tool_calls": [{"index": 0, "id": "call_1", "function": {"name": "get"}}]},
+        {"tool_calls": [{"index": 0, "function": {"arguments": '{"a":'}}]},
+        {"tool_calls": [{"index": 0, "function": {"arguments": " 1}"}}]},
+    ):
+        aggregator.handle_event(chat_event(delta))
+    message = aggregator.result()["choices"][0]["message"]
+    assert message["content"] is None
+    assert message["tool_calls"] == [
+        {
+            "id": "call_1",
+            "type": "function",
+            "function": {"name": "get", "arguments": '{"a": 1}'},
+        }
+    ]
+
+
+def test_aggregate_text_completion():
+    aggregator = StreamAggregator()
+    for text, tokens in (("Hello", ["Hello"]), (" world", [" world"])):
+        aggregator.handle_event(
+            json.dumps(
+                {
+                    "id": "cmpl-1",
+                    "object": "text_completion",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "text": text,
+                            "logprobs": {"tokens": tokens, "token_logprobs": [-0.5]},
+                            "finish_reason": None,
+                        }
+                    ],
+                }
+            ).encode()
+        )
+    result = aggregator.result()
+    assert result["object"] == "text_completion"
+    assert result["choices"][0]["text"] == "Hello world"
+    assert result["choices"][0]["logprobs"] == {
+        "tokens": ["Hello", " world"],
+        "token_logprobs": [-0.5, -0.5],
+    }
+
+
+def test_aggregate_error():
+    aggregator = StreamAggregator()
+    aggregator.handle_event(chat_event({"content": "Hello"}))
+    aggregator.handle_event(b'{"error": {"message": "out of memory"}}')
+    assert aggregator.error == {"error": {"message": "out of memory"}}
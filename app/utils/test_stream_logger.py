@@ -0,0 +1,175 @@
+import asyncio
+import json
+import logging
+import httpx
+from starlette.datastructures import Headers
+
+from utils.stream_logger import StreamLogger
+from utils.sse_parsing import strip_usage_events
+from utils.load_balancing import LoadBalancer
+from utils.request_building import BodyHandler
+from utils.response_handling import LoggingStreamResponse
+from utils.upstream_clients import UpstreamClientManager
+from utils.upstream_health import UpstreamHealth
+
+
+class UsageRecorder:
+    def __init__(self):
+        self.entries = []
+
+    def log_usage_for_key(self, tokencount, model, key, isprompt=False):
+        self.entries.append((tokencount, isprompt))
+
+
+class Models:
+    async def get_model_backends(self, model):
+        return [{"url": None, "path": "/m1", "weight": 1}]
+
+
+def chunk_event(content, usage=None, choices=1):
+    data = {
+        "object": "chat.completion.chunk",
+        "choices": [
+            {"index": i, "delta": {"content": content}, "finish_reason": None}
+            for i in range(choices)
+        ],
+    }
+    if usage is not None:
+        data = {"object": "chat.completion.chunk", "choices": [], "usage": usage}
+    return b"data: " + json.dumps(data).encode() + b"\r\n\r\n"
+
+
+def mock_response(events, chunk_size=4096):
+    """
+    A streaming response that sends the events in chunks of chunk_size bytes.
+    """
+    stream = b"".join(events) + b"data: [DONE]\r\n\r\n"
+
+    async def body():
+        for start in range(0, len(stream), chunk_size):
+            yield stream[start : start + chunk_size]
+
+    return httpx.Response(
+        200, headers={"content-type": "text/event-stream"}, content=body()
+    )
+
+
+def mock_upstream(events, chunk_size):
+    return httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda request: mock_response(events, chunk_size))
+    )
+
+
+def run_stream(events, chunk_size, strip):
+    async def run():
+        recorder = UsageRecorder()
+        logger = StreamLogger(recorder, "key", True, "model")
+        received = b""
+        async with mock_upstream(events, chunk_size) as client:
+            async with client.stream("POST", "http://upstream/v1/chat") as r:
+                content = r.aiter_raw()
+                if strip:
+                    content = strip_usage_events(content, logger.handle_chunk)
+                async for chunk in content:
+                    # What LoggingStreamResponse does with each chunk
+                    logger.handle_chunk(chunk)
+                    received += chunk
+        await logger.finish()
+        return received, recorder.entries
+
+    return asyncio.run(run())
+
+
+def test_usage_from_final_event():
+    # Chunks with multiple tokens make counting choices wrong
+    events = [chunk_event("Hello there"), chunk_event(" world", choices=2)]
+    events.append(chunk_event(None, usage={"prompt_tokens": 7, "completion_tokens": 5}))
+    for chunk_size in (1, 13, 4096):
+        received, entries = run_stream(events, chunk_size, strip=True)
+        assert b'"usage"' not in received
+        assert received.endswith(b"data: [DONE]\r\n\r\n")
+        assert received.count(b"data:") == 3
+        assert entries == [(5, False), (7, True)]
+        # The usage is passed on if the client asked for it
+        received, entries = run_stream(events, chunk_size, strip=False)
+        assert b'"prompt_tokens": 7' in received
+        assert entries == [(5, False), (7, True)]
+
+
+def test_counting_fallback():
+    events = [chunk_event("a"), chunk_event("b"), chunk_event("c", choices=2)]
+    received, entries = run_stream(events, 10, strip=True)
+    assert received.count(b"data:") == 4
+    assert entries == [(4, False)]
+
+
+def run_gateway_stream(body: bytes, monkeypatch):
+    """
+    Send a streaming request through the request building, a mock upstream
+    and the stream response, the way the llm router does.
+    """
+    monkeypatch.setenv("INFERENCE_KEY", "inference")
+    upstream_bodies = []
+
+    def handler(request):
+        # Like an OpenAI compatible server, the usage is only sent if requested
+        data = json.loads(request.content)
+        upstream_bodies.append(data)
+        events = [chunk_event("Hello there"), chunk_event(" world")]
+        if (data.get("stream_options") or {}).get("include_usage"):
+            events.append(
+                chunk_event(None, usage={"prompt_tokens": 7, "completion_tokens": 3})
+            )
+        return mock_response(events)
+
+    clients = UpstreamClientManager("http://upstream")
+    clients.clients["http://upstream"] = httpx.AsyncClient(
+        base_url="http://upstream", transport=httpx.MockTransport(handler)
+    )
+    builder = BodyHandler(
+        logging.getLogger("app"), Models(), clients, LoadBalancer(), UpstreamHealth()
+    )
+    recorder = UsageRecorder()
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    async def run():
+        request = builder.parse_request(body)
+        request.request_stream_usage()
+        req, model, backend = await builder.build_request(
+            request, Headers({}), "/v1/chat/completions", "POST"
+        )
+        r = await backend.client.send(req, stream=True)
+        logger = StreamLogger(recorder, "key", True, model)
+        content = r.aiter_raw()
+        if request.strip_usage:
+            content = strip_usage_events(content, logger.handle_chunk)
+        response = LoggingStreamResponse(content=content, streamlogger=logger)
+        await response.stream_response(send)
+        await r.aclose()
+        backend.release()
+
+    asyncio.run(run())
+    received = b"".join(message.get("body", b"") for message in sent[1:])
+    return upstream_bodies[0], received, recorder.entries
+
+
+def test_gateway_stream_usage(monkeypatch):
+    # The client did not ask for the usage, it is requested and stripped by the gateway
+    upstream_body, received, entries = run_gateway_stream(
+        b'{"model": "m1", "stream": true, "messages": []}', monkeypatch
+    )
+    assert upstream_body["stream_options"] == {"include_usage": True}
+    assert b'"usage"' not in received
+    assert received.count(b"data:") == 3
+    # Logged from the usage event, not by counting the events
+    assert entries == [(3, False), (7, True)]
+    # The client asked for the usage, it is passed on
+    upstream_body, received, entries = run_gateway_stream(
+        b'{"model": "m1", "stream": true, "stream_options": {"include_usage": true}}',
+        monkeypatch,
+    )
+    assert b'"prompt_tokens": 7' in received
+    assert entries == [(3, False), (7, True)]
@@ -0,0 +1,121 @@
+import asyncio
+
+import httpx
+
+from utils.upstream_clients import UpstreamClientManager
+
+
+def mock_client(base_url, requests, fail=False):
+    def handler(request):
+        requests.append((request.method, str(request.url)))
+        if fail:
+            raise httpx.ConnectError("Connection refused", request=request)
+        return httpx.Response(404)
+
+    return httpx.AsyncClient(base_url=base_url, transport=httpx.MockTransport(handler))
+
+
+def test_defaults(monkeypatch):
+    monkeypatch.setenv("LLM_BASE_URL", "http://upstream")
+    manager = UpstreamClientManager()
+    assert manager.default_url == "http://upstream"
+    assert manager.limits == httpx.Limits(
+        max_connections=512, max_keepalive_connections=128, keepalive_expiry=60.0
+    )
+    assert manager.timeout == httpx.Timeout(300.0, connect=10.0, pool=30.0)
+    assert manager.http2 == False
+    assert manager.warmup_connections == 4
+    assert manager.warmup_path == "/"
+
+
+def test_environment(monkeypatch):
+    monkeypatch.setenv("UPSTREAM_MAX_CONNECTIONS", "16")
+    monkeypatch.setenv("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "8")
+    monkeypatch.setenv("UPSTREAM_KEEPALIVE_EXPIRY", "5.5")
+    monkeypatch.setenv("UPSTREAM_TIMEOUT", "20")
+    monkeypatch.setenv("UPSTREAM_CONNECT_TIMEOUT", "2")
+    monkeypatch.setenv("UPSTREAM_POOL_TIMEOUT", "3")
+    monkeypatch.setenv("UPSTREAM_HTTP2", "1")
+    monkeypatch.setenv("UPSTREAM_WARMUP_CONNECTIONS", "2")
+    monkeypatch.setenv("UPSTREAM_WARMUP_PATH", "/health")
+    manager = UpstreamClientManager("http://upstream")
+    assert manager.limits == httpx.Limits(
+        max_connections=16, max_keepalive_connections=8, keepalive_expiry=5.5
+    )
+    assert manager.timeout == httpx.Timeout(20.0, connect=2.0, pool=3.0)
+    assert manager.http2 == True
+    assert manager.warmup_connections == 2
+    assert manager.warmup_path == "/health"
+    # The clients are created with the configured pool
+    client = manager.get_client()
+    assert client.timeout == manager.timeout
+    assert client is manager.get_client("http://upstream")
+    assert client is not manager.get_client("http://other")
+    asyncio.run(manager.aclose())
+
+
+def test_http2_fallback(monkeypatch):
+    monkeypatch.setenv("UPSTREAM_HTTP2", "1")
+    created = []
+
+    class AsyncClient(httpx.AsyncClient):
+        def __init__(self, http2=False, **kwargs):
+            if http2:
+                # What httpx does if h2 is not installed
+                raise ImportError(
+                    "Using http2=True, but the 'h2' package is not installed"
+                )
+            created.append(kwargs["base_url"])
+            super().__init__(**kwargs)
+
+    monkeypatch.setattr(httpx, "AsyncClient", AsyncClient)
+    manager = UpstreamClientManager("http://upstream")
+    client = manager.get_client()
+    assert created == ["http://upstream"]
+    assert manager.http2 == False
+    assert manager.get_client("http://other") is not client
+    assert created == ["http://upstream", "http://other"]
+    asyncio.run(manager.aclose())
+
+
+def test_warmup(monkeypatch):
+    monkeypatch.setenv("UPSTREAM_WARMUP_CONNECTIONS", "3")
+    monkeypatch.setenv("UPSTREAM_WARMUP_PATH", "/health")
+    manager = UpstreamClientManager("http://upstream")
+    requests = []
+    manager.clients["http://upstream"] = mock_client("http://upstream", requests)
+    manager.clients["http://other"] = mock_client("http://other", requests)
+    asyncio.run(manager.start())
+    # The status of the answer does not matter
+    assert requests == [("HEAD", "http://upstream/health")] * 3
+    requests.clear()
+    asyncio.run(manager.start(["http://upstream", "http://other"]))
+    assert (
+        sorted(requests)
+        == [("HEAD", "http://other/health")] * 3
+        + [("HEAD", "http://upstream/health")] * 3
+    )
+
+
+def test_warmup_failure(monkeypatch):
+    manager = UpstreamClientManager("http://upstream")
+    requests = []
+    manager.clients["http://upstream"] = mock_client(
+        "http://upstream", requests, fail=True
+    )
+    # An unreachable upstream does not prevent the start
+    asyncio.run(manager.warmup())
+    assert len(requests) == 4
+
+
+def test_aclose():
+    manager = UpstreamClientManager("http://upstream")
+    clients = [manager.get_client(), manager.get_client("http://other")]
+    asyncio.run(manager.aclose())
+    assert manager.clients == {}
+    assert all(client.is_closed for client in clients)
+    # A new client is created on the next use
+    client = manager.get_client()
+    assert client not in clients
+    assert not client.is_closed
+    asyncio.run(manager.aclose())
@@ -0,0 +1,130 @@
+import asyncio
+
+import httpx
+
+from utils.upstream_health import (
+    CircuitBreaker,
+    UpstreamHealth,
+    HealthChecker,
+    CLOSED,
+    OPEN,
+    HALF_OPEN,
+)
+
+
+def test_breaker_opens_after_failures():
+    breaker = CircuitBreaker(
+        failure_threshold=2, recovery_time=60, slow_call_threshold=0
+    )
+    breaker.record_failure("error")
+    assert breaker.state == CLOSED
+    assert breaker.is_available()
+    breaker.record_failure("error")
+    assert breaker.state == OPEN
+    assert not breaker.is_available()
+    assert breaker.retry_after() > 59
+
+
+def test_breaker_half_open_probe():
+    breaker = CircuitBreaker(
+        failure_threshold=1, recovery_time=0, slow_call_threshold=0
+    )
+    breaker.record_failure("error")
+    # recovery time passed, a single probe is allowed
+    assert breaker.is_available()
+    assert breaker.state == HALF_OPEN
+    breaker.on_request()
+    assert not breaker.is_available()
+    # failing probe opens the breaker again
+    breaker.record_failure("error")
+    assert breaker.state == OPEN
+    assert breaker.is_available()
+    breaker.on_request()
+    breaker.record_success(0.1)
+    assert breaker.state == CLOSED
+    assert breaker.failures == 0
+
+
+def test_slow_calls_count_as_failures():
+    breaker = CircuitBreaker(
+        failure_threshold=1, recovery_time=60, slow_call_threshold=1
+    )
+    breaker.record_success(0.5)
+    assert breaker.state == CLOSED
+    breaker.record_success(2)
+    assert breaker.state == OPEN
+
+
+def test_filter_backends():
+    health = UpstreamHealth()
+    backends = [
+        {"url": None, "path": "a", "weight": 1},
+        {"url": None, "path": "b", "weight": 1},
+    ]
+    for _ in range(health.failure_threshold):
+        health.record_failure((None, "a"), "error")
+    assert health.filter_backends(backends) == [backends[1]]
+    assert health.filter_backends(backends, exclude=[(None, "b")]) == []
+    assert health.retry_after(backends[:1]) > 0
+    assert len(health.get_status()) == 2
+
+
+def test_cancelled_probe():
+    health = UpstreamHealth()
+    health.recovery_time = 0
+    key = (None, "a")
+    backends = [{"url": None, "path": "a", "weight": 1}]
+    for _ in range(health.failure_threshold):
+        health.record_failure(key, "error")
+    assert health.filter_backends(backends) == backends
+
+    async def probe():
+        health.on_request(key)
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            # What send_upstream does when the client disconnects
+            health.on_cancel(key)
+            raise
+
+    async def run():
+        task = asyncio.create_task(probe())
+        await asyncio.sleep(0)
+        # Only one probe at a time
+        assert health.filter_backends(backends) == []
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(run())
+    assert health.get_breaker(key).state == HALF_OPEN
+    assert health.filter_backends(backends) == backends
+
+
+class HealthyClient:
+    async def get(self, url, timeout=None):
+        return httpx.Response(200)
+
+
+class Clients:
+    def get_client(self, url):
+        return HealthyClient()
+
+
+def test_health_check_closes_half_open_breaker():
+    health = UpstreamHealth()
+    key = (None, "a")
+    breaker = health.get_breaker(key)
+    breaker.recovery_time = 0
+    for _ in range(health.failure_threshold):
+        breaker.record_failure("error")
+    assert breaker.is_available()
+    # A probe that never reports back
+    breaker.on_request()
+    assert not breaker.is_available()
+    checker = HealthChecker(health, None, Clients())
+    asyncio.run(checker.check_backend({"url": None, "path": "a"}))
+    assert breaker.state == CLOSED
+    assert breaker.is_available()
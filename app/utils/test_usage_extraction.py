@@ -0,0 +1,32 @@
+from utils.usage_extraction import extract_usage
+import json
+
+
+def test_extract_usage():
+    body = json.dumps(
+        {
+            "object": "list",
+            "data": [{"embedding": [0.1, 0.2], "index": 0}],
+            "usage": {"prompt_tokens": 5, "total_tokens": 5},
+        }
+    ).encode()
+    assert extract_usage(body) == {"prompt_tokens": 5, "total_tokens": 5}
+
+
+def test_extract_usage_ignores_strings():
+    # The generated text contains something that looks like a usage key.
+    body = json.dumps(
+        {
+            "choices": [{"text": 'the "usage": {"prompt_tokens": 1} \\'}],
+            "usage": {"prompt_tokens": 3, "completion_tokens": 2},
+        }
+    ).encode()
+    assert extract_usage(body) == {"prompt_tokens": 3, "completion_tokens": 2}
+    body = json.dumps({"choices": [{"text": 'the "usage": {"a": 1}'}]}).encode()
+    assert extract_usage(body) == None
+
+
+def test_extract_usage_missing():
+    assert extract_usage(b'{"error": "model not loaded"}') == None
+    assert extract_usage(b'{"usage": null}') == None
+    assert extract_usage(b"") == None
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+
+import httpx
+
+logger = logging.getLogger("app")
+
+
+class UpstreamClientManager:
+    """
+    Owns the connection pools towards the inference servers.
+
+    There is one pooled httpx.AsyncClient per upstream base URL. Clients are
+    created lazily (or eagerly by start()) and are all closed by aclose(),
+    which should be called from the application lifespan.
+    """
+
+    def __init__(self, default_url: str = None):
+        self.default_url = (
+            default_url if default_url is not None else os.environ.get("LLM_BASE_URL")
+        )
+        self.limits = httpx.Limits(
+            max_connections=int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", 512)),
+            max_keepalive_connections=int(
+                os.environ.get("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", 128)
+            ),
+            keepalive_expiry=float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", 60.0)),
+        )
+        self.timeout = httpx.Timeout(
+            float(os.environ.get("UPSTREAM_TIMEOUT", 300.0)),
+            connect=float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 10.0)),
+            pool=float(os.environ.get("UPSTREAM_POOL_TIMEOUT", 30.0)),
+        )
+        self.http2 = int(os.environ.get("UPSTREAM_HTTP2", 0)) == 1
+        self.warmup_connections = int(os.environ.get("UPSTREAM_WARMUP_CONNECTIONS", 4))
+        self.warmup_path = os.environ.get("UPSTREAM_WARMUP_PATH", "/")
+        self.clients: dict[str, httpx.AsyncClient] = {}
+
+    def _create_client(self, base_url: str) -> httpx.AsyncClient:
+        kwargs = {
+            "base_url": base_url,
+            "limits": self.limits,
+            "timeout": self.timeout,
+        }
+        if self.http2:
+            try:
+                return httpx.AsyncClient(http2=True, **kwargs)
+            except ImportError:
+                # http2 needs the optional h2 package
+                logger.warning(
+                    "HTTP/2 requested but h2 is not installed, using HTTP/1.1"
+                )
+                self.http2 = False
+        return httpx.AsyncClient(**kwargs)
+
+    def get_client(self, base_url: str = None) -> httpx.AsyncClient:
+        """
+        Get the pooled client for an upstream.
+
+        Parameters:
+        - base_url (str, optional): The base url of the upstream. Defaults to LLM_BASE_URL.
+
+        Returns:
+        - httpx.AsyncClient: The client that is shared by all requests to this upstream.
+        """
+        if base_url is None:
+            base_url = self.default_url
+        client = self.clients.get(base_url)
+        if client is None or client.is_closed:
+            client = self._create_client(base_url)
+            self.clients[base_url] = client
+        return client
+
+    async def warmup(self, base_url: str = None):
+        """
+        Open connections to an upstream so that the first requests do not
+        have to pay the connection (and TLS) setup.
+        The answer of the upstream does not matter, only the connection does.
+        """
+        client = self.get_client(base_url)
+
+        async def open_connection():
+            try:
+                response = await client.head(self.warmup_path)
+                await response.aclose()
+            except httpx.HTTPError as e:
+                logger.warning(
+                    f"Could not pre-warm connection to {client.base_url}: {e}"
+                )
+
+        await asyncio.gather(
+            *[open_connection() for _ in range(self.warmup_connections)]
+        )
+
+    async def start(self, base_urls: list[str] = None):
+        """
+        Create and pre-warm the clients for the known upstreams.
+        """
+        if base_urls is None:
+            base_urls = [self.default_url]
+        logger.info(f"Opening upstream connection pools for {base_urls}")
+        await asyncio.gather(*[self.warmup(url) for url in base_urls])
+
+    async def aclose(self):
+        """
+        Close all upstream connection pools.
+        """
+        clients = list(self.clients.values())
+        self.clients = {}
+        await asyncio.gather(*[client.aclose() for client in clients])
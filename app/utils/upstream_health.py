@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import os
+import time
+
+import httpx
+
+logger = logging.getLogger("app")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for a single upstream backend.
+
+    - closed: Requests are sent to the backend. After failure_threshold consecutive
+      failures (errors or calls slower than slow_call_threshold) the breaker opens.
+    - open: No requests are sent to the backend. After recovery_time the breaker
+      becomes half open.
+    - half_open: A single probe request is let through. If it succeeds the breaker
+      closes, otherwise it opens again.
+    """
+
+    def __init__(
+        self, failure_threshold: int, recovery_time: float, slow_call_threshold: float
+    ):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.slow_call_threshold = slow_call_threshold
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.last_error = None
+        self.last_latency = None
+
+    def is_available(self, now: float = None) -> bool:
+        """
+        Whether a request may be sent to the backend.
+        """
+        if self.state == OPEN:
+            if now is None:
+                now = time.monotonic()
+            if now - self.opened_at < self.recovery_time:
+                return False
+            self.state = HALF_OPEN
+            self.probe_in_flight = False
+        if self.state == HALF_OPEN:
+            return not self.probe_in_flight
+        return True
+
+    def retry_after(self, now: float = None) -> float:
+        """
+        Seconds until the breaker lets requests through again.
+        """
+        if not self.state == OPEN:
+            return 0
+        if now is None:
+            now = time.monotonic()
+        return max(self.recovery_time - (now - self.opened_at), 0)
+
+    def on_request(self):
+        if self.state == HALF_OPEN:
+            self.probe_in_flight = True
+
+    def abandon_probe(self):
+        """
+        The request ended without a result (e.g. it was cancelled), another
+        request may probe the backend.
+        """
+        if self.state == HALF_OPEN:
+            self.probe_in_flight = False
+
+    def record_success(self, latency: float = None):
+        self.last_latency = latency
+        if (
+            latency is not None
+            and self.slow_call_threshold > 0
+            and latency > self.slow_call_threshold
+        ):
+            self.record_failure(f"Slow response ({latency:.1f}s)")
+            return
+        self.failures = 0
+        if not self.state == CLOSED:
+            logger.info("Circuit closed, backend recovered")
+        self.state = CLOSED
+        self.probe_in_flight = False
+
+    def record_failure(self, error: str):
+        self.last_error = error
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if not self.state == OPEN:
+                logger.warning(
+                    f"Circuit opened after {self.failures} failures: {error}"
+                )
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def info(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "retry_after": self.retry_after(),
+            "last_error": self.last_error,
+            "last_latency": self.last_latency,
+        }
+
+
+class UpstreamHealth:
+    """
+    Keeps a circuit breaker per upstream backend (url, path).
+    """
+
+    def __init__(self):
+        self.failure_threshold = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 5))
+        self.recovery_time = float(os.environ.get("CIRCUIT_RECOVERY_TIME", 30.0))
+        # 0 disables counting slow calls as failures
+        self.slow_call_threshold = float(
+            os.environ.get("CIRCUIT_SLOW_CALL_THRESHOLD", 0)
+        )
+        self.breakers: dict[tuple, CircuitBreaker] = {}
+
+    def get_breaker(self, key: tuple) -> CircuitBreaker:
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                self.failure_threshold, self.recovery_time, self.slow_call_threshold
+            )
+            self.breakers[key] = breaker
+        return breaker
+
+    def filter_backends(self, backends: list[dict], exclude: list = ()) -> list[dict]:
+        """
+        Get the backends requests can currently be sent to.
+        """
+        now = time.monotonic()
+        return [
+            backend
+            for backend in backends
+            if (backend["url"], backend["path"]) not in exclude
+            and self.get_breaker((backend["url"], backend["path"])).is_available(now)
+        ]
+
+    def retry_after(self, backends: list[dict]) -> float:
+        """
+        Seconds until the first of the backends accepts requests again.
+        """
+        now = time.monotonic()
+        return min(
+            self.get_breaker((backend["url"], backend["path"])).retry_after(now)
+            for backend in backends
+        )
+
+    def on_request(self, key: tuple):
+        self.get_breaker(key).on_request()
+
+    def record_success(self, key: tuple, latency: float = None):
+        self.get_breaker(key).record_success(latency)
+
+    def record_failure(self, key: tuple, error: str):
+        self.get_breaker(key).record_failure(error)
+
+    def on_cancel(self, key: tuple):
+        self.get_breaker(key).abandon_probe()
+
+    def get_status(self):
+        return [
+            {"url": key[0], "path": key[1], **breaker.info()}
+            for key, breaker in self.breakers.items()
+        ]
+
+
+class HealthChecker:
+    """
+    Periodically checks all model backends and feeds the results into the circuit breakers.
+
+    Parameters:
+    - health (UpstreamHealth): The circuit breakers to update.
+    - model_handler (ModelHandler): Source of the model backends.
+    - upstream_clients (UpstreamClientManager): Source of the upstream clients.
+    """
+
+    def __init__(self, health: UpstreamHealth, model_handler, upstream_clients):
+        self.health = health
+        self.model_handler = model_handler
+        self.upstream_clients = upstream_clients
+        self.interval = float(os.environ.get("UPSTREAM_HEALTH_INTERVAL", 10.0))
+        self.timeout = float(os.environ.get("UPSTREAM_HEALTH_TIMEOUT", 5.0))
+        self.health_path = os.environ.get("UPSTREAM_HEALTH_PATH", "/v1/models")
+        self.task = None
+
+    async def check_backend(self, backend: dict):
+        key = (backend["url"], backend["path"])
+        client = self.upstream_clients.get_client(backend["url"])
+        start = time.monotonic()
+        try:
+            r = await client.get(
+                backend["path"] + self.health_path, timeout=self.timeout
+            )
+        except httpx.HTTPError as e:
+            self.health.record_failure(key, f"Health check failed: {e!r}")
+            return
+        if r.is_success:
+            breaker = self.health.get_breaker(key)
+            if breaker.state == OPEN:
+                # Let real traffic confirm the recovery.
+                breaker.opened_at = time.monotonic() - breaker.recovery_time
+            else:
+                # Also closes a half open breaker, even if its probe was lost
+                breaker.record_success(time.monotonic() - start)
+        else:
+            self.health.record_failure(
+                key, f"Health check returned status {r.status_code}"
+            )
+
+    async def check_all(self):
+        backends = {
+            (backend["url"], backend["path"]): backend
+            for backend in await self.model_handler.get_all_backends()
+        }
+        await asyncio.gather(
+            *[self.check_backend(backend) for backend in backends.values()]
+        )
+
+    async def run(self):
+        while True:
+            try:
+                await self.check_all()
+            except Exception as e:
+                logger.exception(e)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.interval > 0 and self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
@@ -0,0 +1,71 @@
+import json
+
+_decoder = json.JSONDecoder()
+_whitespace = b" \t\r\n"
+
+
+def is_escaped(data: bytes, pos: int) -> bool:
+    """
+    Check whether the character at pos is escaped by an odd number of backslashes,
+    i.e. whether a quote at pos is part of a JSON string instead of delimiting one.
+    """
+    backslashes = 0
+    pos -= 1
+    while pos >= 0 and data[pos] == 0x5C:
+        backslashes += 1
+        pos -= 1
+    return backslashes % 2 == 1
+
+
+def find_value(data: bytes, key: bytes, start: int = 0, end: int = None) -> int:
+    """
+    Find the start of the value of a JSON key in data, searching backwards
+    from end. Quotes inside JSON strings are always escaped, so an unescaped
+    '"key"' followed by a colon can only be an actual key.
+
+    Returns:
+    - int: The index of the first character of the value or -1 if the key was not found.
+    """
+    needle = b'"' + key + b'"'
+    if end is None:
+        end = len(data)
+    while True:
+        pos = data.rfind(needle, start, end)
+        if pos < 0:
+            return -1
+        end = pos
+        if is_escaped(data, pos):
+            continue
+        idx = pos + len(needle)
+        while idx < len(data) and data[idx] in _whitespace:
+            idx += 1
+        if idx >= len(data) or data[idx] != 0x3A:  # ':'
+            continue
+        idx += 1
+        while idx < len(data) and data[idx] in _whitespace:
+            idx += 1
+        return idx
+
+
+def extract_usage(body: bytes) -> dict | None:
+    """
+    Extract the usage object from an OpenAI style response body without
+    parsing the whole body. The usage is the last field of these responses,
+    so only the tail of the body needs to be decoded.
+
+    Parameters:
+    - body (bytes): The raw response body.
+
+    Returns:
+    - dict: The usage object, or None if the body does not contain usage information.
+    """
+    idx = find_value(body, b"usage")
+    if idx < 0:
+        return None
+    try:
+        usage, _ = _decoder.raw_decode(body[idx:].decode())
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(usage, dict):
+        return None
+    return usage
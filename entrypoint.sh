@@ -1,2 +1,2 @@
 #!/usr/bin/env bash
-gunicorn main:app --bind 0.0.0.0:3000 -k uvicorn.workers.UvicornWorker --workers 1
\ No newline at end of file
+gunicorn main:app --bind 0.0.0.0:3000 -k uvicorn.workers.UvicornWorker --workers 1 --graceful-timeout 60
\ No newline at end of file